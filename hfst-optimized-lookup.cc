@@ -30,7 +30,35 @@
 //#endif
 
 #include <cstdarg>
+#include <chrono>
 #include <iostream> // DEBUG
+#include <new>
+
+#if !defined(OL_SCALAR_SCAN) && \
+  (defined(__SSE2__) || defined(_M_X64) || (defined(_M_IX86_FP) && _M_IX86_FP >= 2))
+#  define OL_SSE2_SCAN 1
+#  include <emmintrin.h>
+#endif
+
+#ifndef _MSC_VER
+#  include <sys/mman.h>
+#  include <sys/stat.h>
+#  include <unistd.h>
+#else
+#  include <sys/types.h>
+#  include <sys/stat.h>
+#endif
+
+#if BUILD_HFSTOL_MAIN
+#  include <cerrno>
+#  include <csignal>
+#  include <deque>
+#  include <pthread.h>
+#  include <sys/socket.h>
+#  include <sys/time.h>
+#  include <sys/un.h>
+#  include <unistd.h>
+#endif
 
 static OutputType outputType = xerox;
 
@@ -38,8 +66,8 @@ static bool verboseFlag = false;
 
 static bool displayWeightsFlag = false;
 static bool displayUniqueFlag = false;
-static bool echoInputsFlag = false;
 static bool beFast = false;
+static bool epsilonClosuresFlag = false;
 static int maxAnalyses = INT_MAX;
 static bool limit_reached = false;
 static unsigned long call_counter = 0;
@@ -47,8 +75,17 @@ static double time_cutoff = 0.0;
 static clock_t start_clock;
 
 static float beam=-1;
+
+#if BUILD_HFSTOL_MAIN
+// Only the command line uses these
+static bool echoInputsFlag = false;
+static bool prefaultFlag = false;
 static bool pipe_input = false;
 static bool pipe_output = false;
+static const char * server_socket_path = NULL;
+static int server_threads = 0;
+static int server_timeout = 60;
+#endif
 
 bool print_usage(void)
 {
@@ -79,10 +116,23 @@ bool print_usage(void)
     "                              (with this option enabled -u and -n don't work and\n" <<
     "                              output won't be ordered by weight).\n" <<
     "  -p, --pipe-mode[=STREAM]    Control input and output streams.\n" <<
+    "  -S, --server=SOCKET         Instead of reading standard input, answer lookups\n" <<
+    "                              from clients connecting to the unix domain socket\n" <<
+    "                              SOCKET, one input per line, in xerox format\n" <<
+    "  -j, --threads=N             With --server, serve up to N clients at a time\n" <<
+    "                              (default: one per processor)\n" <<
+    "      --server-timeout=S      With --server, close connections that send\n" <<
+    "                              nothing for S seconds (default: 60)\n" <<
+    "  -E, --epsilon-closures      Work out where the epsilon arcs of each state\n" <<
+    "                              lead when loading, for faster lookups at the\n" <<
+    "                              cost of memory (unweighted transducers only)\n" <<
+    "  -P, --prefault              Read a compiled transducer into memory when\n" <<
+    "                              loading it, hottest transitions first\n" <<
     "\n" <<
     "N must be a positive integer. B must be a non-negative float.\n" <<
     "S must be a non-negative float. The default, 0.0, indicates no cutoff.\n"
     "Options -n and -b are combined with AND, i.e. they both restrict the output.\n" <<
+    "--server can't be combined with --time-cutoff, and ignores --fast and --echo.\n" <<
     "\n" <<
     "STREAM can be { input, output, both }. If not given, defaults to {both}.\n" <<
 #ifdef _MSC_VER
@@ -116,597 +166,3613 @@ bool print_short_help(void)
   return true;
 }
 
-TransducerFile::TransducerFile(const char *p):
-    path(p),
-    file(p),
-    header(file.f),
-    alphabet(file.f, header.symbol_count())
+// Adds the time since it was started, or last finished a phase, to a
+// LoadProfile
+class PhaseTimer
 {
-    transducer = instantiateTransducer(file.f, header, alphabet);
-}
+private:
+    LoadProfile & profile;
+    std::chrono::steady_clock::time_point start;
 
-std::vector<std::vector<std::string> > TransducerFile::lookup(const char* input_text) {
-  SymbolNumber * input_string = (SymbolNumber*)(malloc(2000));
-  for (int i = 0; i < 1000; ++i)
+public:
+    PhaseTimer(LoadProfile & p):
+        profile(p),
+        start(std::chrono::steady_clock::now())
+        {}
+
+    void restart(void)
+        {
+            start = std::chrono::steady_clock::now();
+        }
+
+    void finish(const char * phase)
+        {
+            std::chrono::steady_clock::time_point now = std::chrono::steady_clock::now();
+            profile.phases.push_back(std::make_pair(
+                std::string(phase), std::chrono::duration<double>(now - start).count()));
+            start = now;
+        }
+};
+
+static void warn_about_epsilon_cycles(bool has_epsilon_cycles)
+{
+  if (has_epsilon_cycles)
     {
-      input_string[i] = NO_SYMBOL_NUMBER;
+      std::cerr << "!! Warning: transducer has epsilon cycles                  !!\n"
+                << "!! This is currently not handled - if they are encountered !!\n"
+                << "!! program *will* segfault.                                !!\n";
     }
+}
 
-      int i = 0;
-      SymbolNumber k = NO_SYMBOL_NUMBER;
-
-      bool tokenization_failed = false;
-      for ( const char ** Str = &input_text; **Str != 0; )
+// Letters with a diacritic that Unicode can also write as a base letter
+// followed by a combining mark; compose-latin and decompose-latin only
+// know these.
+static const unsigned int DECOMPOSITIONS[][3] =
+  {
+    // composed, base, combining mark
+    {0x00C0, 'A', 0x0300}, {0x00C1, 'A', 0x0301}, {0x00C2, 'A', 0x0302},
+    {0x00C3, 'A', 0x0303}, {0x00C4, 'A', 0x0308}, {0x00C7, 'C', 0x0327},
+    {0x00C8, 'E', 0x0300}, {0x00C9, 'E', 0x0301}, {0x00CA, 'E', 0x0302},
+    {0x00CB, 'E', 0x0308}, {0x00CC, 'I', 0x0300}, {0x00CD, 'I', 0x0301},
+    {0x00CE, 'I', 0x0302}, {0x00CF, 'I', 0x0308}, {0x00D1, 'N', 0x0303},
+    {0x00D2, 'O', 0x0300}, {0x00D3, 'O', 0x0301}, {0x00D4, 'O', 0x0302},
+    {0x00D5, 'O', 0x0303}, {0x00D6, 'O', 0x0308}, {0x00D9, 'U', 0x0300},
+    {0x00DA, 'U', 0x0301}, {0x00DB, 'U', 0x0302}, {0x00DC, 'U', 0x0308},
+    {0x00DD, 'Y', 0x0301}, {0x00E0, 'a', 0x0300}, {0x00E1, 'a', 0x0301},
+    {0x00E2, 'a', 0x0302}, {0x00E3, 'a', 0x0303}, {0x00E4, 'a', 0x0308},
+    {0x00E7, 'c', 0x0327}, {0x00E8, 'e', 0x0300}, {0x00E9, 'e', 0x0301},
+    {0x00EA, 'e', 0x0302}, {0x00EB, 'e', 0x0308}, {0x00EC, 'i', 0x0300},
+    {0x00ED, 'i', 0x0301}, {0x00EE, 'i', 0x0302}, {0x00EF, 'i', 0x0308},
+    {0x00F1, 'n', 0x0303}, {0x00F2, 'o', 0x0300}, {0x00F3, 'o', 0x0301},
+    {0x00F4, 'o', 0x0302}, {0x00F5, 'o', 0x0303}, {0x00F6, 'o', 0x0308},
+    {0x00F9, 'u', 0x0300}, {0x00FA, 'u', 0x0301}, {0x00FB, 'u', 0x0302},
+    {0x00FC, 'u', 0x0308}, {0x00FD, 'y', 0x0301}, {0x00FF, 'y', 0x0308},
+    {0x0100, 'A', 0x0304}, {0x0101, 'a', 0x0304}, {0x0112, 'E', 0x0304},
+    {0x0113, 'e', 0x0304}, {0x012A, 'I', 0x0304}, {0x012B, 'i', 0x0304},
+    {0x014C, 'O', 0x0304}, {0x014D, 'o', 0x0304}, {0x016A, 'U', 0x0304},
+    {0x016B, 'u', 0x0304}
+  };
+
+// Vowels with a circumflex, and the same vowels with a macron; both are
+// used to write long vowels
+static const unsigned int CIRCUMFLEX_MACRON[][2] =
+  {
+    {0x00C2, 0x0100}, {0x00CA, 0x0112}, {0x00CE, 0x012A}, {0x00D4, 0x014C},
+    {0x00DB, 0x016A}, {0x00E2, 0x0101}, {0x00EA, 0x0113}, {0x00EE, 0x012B},
+    {0x00F4, 0x014D}, {0x00FB, 0x016B}
+  };
+
+static const size_t DECOMPOSITION_COUNT =
+  sizeof(DECOMPOSITIONS) / sizeof(DECOMPOSITIONS[0]);
+static const size_t CIRCUMFLEX_MACRON_COUNT =
+  sizeof(CIRCUMFLEX_MACRON) / sizeof(CIRCUMFLEX_MACRON[0]);
+
+// Split UTF-8 text into code points, returning false if it isn't valid
+static bool decode_utf8(const std::string & text, std::vector<unsigned int> & code_points)
+{
+  for (size_t i = 0; i < text.size(); )
+    {
+      unsigned char c = text[i];
+      size_t length = c < 0x80 ? 1 : (c >> 5) == 0x6 ? 2 : (c >> 4) == 0xE ? 3 : (c >> 3) == 0x1E ? 4 : 0;
+      if (length == 0 || i + length > text.size())
         {
-          k = transducer->find_next_key(Str);
-          if (k == NO_SYMBOL_NUMBER)
+          return false;
+        }
+      unsigned int code_point = length == 1 ? c : c & (0x7F >> length);
+      for (size_t k = 1; k < length; ++k)
+        {
+          unsigned char continuation = text[i + k];
+          if ((continuation >> 6) != 0x2)
             {
-                tokenization_failed = true;
-              break;
+              return false;
             }
-          input_string[i] = k;
-          ++i;
+          code_point = (code_point << 6) | (continuation & 0x3F);
         }
-
-      transducer->analyze(input_string);
-
-      std::vector<std::vector<std::string> > output;
-      if (tokenization_failed) {
-          // Return empty output vector
-          return output;
-      }
-
-      Transducer* t = dynamic_cast<Transducer*>(transducer);
-      if (t) {
-          DisplayVector analyses = t->get_display_vector();
-
-          for (DisplayVector::iterator it = analyses.begin(); it != analyses.end(); it++) {
-              std::vector<std::string> output_analysis;
-              for (std::vector<std::string>::iterator it2 = it->begin(); it2 != it->end(); it2++) {
-                output_analysis.push_back(*it2);
-              }
-
-              output.push_back(output_analysis);
-          }
-      } else {
-          throw std::runtime_error("Weighted transducers not yet supported");
-      }
-      return output;
+      code_points.push_back(code_point);
+      i += length;
+    }
+  return true;
 }
 
-#if BUILD_HFSTOL_MAIN
-int main(int argc, char **argv)
+static std::string encode_utf8(const std::vector<unsigned int> & code_points)
 {
-
-  int c;
-
-  while (true)
+  std::string text;
+  for (std::vector<unsigned int>::const_iterator it = code_points.begin(); it != code_points.end(); ++it)
     {
-      static struct option long_options[] =
+      unsigned int c = *it;
+      if (c < 0x80)
         {
-          // first the hfst-mandated options
-          {"help",         no_argument,       0, 'h'},
-          {"version",      no_argument,       0, 'V'},
-          {"verbose",      no_argument,       0, 'v'},
-          {"quiet",        no_argument,       0, 'q'},
-          {"silent",       no_argument,       0, 's'},
-          // the hfst-optimized-lookup-specific options
-          {"echo-inputs",  no_argument,       0, 'e'},
-          {"show-weights", no_argument,       0, 'w'},
-          {"beam",         required_argument, 0, 'b'},
-          {"time-cutoff",  required_argument, 0, 't'},
-          {"unique",       no_argument,       0, 'u'},
-          {"xerox",        no_argument,       0, 'x'},
-          {"fast",         no_argument,       0, 'f'},
-          {"pipe-mode",    optional_argument,       0, 'p'},
-          {"analyses",     required_argument, 0, 'n'},
-          {0,              0,                 0,  0 }
-        };
-
-      int option_index = 0;
-      c = getopt_long(argc, argv, "hVvqsewb:t:uxfn:p::", long_options, &option_index);
-
-      if (c == -1) // no more options to look at
-        break;
-
-      switch (c)
+          text.push_back(c);
+        }
+      else if (c < 0x800)
         {
-        case 'h':
-          print_usage();
-          return EXIT_SUCCESS;
-          break;
-
-        case 'V':
-          print_version();
-          return EXIT_SUCCESS;
-          break;
-
-        case 'v':
-#ifdef OL_DEBUG
-          printDebuggingInformationFlag = true;
-          preserveDiacriticRepresentationsFlag = true;
-#endif
-
-#ifdef TIMING
-          timingFlag = true;
-#endif
-          verboseFlag = true;
-          break;
-
-        case 'q':
-        case 's':
-#ifdef OL_DEBUG
-          printDebuggingInformationFlag = false;
-          preserveDiacriticRepresentationsFlag = false;
-#endif
-
-#ifdef TIMING
-          timingFlag = false;
-#endif
-          verboseFlag = false;
-          displayWeightsFlag = true;
-          break;
+          text.push_back(0xC0 | (c >> 6));
+          text.push_back(0x80 | (c & 0x3F));
+        }
+      else if (c < 0x10000)
+        {
+          text.push_back(0xE0 | (c >> 12));
+          text.push_back(0x80 | ((c >> 6) & 0x3F));
+          text.push_back(0x80 | (c & 0x3F));
+        }
+      else
+        {
+          text.push_back(0xF0 | (c >> 18));
+          text.push_back(0x80 | ((c >> 12) & 0x3F));
+          text.push_back(0x80 | ((c >> 6) & 0x3F));
+          text.push_back(0x80 | (c & 0x3F));
+        }
+    }
+  return text;
+}
 
-        case 'e':
-          echoInputsFlag = true;
-          break;
+// Lowercase the letters of Basic Latin, Latin-1, Latin Extended-A, and
+// the basic Greek and Cyrillic alphabets
+static unsigned int to_lower(unsigned int c)
+{
+  if ((c >= 'A' && c <= 'Z') ||
+      (c >= 0x00C0 && c <= 0x00DE && c != 0x00D7) ||
+      (c >= 0x0391 && c <= 0x03AB && c != 0x03A2) ||
+      (c >= 0x0410 && c <= 0x042F))
+    {
+      return c + 0x20;
+    }
+  if (c >= 0x0400 && c <= 0x040F)
+    {
+      return c + 0x50;
+    }
+  // Latin Extended-A mostly alternates between upper and lower case
+  if (((c >= 0x0100 && c <= 0x0137) || (c >= 0x014A && c <= 0x0177)) &&
+      c != 0x0130 && c % 2 == 0)
+    {
+      return c + 1;
+    }
+  if (((c >= 0x0139 && c <= 0x0148) || (c >= 0x0179 && c <= 0x017E)) && c % 2 == 1)
+    {
+      return c + 1;
+    }
+  if (c == 0x0178)
+    {
+      return 0x00FF;
+    }
+  return c;
+}
 
-        case 'w':
-          displayWeightsFlag = true;
-          break;
+InputRule input_rule_from_name(const std::string & name)
+{
+  if (name == "compose-latin")
+    return COMPOSE_LATIN;
+  if (name == "decompose-latin")
+    return DECOMPOSE_LATIN;
+  if (name == "lowercase")
+    return LOWERCASE;
+  if (name == "circumflex-to-macron")
+    return CIRCUMFLEX_TO_MACRON;
+  if (name == "macron-to-circumflex")
+    return MACRON_TO_CIRCUMFLEX;
+  throw std::invalid_argument("Unknown input rule ‘" + name + "’");
+}
 
-        case 'u':
-          displayUniqueFlag = true;
-          break;
+const char * input_rule_name(InputRule rule)
+{
+  switch (rule)
+    {
+    case COMPOSE_LATIN:
+      return "compose-latin";
+    case DECOMPOSE_LATIN:
+      return "decompose-latin";
+    case LOWERCASE:
+      return "lowercase";
+    case CIRCUMFLEX_TO_MACRON:
+      return "circumflex-to-macron";
+    case MACRON_TO_CIRCUMFLEX:
+      return "macron-to-circumflex";
+    }
+  return "";
+}
 
-        case 'b':
-          beam = atof(optarg);
-          if (beam < 0)
+std::string apply_input_rule(InputRule rule, const std::string & input)
+{
+  std::vector<unsigned int> in;
+  if (!decode_utf8(input, in))
+    {
+      return input;
+    }
+  std::vector<unsigned int> out;
+  for (size_t i = 0; i < in.size(); ++i)
+    {
+      unsigned int c = in[i];
+      switch (rule)
+        {
+        case COMPOSE_LATIN:
+          if (i + 1 < in.size())
             {
-              std::cerr << "Invalid argument for --beam\n";
-              return EXIT_FAILURE;
+              for (size_t k = 0; k < DECOMPOSITION_COUNT; ++k)
+                {
+                  if (DECOMPOSITIONS[k][1] == c && DECOMPOSITIONS[k][2] == in[i + 1])
+                    {
+                      c = DECOMPOSITIONS[k][0];
+                      ++i;
+                      break;
+                    }
+                }
             }
           break;
-        case 't':
-            time_cutoff = atof(optarg);
-            if (time_cutoff < 0.0)
-            {
-                std::cerr << "Invalid argument for --time-cutoff\n";
-                return EXIT_FAILURE;
-            }
-            break;
-        case 'n':
-          maxAnalyses = atoi(optarg);
-          if (maxAnalyses < 1)
+        case DECOMPOSE_LATIN:
+          for (size_t k = 0; k < DECOMPOSITION_COUNT; ++k)
             {
-              std::cerr << "Invalid or no argument for analyses count\n";
-              return EXIT_FAILURE;
+              if (DECOMPOSITIONS[k][0] == c)
+                {
+                  out.push_back(DECOMPOSITIONS[k][1]);
+                  c = DECOMPOSITIONS[k][2];
+                  break;
+                }
             }
           break;
-
-        case 'x':
-          outputType = xerox;
-          break;
-
-        case 'f':
-          beFast = true;
-          break;
-
-        case 'p':
-          if (optarg == NULL)
-            { pipe_input = true; pipe_output = true; }
-          else if (strcmp(optarg, "both") == 0 || strcmp(optarg, "BOTH") == 0)
-            { pipe_input = true; pipe_output = true; }
-          else if (strcmp(optarg, "input") == 0 || strcmp(optarg, "INPUT") == 0 ||
-                   strcmp(optarg, "in") == 0 || strcmp(optarg, "IN") == 0)
-            { pipe_input = true; }
-          else if (strcmp(optarg, "output") == 0 || strcmp(optarg, "OUTPUT") == 0 ||
-                   strcmp(optarg, "out") == 0 || strcmp(optarg, "OUT") == 0)
-            { pipe_output = true; }
-          else
-            { std::cerr << "--pipe-mode argument " << std::string(optarg) << " unrecognised\n\n";
-              return EXIT_FAILURE; }
+        case LOWERCASE:
+          c = to_lower(c);
           break;
-
-        default:
-          std::cerr << "Invalid option\n\n";
-          print_short_help();
-          return EXIT_FAILURE;
+        case CIRCUMFLEX_TO_MACRON:
+        case MACRON_TO_CIRCUMFLEX:
+          {
+            size_t from = rule == CIRCUMFLEX_TO_MACRON ? 0 : 1;
+            for (size_t k = 0; k < CIRCUMFLEX_MACRON_COUNT; ++k)
+              {
+                if (CIRCUMFLEX_MACRON[k][from] == c)
+                  {
+                    c = CIRCUMFLEX_MACRON[k][1 - from];
+                    break;
+                  }
+              }
+          }
           break;
         }
+      out.push_back(c);
     }
+  return encode_utf8(out);
+}
 
-#ifdef _MSC_VER
-  //hfst::print_output_to_console(!pipe_output); // has no effect on windows or mac
-#endif
+LookupRecorder::LookupRecorder():
+    enabled(false),
+    slow_nanoseconds(10000000),
+    slow_count(0),
+    slow_capacity(100),
+    slow_next(0)
+{
+  reset();
+}
 
-  // no more options, we should now be at the input filename
-  if ( (optind + 1) < argc)
+const char * LookupRecorder::method_name(Method m)
+{
+  switch (m)
     {
-      std::cerr << "More than one input file given\n";
-      return EXIT_FAILURE;
+    case LOOKUP: return "lookup";
+    case LOOKUP_LEMMA_WITH_AFFIXES: return "lookup_lemma_with_affixes";
+    case LOOKUP_VARIANTS: return "lookup_variants";
+    case BULK_LOOKUP: return "bulk_lookup";
+    case COMPLETE: return "complete";
+    default: break;
     }
-  else if ( (optind + 1) == argc)
+  throw std::runtime_error("should not happen");
+}
+
+void LookupRecorder::configure(bool enable, double slow_seconds, size_t slow_log_size)
+{
+  {
+    std::lock_guard<std::mutex> lock(slow_mutex);
+    if (slow_log_size != slow_capacity)
+      {
+        // the oldest ones go first
+        std::vector<SlowLookup> kept;
+        for (size_t n = 0; n < slow_lookups.size(); ++n)
+          {
+            kept.push_back(slow_lookups[(slow_next + n) % slow_lookups.size()]);
+          }
+        if (kept.size() > slow_log_size)
+          {
+            kept.erase(kept.begin(), kept.end() - slow_log_size);
+          }
+        slow_lookups.swap(kept);
+        slow_capacity = slow_log_size;
+        slow_next = 0;
+      }
+  }
+  slow_nanoseconds = (unsigned long long)(slow_seconds * 1e9);
+  enabled = enable;
+}
+
+void LookupRecorder::reset(void)
+{
+  for (size_t m = 0; m < METHOD_COUNT; ++m)
     {
-      FILE * f = fopen(argv[(optind)], "rb");
-      if (f == NULL)
+      for (size_t b = 0; b < LATENCY_BUCKETS; ++b)
         {
-          std::cerr << "Could not open file " << argv[(optind)] << std::endl;
-          return 1;
+          latency_counts[m][b] = 0;
         }
-      return setup(f);
+      latency_nanoseconds[m] = 0;
     }
-  else
+  for (size_t b = 0; b < ANALYSES_BUCKETS; ++b)
     {
-      std::cerr << "No input file given\n";
-      return EXIT_FAILURE;
+      analyses_counts[b] = 0;
     }
+  analyses_sum = 0;
+  slow_count = 0;
+  std::lock_guard<std::mutex> lock(slow_mutex);
+  slow_lookups.clear();
+  slow_next = 0;
 }
-#endif
 
-void TransducerHeader::skip_hfst3_header(FILE * f)
+void LookupRecorder::note_latency(Method m, unsigned long long nanoseconds)
 {
-    const char* header1 = "HFST";
-    unsigned int header_loc = 0; // how much of the header has been found
-    int c;
-    for(header_loc = 0; header_loc < strlen(header1) + 1; header_loc++)
+  size_t b = 0;
+  while (b + 1 < LATENCY_BUCKETS && (1000ULL << b) < nanoseconds)
     {
-        c = getc(f);
+      ++b;
+    }
+  latency_counts[m][b].fetch_add(1, std::memory_order_relaxed);
+  latency_nanoseconds[m].fetch_add(nanoseconds, std::memory_order_relaxed);
+}
+
+void LookupRecorder::count_analyses(size_t analyses)
+{
+  if (!enabled.load(std::memory_order_relaxed))
+    {
+      return;
+    }
+  size_t b = 0;
+  while (b + 1 < ANALYSES_BUCKETS && (b == 0 ? 0 : (size_t)1 << (b - 1)) < analyses)
+    {
+      ++b;
+    }
+  analyses_counts[b].fetch_add(1, std::memory_order_relaxed);
+  analyses_sum.fetch_add(analyses, std::memory_order_relaxed);
+}
+
+void LookupRecorder::finish(Method m, TimePoint began)
+{
+  if (began == TimePoint())
+    {
+      return;
+    }
+  note_latency(m, std::chrono::duration_cast<std::chrono::nanoseconds>(
+                 std::chrono::steady_clock::now() - began).count());
+}
+
+void LookupRecorder::finish(Method m, TimePoint began, const char * input, size_t analyses)
+{
+  if (began == TimePoint())
+    {
+      return;
+    }
+  unsigned long long nanoseconds = std::chrono::duration_cast<std::chrono::nanoseconds>(
+    std::chrono::steady_clock::now() - began).count();
+  note_latency(m, nanoseconds);
+  count_analyses(analyses);
+  if (nanoseconds < slow_nanoseconds.load(std::memory_order_relaxed))
+    {
+      return;
+    }
+  slow_count.fetch_add(1, std::memory_order_relaxed);
+  SlowLookup slow;
+  slow.method = method_name(m);
+  slow.input = input;
+  slow.seconds = nanoseconds / 1e9;
+  slow.analyses = analyses;
+  std::lock_guard<std::mutex> lock(slow_mutex);
+  if (slow_lookups.size() < slow_capacity)
+    {
+      slow_lookups.push_back(slow);
+    }
+  else if (slow_capacity > 0)
+    {
+      slow_lookups[slow_next] = slow;
+      slow_next = (slow_next + 1) % slow_capacity;
+    }
+}
+
+LookupMetrics LookupRecorder::metrics(void)
+{
+  LookupMetrics metrics;
+  for (size_t m = 0; m < METHOD_COUNT; ++m)
+    {
+      Histogram h;
+      h.count = 0;
+      for (size_t b = 0; b < LATENCY_BUCKETS; ++b)
+        {
+          if (b + 1 < LATENCY_BUCKETS)
+            {
+              h.bounds.push_back((1ULL << b) / 1e6);
+            }
+          h.counts.push_back(latency_counts[m][b].load(std::memory_order_relaxed));
+          h.count += h.counts.back();
+        }
+      h.sum = latency_nanoseconds[m].load(std::memory_order_relaxed) / 1e9;
+      metrics.latencies.push_back(std::make_pair(std::string(method_name((Method)m)), h));
+    }
+
+  metrics.analyses.count = 0;
+  for (size_t b = 0; b < ANALYSES_BUCKETS; ++b)
+    {
+      if (b + 1 < ANALYSES_BUCKETS)
+        {
+          metrics.analyses.bounds.push_back(b == 0 ? 0 : (double)(1ULL << (b - 1)));
+        }
+      metrics.analyses.counts.push_back(analyses_counts[b].load(std::memory_order_relaxed));
+      metrics.analyses.count += metrics.analyses.counts.back();
+    }
+  metrics.analyses.sum = analyses_sum.load(std::memory_order_relaxed);
+
+  metrics.slow_lookup_count = slow_count.load(std::memory_order_relaxed);
+  std::lock_guard<std::mutex> lock(slow_mutex);
+  for (size_t n = 0; n < slow_lookups.size(); ++n)
+    {
+      metrics.slow_lookups.push_back(slow_lookups[(slow_next + n) % slow_lookups.size()]);
+    }
+  return metrics;
+}
+
+// One Prometheus histogram, with an optional label on every sample
+static void write_prometheus_histogram(std::ostringstream & out, const std::string & name,
+                                       const std::string & label, const Histogram & h)
+{
+  std::string labels = label.empty() ? "" : label + ",";
+  unsigned long long cumulative = 0;
+  for (size_t b = 0; b < h.counts.size(); ++b)
+    {
+      cumulative += h.counts[b];
+      out << name << "_bucket{" << labels << "le=\"";
+      if (b < h.bounds.size())
+        {
+          out << h.bounds[b];
+        }
+      else
+        {
+          out << "+Inf";
+        }
+      out << "\"} " << cumulative << "\n";
+    }
+  std::string braces = label.empty() ? "" : "{" + label + "}";
+  out << name << "_sum" << braces << " " << h.sum << "\n";
+  out << name << "_count" << braces << " " << h.count << "\n";
+}
+
+std::string LookupMetrics::prometheus(const std::string & prefix) const
+{
+  std::ostringstream out;
+  out.precision(10);
+  std::string name = prefix + "_lookup_seconds";
+  out << "# HELP " << name << " Time taken by lookups, by method.\n"
+      << "# TYPE " << name << " histogram\n";
+  for (size_t m = 0; m < latencies.size(); ++m)
+    {
+      write_prometheus_histogram(out, name, "method=\"" + latencies[m].first + "\"",
+                                 latencies[m].second);
+    }
+  name = prefix + "_analyses_per_input";
+  out << "# HELP " << name << " Analyses of each input looked up.\n"
+      << "# TYPE " << name << " histogram\n";
+  write_prometheus_histogram(out, name, "", analyses);
+  name = prefix + "_slow_lookups_total";
+  out << "# HELP " << name << " Lookups that took at least the slow lookup threshold.\n"
+      << "# TYPE " << name << " counter\n"
+      << name << " " << slow_lookup_count << "\n";
+  return out.str();
+}
+
+TransducerFile::Loaded::Loaded(const char *p, bool epsilon_closures,
+                               const char *snapshot_path, bool prefault):
+    path(p),
+    tables(NULL),
+    transducer(NULL),
+    snapshot(NULL)
+{
+    PhaseTimer timer(profile);
+    File file(p);
+    stamp = LookupSnapshot::stamp(file.f);
+    if (TransducerTables::is_compiled(file.f))
+      {
+        tables = TransducerTables::load(file.f);
+        timer.finish("map");
+        if (prefault)
+          {
+            tables->prefault();
+            timer.finish("prefault");
+          }
+      }
+    else
+      {
+        TransducerHeader header(file.f);
+        timer.finish("header");
+        TransducerAlphabet alphabet(file.f, header.symbol_count());
+        timer.finish("alphabet");
+        if (header.probe_flag(Weighted))
+          {
+            if (snapshot_path != NULL)
+              {
+                throw std::runtime_error("Weighted transducers not yet supported");
+              }
+            number_of_symbols = header.symbol_count();
+            transducer = instantiateTransducer(file.f, header, alphabet);
+            timer.finish("tables");
+            return;
+          }
+        tables = TransducerTables::from_hfstol(file.f, header, alphabet, &profile);
+        timer.restart();
+      }
+    if (epsilon_closures)
+      {
+        tables->compute_epsilon_closures();
+        timer.finish("epsilon closures");
+      }
+    if (snapshot_path != NULL)
+      {
+        try
+          {
+            snapshot = LookupSnapshot::load(snapshot_path, file.f, stamp,
+                                            tables->symbol_count());
+          }
+        catch (...)
+          {
+            delete tables;
+            throw;
+          }
+        timer.finish("snapshot");
+      }
+    number_of_symbols = tables->symbol_count();
+    warn_about_epsilon_cycles(tables->probe_flag(Has_unweighted_input_epsilon_cycles) ||
+                              tables->probe_flag(Has_input_epsilon_cycles));
+}
+
+TransducerFile::Loaded::~Loaded()
+{
+  for (size_t n = 0; n < idle_transducers.size(); ++n)
+    {
+      delete idle_transducers[n];
+    }
+  delete transducer;
+  delete snapshot;
+  delete tables;
+}
+
+TransducerFile::TransducerFile(const char *p, bool epsilon_closures,
+                               const char *snapshot_path, bool prefault):
+    with_epsilon_closures(epsilon_closures),
+    with_prefault(prefault),
+    loaded(new Loaded(p, epsilon_closures, snapshot_path, prefault)),
+    counting_hits(false)
+{}
+
+std::shared_ptr<TransducerFile::Loaded> TransducerFile::current(void)
+{
+  std::lock_guard<std::mutex> lock(loaded_mutex);
+  return loaded;
+}
+
+void TransducerFile::reload(const char *p, const char *snapshot_path)
+{
+  std::string new_path = p == NULL ? current()->path : std::string(p);
+  // Loading takes as long as it takes without holding anything up; only
+  // the switch is done under the lock
+  std::shared_ptr<Loaded> next(new Loaded(new_path.c_str(), with_epsilon_closures,
+                                          snapshot_path, with_prefault));
+  {
+    std::lock_guard<std::mutex> lock(loaded_mutex);
+    loaded.swap(next);
+  }
+  // next, now the old transducer, is freed here unless lookups still
+  // hold on to it
+}
+
+int TransducerFile::symbol_count(void)
+{
+  return current()->number_of_symbols;
+}
+
+LoadProfile TransducerFile::load_profile(void)
+{
+  return current()->profile;
+}
+
+namespace
+{
+  // Orders hit counts from the most hits to the fewest
+  struct MoreHits
+  {
+    bool operator()(const std::pair<std::string, size_t> & a,
+                    const std::pair<std::string, size_t> & b) const
+      {
+        return a.second > b.second;
+      }
+  };
+}
+
+void TransducerFile::count_hit(const char * input_string)
+{
+  if (counting_hits)
+    {
+      std::lock_guard<std::mutex> lock(hits_mutex);
+      ++hits[input_string];
+    }
+}
+
+void TransducerFile::set_hit_counting(bool enabled)
+{
+  counting_hits = enabled;
+}
+
+void TransducerFile::set_metrics(bool enabled, double slow_seconds, size_t slow_log_size)
+{
+  recorder.configure(enabled, slow_seconds, slow_log_size);
+}
+
+LookupMetrics TransducerFile::metrics(void)
+{
+  return recorder.metrics();
+}
+
+void TransducerFile::reset_metrics(void)
+{
+  recorder.reset();
+}
+
+std::vector<std::pair<std::string, size_t> > TransducerFile::hit_counts(void)
+{
+  std::vector<std::pair<std::string, size_t> > counts;
+  {
+    std::lock_guard<std::mutex> lock(hits_mutex);
+    counts.assign(hits.begin(), hits.end());
+  }
+  // ties stay in alphabetical order
+  std::stable_sort(counts.begin(), counts.end(), MoreHits());
+  return counts;
+}
+
+void TransducerFile::save_snapshot(const char* snapshot_path,
+                                   const std::vector<std::string>& inputs)
+{
+  std::shared_ptr<Loaded> l = current();
+  std::vector<AnalysisVector> analyses;
+  std::vector<size_t> rows;
+  l->analyze_inputs(inputs, analyses, rows);
+  std::vector<AnalysisVector> input_analyses(inputs.size());
+  for (size_t n = 0; n < inputs.size(); ++n)
+    {
+      if (rows[n] != NO_ROW)
+        {
+          input_analyses[n] = analyses[rows[n]];
+        }
+    }
+  File file(l->path.c_str());
+  LookupSnapshot::Stamp stamp = LookupSnapshot::stamp(file.f);
+  if (memcmp(&stamp, &l->stamp, sizeof(stamp)) != 0)
+    {
+      throw std::runtime_error("Transducer file ‘" + l->path +
+                               "’ has changed since it was loaded");
+    }
+  LookupSnapshot::save(snapshot_path, file.f, stamp, inputs, input_analyses);
+}
+
+size_t TransducerFile::snapshot_entry_count(void)
+{
+  std::shared_ptr<Loaded> l = current();
+  return l->snapshot == NULL ? 0 : l->snapshot->entry_count();
+}
+
+size_t TransducerFile::epsilon_closures_size(void)
+{
+  std::shared_ptr<Loaded> l = current();
+  if (l->tables == NULL || l->tables->epsilon_closures() == NULL)
+    {
+      return 0;
+    }
+  return l->tables->epsilon_closures()->size();
+}
+
+MemoryUsage TransducerFile::memory_usage(void)
+{
+  std::shared_ptr<Loaded> l = current();
+  TransducerTables * tables = l->tables;
+  if (tables == NULL)
+    {
+      throw std::runtime_error("Weighted transducers not yet supported");
+    }
+  MemoryUsage usage;
+  usage.mapped = tables->is_mapped();
+  size_t sections = 0;
+  for (int n = 0; n < TransducerTables::SECTION_COUNT; ++n)
+    {
+      TransducerTables::Section section = (TransducerTables::Section)n;
+      usage.structures.push_back(std::make_pair(
+        std::string(TransducerTables::section_name(section)), tables->section_bytes(section)));
+      sections += tables->section_bytes(section);
+    }
+  size_t snapshot_entries = l->snapshot == NULL ? 0 : l->snapshot->entry_count();
+  // the image header and the alignment padding between sections
+  usage.structures.push_back(std::make_pair(std::string("header"), tables->size() - sections));
+  usage.structures.push_back(std::make_pair(
+    std::string("epsilon_closures"),
+    tables->epsilon_closures() == NULL ? 0 : tables->epsilon_closures()->size()));
+  usage.structures.push_back(std::make_pair(std::string("snapshot"),
+                                            l->snapshot == NULL ? 0 : l->snapshot->size()));
+  usage.structures.push_back(std::make_pair(
+    std::string("lookup_buffers"),
+    l->idle_transducer_count() * (sizeof(TransducerFd) +
+                                  Transducer::OUTPUT_STRING_LENGTH * sizeof(SymbolNumber))));
+
+  usage.total = 0;
+  for (size_t n = 0; n < usage.structures.size(); ++n)
+    {
+      usage.total += usage.structures[n].second;
+    }
+
+  usage.counts.push_back(std::make_pair(std::string("index_entries"), (size_t)tables->index_count()));
+  usage.counts.push_back(std::make_pair(std::string("transition_entries"), (size_t)tables->transition_count()));
+  usage.counts.push_back(std::make_pair(std::string("symbols"), (size_t)tables->symbol_count()));
+  usage.counts.push_back(std::make_pair(std::string("input_symbols"), (size_t)tables->input_symbol_count()));
+  usage.counts.push_back(std::make_pair(std::string("flag_features"), (size_t)tables->flag_feature_count()));
+  usage.counts.push_back(std::make_pair(std::string("trie_nodes"), (size_t)tables->trie_node_count()));
+  usage.counts.push_back(std::make_pair(std::string("snapshot_entries"), snapshot_entries));
+  return usage;
+}
+
+Transducer * TransducerFile::Loaded::acquire_transducer(void)
+{
+  if (tables == NULL)
+    {
+      throw std::runtime_error("Weighted transducers not yet supported");
+    }
+  {
+    std::lock_guard<std::mutex> lock(idle_transducers_mutex);
+    if (!idle_transducers.empty())
+      {
+        Transducer * t = idle_transducers.back();
+        idle_transducers.pop_back();
+        return t;
+      }
+  }
+  if (tables->flag_feature_count() == 0)
+    {
+      return new Transducer(tables, false);
+    }
+  return new TransducerFd(tables, false);
+}
+
+void TransducerFile::Loaded::release_transducer(Transducer * t)
+{
+  std::lock_guard<std::mutex> lock(idle_transducers_mutex);
+  idle_transducers.push_back(t);
+}
+
+size_t TransducerFile::Loaded::idle_transducer_count(void)
+{
+  std::lock_guard<std::mutex> lock(idle_transducers_mutex);
+  return idle_transducers.size();
+}
+
+static bool tokenize_input(TransducerTables * tables, const char * input_string,
+                           SymbolNumberVector & input)
+{
+  for (const char ** Str = &input_string; **Str != 0; )
+    {
+      SymbolNumber k = tables->find_key(Str);
+      if (k == NO_SYMBOL_NUMBER)
+        {
+          return false;
+        }
+      input.push_back(k);
+    }
+  return true;
+}
+
+bool TransducerFile::Loaded::tokenize(const char * input_string, SymbolNumberVector & input)
+{
+  return tokenize_input(tables, input_string, input);
+}
+
+std::vector<std::string> TransducerFile::Loaded::symbol_strings(const SymbolNumberVector & analysis)
+{
+  std::vector<std::string> output_analysis;
+  for (SymbolNumberVector::const_iterator it = analysis.begin(); it != analysis.end(); ++it)
+    {
+      output_analysis.push_back(tables->symbol_string(*it));
+    }
+  return output_analysis;
+}
+
+void TransducerFile::Loaded::analyze(const char * input_text, AnalysisVector & analyses)
+{
+  if (snapshot != NULL && snapshot->find(input_text, analyses))
+    {
+      return;
+    }
+
+  Lease t(*this);
+
+  SymbolNumberVector input_string;
+  if (!tokenize(input_text, input_string)) {
+      analyses.clear();
+      return;
+  }
+  input_string.push_back(NO_SYMBOL_NUMBER);
+
+  t->analyze(&input_string[0]);
+  analyses = t->get_analysis_vector();
+}
+
+std::vector<std::vector<std::string> > TransducerFile::lookup(const char* input_text) {
+  LookupRecorder::TimePoint began = recorder.start();
+  std::shared_ptr<Loaded> l = current();
+  std::vector<std::vector<std::string> > output;
+  AnalysisVector analyses;
+  count_hit(input_text);
+  l->analyze(input_text, analyses);
+  for (AnalysisVector::const_iterator it = analyses.begin(); it != analyses.end(); it++) {
+      output.push_back(l->symbol_strings(*it));
+  }
+  recorder.finish(LookupRecorder::LOOKUP, began, input_text, output.size());
+  return output;
+}
+
+std::vector<LemmaAnalysis> TransducerFile::lookup_lemma_with_affixes(const char* input_text)
+{
+  LookupRecorder::TimePoint began = recorder.start();
+  std::shared_ptr<Loaded> l = current();
+  TransducerTables * tables = l->tables;
+  std::vector<LemmaAnalysis> output;
+  AnalysisVector analyses;
+  count_hit(input_text);
+  l->analyze(input_text, analyses);
+  for (AnalysisVector::const_iterator it = analyses.begin(); it != analyses.end(); it++) {
+      LemmaAnalysis analysis;
+      analysis.contiguous = true;
+      // Multicharacter symbols are prefixes until the first lexical
+      // symbol is seen, and suffixes after that.
+      bool seen_lexical = false;
+      for (SymbolNumberVector::const_iterator s = it->begin(); s != it->end(); ++s) {
+          if (tables->symbol_kind(*s) == Lexical) {
+              if (!analysis.suffixes.empty()) {
+                  analysis.contiguous = false;
+              }
+              analysis.lemma.append(tables->symbol_string(*s));
+              seen_lexical = true;
+          } else if (seen_lexical) {
+              analysis.suffixes.push_back(tables->symbol_string(*s));
+          } else {
+              analysis.prefixes.push_back(tables->symbol_string(*s));
+          }
+      }
+      output.push_back(analysis);
+  }
+  recorder.finish(LookupRecorder::LOOKUP_LEMMA_WITH_AFFIXES, began, input_text, output.size());
+  return output;
+}
+
+VariantLookup TransducerFile::lookup_variants(const char* input_text,
+                                              const std::vector<InputRule>& rules)
+{
+  // The input itself, then every combination of the rules, each applied
+  // after the ones before it in the list: the variants needing the fewest
+  // and earliest rules come first. Rules that change nothing don't add
+  // variants, so usually there are only a few.
+  LookupRecorder::TimePoint began = recorder.start();
+  std::vector<VariantLookup> variants(1);
+  variants[0].variant = input_text;
+  for (std::vector<InputRule>::const_iterator rule = rules.begin(); rule != rules.end(); ++rule)
+    {
+      size_t count = variants.size();
+      for (size_t v = 0; v < count; ++v)
+        {
+          VariantLookup variant;
+          variant.variant = apply_input_rule(*rule, variants[v].variant);
+          bool seen = false;
+          for (size_t w = 0; w < variants.size() && !seen; ++w)
+            {
+              seen = variants[w].variant == variant.variant;
+            }
+          if (!seen)
+            {
+              variant.rules = variants[v].rules;
+              variant.rules.push_back(*rule);
+              variants.push_back(variant);
+            }
+        }
+    }
+
+  std::shared_ptr<Loaded> l = current();
+  Lease t(*l);
+  for (std::vector<VariantLookup>::iterator v = variants.begin(); v != variants.end(); ++v)
+    {
+      SymbolNumberVector input_string;
+      if (!l->tokenize(v->variant.c_str(), input_string))
+        {
+          continue;
+        }
+      input_string.push_back(NO_SYMBOL_NUMBER);
+      t->analyze(&input_string[0]);
+
+      const AnalysisVector & analyses = t->get_analysis_vector();
+      if (analyses.empty())
+        {
+          continue;
+        }
+      for (AnalysisVector::const_iterator it = analyses.begin(); it != analyses.end(); ++it)
+        {
+          v->analyses.push_back(l->symbol_strings(*it));
+        }
+      recorder.finish(LookupRecorder::LOOKUP_VARIANTS, began, input_text, v->analyses.size());
+      return *v;
+    }
+  recorder.finish(LookupRecorder::LOOKUP_VARIANTS, began, input_text, 0);
+  return variants[0];
+}
+
+SymbolNumber TransducerFile::Loaded::symbol_number(const std::string & symbol)
+{
+  for (SymbolNumber s = 0; s < tables->symbol_count(); ++s)
+    {
+      if (symbol == tables->symbol_string(s))
+        {
+          return s;
+        }
+    }
+  throw std::invalid_argument("Unknown symbol ‘" + symbol + "’");
+}
+
+Completions TransducerFile::complete(const char* prefix, const CompletionLimits& limits)
+{
+  LookupRecorder::TimePoint began = recorder.start();
+  std::shared_ptr<Loaded> l = current();
+  Lease t(*l);
+
+  CompletionSearch search;
+  search.max_depth = limits.max_depth;
+  search.max_results = limits.max_results;
+  search.max_seconds = limits.max_seconds;
+  search.excluded.assign(l->tables->symbol_count(), false);
+  for (size_t n = 0; n < limits.exclude.size(); ++n)
+    {
+      search.excluded[l->symbol_number(limits.exclude[n])] = true;
+    }
+  for (size_t n = 0; n < limits.require.size(); ++n)
+    {
+      search.required.push_back(l->symbol_number(limits.require[n]));
+    }
+
+  Completions output;
+  output.truncated = false;
+  SymbolNumberVector input_string;
+  if (!l->tokenize(prefix, input_string))
+    {
+      recorder.finish(LookupRecorder::COMPLETE, began, prefix, 0);
+      return output;
+    }
+  input_string.push_back(NO_SYMBOL_NUMBER);
+
+  std::vector<SymbolCompletion> found;
+  output.truncated = t->complete(&input_string[0], search, found);
+  for (std::vector<SymbolCompletion>::const_iterator it = found.begin(); it != found.end(); ++it)
+    {
+      Completion completion;
+      completion.input = l->symbol_strings(it->input);
+      completion.output = l->symbol_strings(it->output);
+      output.completions.push_back(completion);
+    }
+  recorder.finish(LookupRecorder::COMPLETE, began, prefix, output.completions.size());
+  return output;
+}
+
+const size_t TransducerFile::NO_ROW = (size_t)(-1);
+
+void TransducerFile::Loaded::analyze_inputs(const std::vector<std::string>& input_strings,
+                                            std::vector<AnalysisVector> & analyses,
+                                            std::vector<size_t> & rows)
+{
+  std::vector<NumberedInput> inputs;
+  // inputs in the snapshot, and their analyses
+  std::vector<size_t> cached;
+  std::vector<AnalysisVector> cached_analyses;
+  AnalysisVector found;
+  for (size_t n = 0; n < input_strings.size(); ++n)
+    {
+      if (snapshot != NULL && snapshot->find(input_strings[n].c_str(), found))
+        {
+          cached.push_back(n);
+          cached_analyses.push_back(found);
+          continue;
+        }
+      SymbolNumberVector input;
+      // Inputs that can't be tokenized are left out, so they end up
+      // without a row
+      if (tokenize(input_strings[n].c_str(), input))
+        {
+          inputs.push_back(NumberedInput(input, n));
+        }
+    }
+  analyze_tokenized(inputs, input_strings.size(), analyses, rows);
+  for (size_t c = 0; c < cached.size(); ++c)
+    {
+      rows[cached[c]] = analyses.size();
+      analyses.push_back(cached_analyses[c]);
+    }
+}
+
+void TransducerFile::Loaded::analyze_tokenized(std::vector<NumberedInput> & inputs,
+                                               size_t input_count,
+                                               std::vector<AnalysisVector> & analyses,
+                                               std::vector<size_t> & rows)
+{
+  Lease t(*this);
+
+  InputBatch batch(inputs);
+  t->analyze_batch(batch, analyses);
+
+  rows.assign(input_count, NO_ROW);
+  for (size_t r = 0; r < batch.row_count(); ++r)
+    {
+      const std::vector<size_t> & ids = batch.ids(r);
+      for (std::vector<size_t>::const_iterator it = ids.begin(); it != ids.end(); ++it)
+        {
+          rows[*it] = r;
+        }
+    }
+}
+
+std::vector<std::vector<std::vector<std::string> > > TransducerFile::bulk_lookup(
+    const std::vector<std::string>& input_strings)
+{
+  LookupRecorder::TimePoint began = recorder.start();
+  std::shared_ptr<Loaded> l = current();
+  for (size_t n = 0; n < input_strings.size(); ++n)
+    {
+      count_hit(input_strings[n].c_str());
+    }
+  std::vector<AnalysisVector> analyses;
+  std::vector<size_t> rows;
+  l->analyze_inputs(input_strings, analyses, rows);
+
+  std::vector<std::vector<std::vector<std::string> > > row_outputs(analyses.size());
+  for (size_t r = 0; r < analyses.size(); ++r)
+    {
+      for (AnalysisVector::const_iterator it = analyses[r].begin(); it != analyses[r].end(); ++it)
+        {
+          row_outputs[r].push_back(l->symbol_strings(*it));
+        }
+    }
+
+  std::vector<std::vector<std::vector<std::string> > > output(input_strings.size());
+  for (size_t n = 0; n < input_strings.size(); ++n)
+    {
+      if (rows[n] != NO_ROW)
+        {
+          output[n] = row_outputs[rows[n]];
+        }
+      recorder.count_analyses(output[n].size());
+    }
+  recorder.finish(LookupRecorder::BULK_LOOKUP, began);
+  return output;
+}
+
+void TransducerFile::bulk_lookup_columns(const std::vector<std::string>& input_strings,
+                                         AnalysisColumns & columns)
+{
+  LookupRecorder::TimePoint began = recorder.start();
+  std::shared_ptr<Loaded> l = current();
+  for (size_t n = 0; n < input_strings.size(); ++n)
+    {
+      count_hit(input_strings[n].c_str());
+    }
+  std::vector<AnalysisVector> analyses;
+  std::vector<size_t> rows;
+  l->analyze_inputs(input_strings, analyses, rows);
+
+  columns = AnalysisColumns();
+  columns.symbol_offsets.push_back(0);
+  columns.text_offsets.push_back(0);
+  for (size_t n = 0; n < input_strings.size(); ++n)
+    {
+      if (rows[n] == NO_ROW)
+        {
+          recorder.count_analyses(0);
+          continue;
+        }
+      const AnalysisVector & row = analyses[rows[n]];
+      recorder.count_analyses(row.size());
+      for (AnalysisVector::const_iterator it = row.begin(); it != row.end(); ++it)
+        {
+          columns.word_index.push_back(n);
+          for (SymbolNumberVector::const_iterator s = it->begin(); s != it->end(); ++s)
+            {
+              const char * symbol = l->tables->symbol_string(*s);
+              columns.symbols.push_back(*s);
+              columns.text.insert(columns.text.end(), symbol, symbol + strlen(symbol));
+            }
+          columns.symbol_offsets.push_back(columns.symbols.size());
+          columns.text_offsets.push_back(columns.text.size());
+        }
+    }
+  recorder.finish(LookupRecorder::BULK_LOOKUP, began);
+}
+
+std::vector<std::string> TransducerFile::symbol_table(void)
+{
+  std::shared_ptr<Loaded> l = current();
+  if (l->tables == NULL)
+    {
+      throw std::runtime_error("Weighted transducers not yet supported");
+    }
+  std::vector<std::string> symbols;
+  for (SymbolNumber s = 0; s < l->tables->symbol_count(); ++s)
+    {
+      symbols.push_back(l->tables->symbol_string(s));
+    }
+  return symbols;
+}
+
+TransducerCascade::TransducerCascade(const std::vector<TransducerFile*>& s,
+                                     Policy p):
+  stages(s),
+  policy(p)
+{
+  for (size_t i = 0; i < stages.size(); ++i)
+    {
+      if (stages[i]->current()->tables == NULL)
+        {
+          throw std::runtime_error("Weighted transducers not yet supported");
+        }
+    }
+}
+
+std::vector<CascadeAnalysis> TransducerCascade::lookup(const char* input_string)
+{
+  return bulk_lookup(std::vector<std::string>(1, input_string))[0];
+}
+
+std::vector<size_t> TransducerCascade::tokenizers_for(
+    const std::vector<std::shared_ptr<TransducerFile::Loaded> >& loaded)
+{
+  std::lock_guard<std::mutex> lock(tokenizers_mutex);
+  bool same = tokenizers_loaded.size() == loaded.size();
+  // Comparing owners rather than pointers, since a reloaded stage's
+  // tables may have been allocated where the ones it replaced were
+  for (size_t i = 0; same && i < loaded.size(); ++i)
+    {
+      same = !tokenizers_loaded[i].owner_before(loaded[i]) &&
+        !loaded[i].owner_before(tokenizers_loaded[i]);
+    }
+  if (!same)
+    {
+      tokenizers_loaded.assign(loaded.begin(), loaded.end());
+      tokenizer_stages.clear();
+      for (size_t i = 0; i < loaded.size(); ++i)
+        {
+          size_t j = 0;
+          while (!loaded[j]->tables->same_input_symbols(*loaded[i]->tables))
+            {
+              ++j;
+            }
+          tokenizer_stages.push_back(j);
+        }
+    }
+  return tokenizer_stages;
+}
+
+std::vector<std::vector<CascadeAnalysis> > TransducerCascade::bulk_lookup(
+    const std::vector<std::string>& input_strings)
+{
+  std::vector<std::vector<CascadeAnalysis> > output(input_strings.size());
+
+  // The stages as they are now, so that reloading one of them partway
+  // through doesn't mix two versions of it
+  std::vector<std::shared_ptr<TransducerFile::Loaded> > loaded;
+  for (size_t i = 0; i < stages.size(); ++i)
+    {
+      loaded.push_back(stages[i]->current());
+      if (loaded[i]->tables == NULL)
+        {
+          throw std::runtime_error("Weighted transducers not yet supported");
+        }
+    }
+  // The first stage that tokenizes inputs the way stage i does
+  std::vector<size_t> tokenizer_stage = tokenizers_for(loaded);
+
+  // The inputs later stages still have to look up
+  std::vector<size_t> pending;
+  for (size_t n = 0; n < input_strings.size(); ++n)
+    {
+      pending.push_back(n);
+    }
+
+  // Stages with the same input symbols tokenize the same way, so each
+  // input is only tokenized once per distinct tokenizer.
+  // tokenized[j][n] is input n as tokenized by stage j, if tokenizes[j][n]
+  // is TOKENIZED.
+  enum Tokenizing {NOT_YET, TOKENIZED, UNTOKENIZABLE};
+  std::vector<std::vector<SymbolNumberVector> > tokenized(stages.size());
+  std::vector<std::vector<Tokenizing> > tokenizes(stages.size());
+
+  for (size_t i = 0; i < stages.size() && !pending.empty(); ++i)
+    {
+      // Each stage looks its inputs up as its own bulk_lookup() would:
+      // counting hits, answering from its snapshot where it can, and
+      // recording metrics
+      TransducerFile & stage = *stages[i];
+      LookupRecorder::TimePoint began = stage.recorder.start();
+      size_t j = tokenizer_stage[i];
+      if (tokenized[j].empty())
+        {
+          tokenized[j].resize(input_strings.size());
+          tokenizes[j].resize(input_strings.size(), NOT_YET);
+        }
+
+      std::vector<NumberedInput> inputs;
+      std::vector<size_t> cached;
+      std::vector<AnalysisVector> cached_analyses;
+      AnalysisVector found;
+      for (std::vector<size_t>::const_iterator n = pending.begin(); n != pending.end(); ++n)
+        {
+          const char * input_string = input_strings[*n].c_str();
+          stage.count_hit(input_string);
+          if (loaded[i]->snapshot != NULL && loaded[i]->snapshot->find(input_string, found))
+            {
+              cached.push_back(*n);
+              cached_analyses.push_back(found);
+              continue;
+            }
+          if (tokenizes[j][*n] == NOT_YET)
+            {
+              tokenizes[j][*n] = loaded[j]->tokenize(input_string, tokenized[j][*n])
+                ? TOKENIZED : UNTOKENIZABLE;
+            }
+          if (tokenizes[j][*n] == TOKENIZED)
+            {
+              inputs.push_back(NumberedInput(tokenized[j][*n], *n));
+            }
+        }
+
+      std::vector<AnalysisVector> analyses;
+      std::vector<size_t> rows;
+      loaded[i]->analyze_tokenized(inputs, input_strings.size(), analyses, rows);
+      for (size_t k = 0; k < cached.size(); ++k)
+        {
+          rows[cached[k]] = analyses.size();
+          analyses.push_back(cached_analyses[k]);
+        }
+
+      std::vector<size_t> still_pending;
+      for (std::vector<size_t>::const_iterator n = pending.begin(); n != pending.end(); ++n)
+        {
+          stage.recorder.count_analyses(
+            rows[*n] == TransducerFile::NO_ROW ? 0 : analyses[rows[*n]].size());
+          if (rows[*n] == TransducerFile::NO_ROW || analyses[rows[*n]].empty())
+            {
+              still_pending.push_back(*n);
+              continue;
+            }
+          const AnalysisVector & row = analyses[rows[*n]];
+          for (AnalysisVector::const_iterator it = row.begin(); it != row.end(); ++it)
+            {
+              CascadeAnalysis analysis;
+              analysis.stage = i;
+              analysis.symbols = loaded[i]->symbol_strings(*it);
+              output[*n].push_back(analysis);
+            }
+          if (policy == UNION)
+            {
+              still_pending.push_back(*n);
+            }
+        }
+      pending.swap(still_pending);
+      stage.recorder.finish(LookupRecorder::BULK_LOOKUP, began);
+    }
+  return output;
+}
+
+#if BUILD_HFSTOL_MAIN
+int main(int argc, char **argv)
+{
+
+  int c;
+
+  while (true)
+    {
+      static struct option long_options[] =
+        {
+          // first the hfst-mandated options
+          {"help",         no_argument,       0, 'h'},
+          {"version",      no_argument,       0, 'V'},
+          {"verbose",      no_argument,       0, 'v'},
+          {"quiet",        no_argument,       0, 'q'},
+          {"silent",       no_argument,       0, 's'},
+          // the hfst-optimized-lookup-specific options
+          {"echo-inputs",  no_argument,       0, 'e'},
+          {"show-weights", no_argument,       0, 'w'},
+          {"beam",         required_argument, 0, 'b'},
+          {"time-cutoff",  required_argument, 0, 't'},
+          {"unique",       no_argument,       0, 'u'},
+          {"xerox",        no_argument,       0, 'x'},
+          {"fast",         no_argument,       0, 'f'},
+          {"pipe-mode",    optional_argument,       0, 'p'},
+          {"analyses",     required_argument, 0, 'n'},
+          {"server",       required_argument, 0, 'S'},
+          {"threads",      required_argument, 0, 'j'},
+          {"server-timeout", required_argument, 0, 'T'},
+          {"epsilon-closures", no_argument,   0, 'E'},
+          {"prefault",     no_argument,       0, 'P'},
+          {0,              0,                 0,  0 }
+        };
+
+      int option_index = 0;
+      c = getopt_long(argc, argv, "hVvqsewb:t:uxfn:p::S:j:EP", long_options, &option_index);
+
+      if (c == -1) // no more options to look at
+        break;
+
+      switch (c)
+        {
+        case 'h':
+          print_usage();
+          return EXIT_SUCCESS;
+          break;
+
+        case 'V':
+          print_version();
+          return EXIT_SUCCESS;
+          break;
+
+        case 'v':
+#ifdef OL_DEBUG
+          printDebuggingInformationFlag = true;
+          preserveDiacriticRepresentationsFlag = true;
+#endif
+
+#ifdef TIMING
+          timingFlag = true;
+#endif
+          verboseFlag = true;
+          break;
+
+        case 'q':
+        case 's':
+#ifdef OL_DEBUG
+          printDebuggingInformationFlag = false;
+          preserveDiacriticRepresentationsFlag = false;
+#endif
+
+#ifdef TIMING
+          timingFlag = false;
+#endif
+          verboseFlag = false;
+          displayWeightsFlag = true;
+          break;
+
+        case 'e':
+          echoInputsFlag = true;
+          break;
+
+        case 'w':
+          displayWeightsFlag = true;
+          break;
+
+        case 'u':
+          displayUniqueFlag = true;
+          break;
+
+        case 'b':
+          beam = atof(optarg);
+          if (beam < 0)
+            {
+              std::cerr << "Invalid argument for --beam\n";
+              return EXIT_FAILURE;
+            }
+          break;
+        case 't':
+            time_cutoff = atof(optarg);
+            if (time_cutoff < 0.0)
+            {
+                std::cerr << "Invalid argument for --time-cutoff\n";
+                return EXIT_FAILURE;
+            }
+            break;
+        case 'n':
+          maxAnalyses = atoi(optarg);
+          if (maxAnalyses < 1)
+            {
+              std::cerr << "Invalid or no argument for analyses count\n";
+              return EXIT_FAILURE;
+            }
+          break;
+
+        case 'x':
+          outputType = xerox;
+          break;
+
+        case 'S':
+          server_socket_path = optarg;
+          break;
+
+        case 'j':
+          server_threads = atoi(optarg);
+          if (server_threads < 1)
+            {
+              std::cerr << "Invalid argument for --threads\n";
+              return EXIT_FAILURE;
+            }
+          break;
+
+        case 'T':
+          server_timeout = atoi(optarg);
+          if (server_timeout < 1)
+            {
+              std::cerr << "Invalid argument for --server-timeout\n";
+              return EXIT_FAILURE;
+            }
+          break;
+
+        case 'f':
+          beFast = true;
+          break;
+
+        case 'E':
+          epsilonClosuresFlag = true;
+          break;
+
+        case 'P':
+          prefaultFlag = true;
+          break;
+
+        case 'p':
+          if (optarg == NULL)
+            { pipe_input = true; pipe_output = true; }
+          else if (strcmp(optarg, "both") == 0 || strcmp(optarg, "BOTH") == 0)
+            { pipe_input = true; pipe_output = true; }
+          else if (strcmp(optarg, "input") == 0 || strcmp(optarg, "INPUT") == 0 ||
+                   strcmp(optarg, "in") == 0 || strcmp(optarg, "IN") == 0)
+            { pipe_input = true; }
+          else if (strcmp(optarg, "output") == 0 || strcmp(optarg, "OUTPUT") == 0 ||
+                   strcmp(optarg, "out") == 0 || strcmp(optarg, "OUT") == 0)
+            { pipe_output = true; }
+          else
+            { std::cerr << "--pipe-mode argument " << std::string(optarg) << " unrecognised\n\n";
+              return EXIT_FAILURE; }
+          break;
+
+        default:
+          std::cerr << "Invalid option\n\n";
+          print_short_help();
+          return EXIT_FAILURE;
+          break;
+        }
+    }
+
+#ifdef _MSC_VER
+  //hfst::print_output_to_console(!pipe_output); // has no effect on windows or mac
+#endif
+
+  // no more options, we should now be at the input filename
+  if ( (optind + 1) < argc)
+    {
+      std::cerr << "More than one input file given\n";
+      return EXIT_FAILURE;
+    }
+  else if ( (optind + 1) == argc)
+    {
+      FILE * f = fopen(argv[(optind)], "rb");
+      if (f == NULL)
+        {
+          std::cerr << "Could not open file " << argv[(optind)] << std::endl;
+          return 1;
+        }
+      if (server_socket_path != NULL)
+        {
+          return serve(f);
+        }
+      return setup(f);
+    }
+  else
+    {
+      std::cerr << "No input file given\n";
+      return EXIT_FAILURE;
+    }
+}
+#endif
+
+void TransducerHeader::skip_hfst3_header(FILE * f)
+{
+    const char* header1 = "HFST";
+    unsigned int header_loc = 0; // how much of the header has been found
+    int c;
+    for(header_loc = 0; header_loc < strlen(header1) + 1; header_loc++)
+    {
+        c = getc(f);
         if(c != header1[header_loc]) {
             break;
         }
     }
-    if(header_loc == strlen(header1) + 1) // we found it
+    if(header_loc == strlen(header1) + 1) // we found it
+    {
+        unsigned short remaining_header_len;
+        if (fread(&remaining_header_len,
+                  sizeof(remaining_header_len), 1, f) != 1 ||
+            getc(f) != '\0') {
+            throw HeaderParsingException();
+        }
+        char * headervalue = new char[remaining_header_len];
+        if (fread(headervalue, remaining_header_len, 1, f) != 1)
+        {
+            throw HeaderParsingException();
+        }
+        if (headervalue[remaining_header_len - 1] != '\0') {
+            throw HeaderParsingException();
+        }
+        std::string header_tail(headervalue, remaining_header_len);
+        size_t type_field = header_tail.find("type");
+        if (type_field != std::string::npos) {
+            if (header_tail.find("HFST_OL") != type_field + 5 &&
+                header_tail.find("HFST_OLW") != type_field + 5) {
+                delete[] headervalue;
+                throw HeaderParsingException();
+            }
+        }
+    } else // nope. put back what we've taken
+    {
+        ungetc(c, f); // first the non-matching character
+            for(int i = header_loc - 1; i>=0; i--) {
+// then the characters that did match (if any)
+                ungetc(header1[i], f);
+            }
+    }
+}
+
+void TransducerAlphabet::get_next_symbol(FILE * f, SymbolNumber k)
+{
+  int byte;
+  char * sym = line;
+  while ( (byte = fgetc(f)) != 0 )
+    {
+      if (byte == EOF || sym - line >= LINE_SIZE)
+        {
+          throw HeaderParsingException();
+        }
+      *sym = byte;
+      ++sym;
+    }
+  *sym = 0;
+  if (strlen(line) >= 5 && line[0] == '@' && line[strlen(line) - 1] == '@' && line[2] == '.')
+    { // a special symbol needs to be parsed
+      std::string feat;
+      std::string val;
+      FlagDiacriticOperator op = P; // g++ worries about this falling through uninitialized
+      switch (line[1]) {
+      case 'P': op = P; break;
+      case 'N': op = N; break;
+      case 'R': op = R; break;
+      case 'D': op = D; break;
+      case 'C': op = C; break;
+      case 'U': op = U; break;
+      }
+      char * c = line;
+      // as long as we're working with utf-8, this should be ok
+      for (c +=3; *c != '.' && *c != '@'; c++) { feat.append(c,1); }
+      if (*c == '.')
+        {
+          for (++c; *c != '@'; c++) { val.append(c,1); }
+        }
+      if (feature_bucket.count(feat) == 0)
+        {
+          feature_bucket[feat] = feat_num;
+          ++feat_num;
+        }
+      if (value_bucket.count(val) == 0)
+        {
+          value_bucket[val] = val_num;
+          ++val_num;
+        }
+      operations.push_back(FlagDiacriticOperation(op, feature_bucket[feat], value_bucket[val]));
+      kt->operator[](k) = strdup("");
+
+#if OL_FULL_DEBUG
+      std::cout << "symbol number " << k << " (flag) is \"" << line << "\"" << std::endl;
+      kt->operator[](k) = strdup(line);
+#endif
+
+      return;
+    }
+  operations.push_back(FlagDiacriticOperation()); // dummy flag
+
+#if OL_FULL_DEBUG
+  std::cout << "symbol number " << k << " is \"" << line << "\"" << std::endl;
+#endif
+
+  kt->operator[](k) = strdup(line);
+}
+
+void LetterTrie::add_string(const char * p, SymbolNumber symbol_key)
+{
+  if (*(p+1) == 0)
+    {
+      symbols[(unsigned char)(*p)] = symbol_key;
+      return;
+    }
+  if (letters[(unsigned char)(*p)] == NULL)
+    {
+      letters[(unsigned char)(*p)] = new LetterTrie();
+    }
+  letters[(unsigned char)(*p)]->add_string(p+1,symbol_key);
+}
+
+bool LetterTrie::has_key_starting_with(const char c) const
+{
+    return letters[(unsigned char) c] != NULL;
+}
+
+SymbolNumber LetterTrie::find_key(const char ** p)
+{
+  const char * old_p = *p;
+  ++(*p);
+  if (letters[(unsigned char)(*old_p)] == NULL)
+    {
+      return symbols[(unsigned char)(*old_p)];
+    }
+  SymbolNumber s = letters[(unsigned char)(*old_p)]->find_key(p);
+  if (s == NO_SYMBOL_NUMBER)
+    {
+      --(*p);
+      return symbols[(unsigned char)(*old_p)];
+    }
+  return s;
+}
+
+void Encoder::read_input_symbols(KeyTable * kt)
+{
+  for (SymbolNumber k = 0; k < number_of_input_symbols; ++k)
+    {
+#if DEBUG
+      assert(kt->find(k) != kt->end());
+#endif
+      const char * p = kt->operator[](k);
+      if ((strlen(p) == 1) && (unsigned char)(*p) <= 127
+          // we have a single char ascii symbol
+          && !letters.has_key_starting_with(*p)) {
+          // make sure there isn't a longer symbol we would be shadowing
+          ascii_symbols[(unsigned char)(*p)] = k;
+      }
+      // If there's an ascii tokenized symbol shadowing this, remove it
+      if (strlen(p) > 1 &&
+          (unsigned char)(*p) <= 127 &&
+          ascii_symbols[(unsigned char)(*p)] != NO_SYMBOL_NUMBER) {
+          ascii_symbols[(unsigned char)(*p)] = NO_SYMBOL_NUMBER;
+      }
+      letters.add_string(p,k);
+    }
+}
+
+SymbolNumber Encoder::find_key(const char ** p)
+{
+  if (ascii_symbols[(unsigned char)(**p)] == NO_SYMBOL_NUMBER)
+    {
+      return letters.find_key(p);
+    }
+  SymbolNumber s = ascii_symbols[(unsigned char)(**p)];
+  ++(*p);
+  return s;
+}
+
+#if BUILD_HFSTOL_MAIN
+void runTransducer (TransducerBase * T)
+{
+  SymbolNumber * input_string = (SymbolNumber*)(malloc(2000));
+  for (int i = 0; i < 1000; ++i)
+    {
+      input_string[i] = NO_SYMBOL_NUMBER;
+    }
+
+  char * str = (char*)(malloc(MAX_IO_STRING*sizeof(char)));
+  *str = 0;
+  char * old_str = str;
+
+  while(true)
+    {
+#ifdef WINDOWS
+      if (!pipe_input)
+        {
+          free(str);
+          std::string linestr("");
+          if (! hfst::get_line_from_console(linestr, MAX_IO_STRING*sizeof(char)))
+            break;
+          str = strdup(linestr.c_str());
+          old_str = str;
+        }
+      else
+#endif
+        {
+          if (! std::cin.getline(str,MAX_IO_STRING))
+            break;
+        }
+
+      if (echoInputsFlag)
+        {
+#ifdef WINDOWS
+          if (!pipe_output)
+            hfst_fprintf_console(stdout, "%s\n", str); // fix: add \r?
+          else
+#endif
+            std::cout << str << std::endl;
+        }
+      int i = 0;
+      SymbolNumber k = NO_SYMBOL_NUMBER;
+      bool failed = false;
+      for ( const char ** Str = (const char **)&str; **Str != 0; )
+        {
+          k = T->find_next_key(Str);
+#if OL_FULL_DEBUG
+          std::cout << "INPUT STRING ENTRY " << i << " IS " << k << std::endl;
+#endif
+          if (k == NO_SYMBOL_NUMBER)
+            {
+              if (echoInputsFlag)
+                {
+                  std::cout << std::endl;
+                }
+              failed = true;
+              break;
+            }
+          input_string[i] = k;
+          ++i;
+        }
+      str = old_str;
+      if (failed)
+        { // tokenization failed
+          if (outputType == xerox)
+            {
+#ifdef WINDOWS
+          if (!pipe_output)
+              hfst_fprintf_console(stdout, "%s\t%s\t+?\n\n", str, str);
+          else
+#endif
+              std::cout << str << "\t" << str << "\t+?" << std::endl << std::endl;
+
+#ifdef WINDOWS
+          if (!pipe_output)
+            hfst_fprintf_console(stdout, "\n\n");
+          else
+#endif
+              std::cout << std::endl << std::endl;
+            }
+          continue;
+        }
+
+      input_string[i] = NO_SYMBOL_NUMBER;
+
+      if (time_cutoff > 0.0) {
+          start_clock = clock();
+          call_counter = 0;
+          limit_reached = false;
+      }
+
+      T->analyze(input_string);
+      T->printAnalyses(std::string(str));
+    }
+}
+#endif
+
+TransducerBase * instantiateTransducer(FILE * f, TransducerHeader& header, TransducerAlphabet& alphabet)
+{
+  if (header.probe_flag(Weighted) == false)
+    {
+      return instantiateTransducer(
+        TransducerTables::from_hfstol(f, header, alphabet), true);
+    }
+
+  warn_about_epsilon_cycles(header.probe_flag(Has_unweighted_input_epsilon_cycles) ||
+                            header.probe_flag(Has_input_epsilon_cycles));
+
+  if (alphabet.get_state_size() == 0)
+    {      // if the state size is zero, there are no flag diacritics to handle
+      if (displayUniqueFlag)
+        { // no flags, weights, unique analyses only
+          return new TransducerWUniq(f, header, alphabet);
+        } else
+        { // no flags, weights, all analyses
+          return new TransducerW(f, header, alphabet);
+        }
+    } else // handle flag diacritics
+    {
+      if (displayUniqueFlag)
+        { // flags, weights, unique analyses only
+          return new TransducerWFdUniq(f, header, alphabet);
+        } else
+        { // flags, weights, all analyses
+          return new TransducerWFd(f, header, alphabet);
+        }
+    }
+}
+
+static void compute_epsilon_closures(TransducerTables * tables)
+{
+  if (epsilonClosuresFlag)
+    {
+      tables->compute_epsilon_closures();
+      if (verboseFlag)
+        {
+          std::cerr << "Epsilon closures take up "
+                    << tables->epsilon_closures()->size() << " bytes\n";
+        }
+    }
+}
+
+TransducerBase * instantiateTransducer(TransducerTables * tables, bool owns_tables)
+{
+  warn_about_epsilon_cycles(tables->probe_flag(Has_unweighted_input_epsilon_cycles) ||
+                            tables->probe_flag(Has_input_epsilon_cycles));
+  compute_epsilon_closures(tables);
+
+  if (tables->flag_feature_count() == 0)
+    {      // if the state size is zero, there are no flag diacritics to handle
+      if (displayUniqueFlag)
+        { // no flags, no weights, unique analyses only
+          return new TransducerUniq(tables, owns_tables);
+        } else
+        { // no flags, no weights, all analyses
+          return new Transducer(tables, owns_tables);
+        }
+    } else // handle flag diacritics
+    {
+      if (displayUniqueFlag)
+        { // flags, no weights, unique analyses only
+          // return new TransducerFdUniq(tables, owns_tables);
+        } else
+        { // flags, no weights, all analyses
+          return new TransducerFd(tables, owns_tables);
+        }
+    }
+    throw std::runtime_error("should not happen");
+}
+
+// The tables laid out for profile_words, as TransducerTables::reordered()
+// does. Deletes tables.
+static TransducerTables * reorder_for(TransducerTables * tables,
+                                      const std::vector<std::string> & profile_words)
+{
+  std::vector<unsigned int> visits(tables->index_count() + tables->transition_count(), 0);
+  Transducer * t;
+  if (tables->flag_feature_count() == 0)
+    {
+      t = new Transducer(tables, true);
+    }
+  else
+    {
+      t = new TransducerFd(tables, true);
+    }
+  TransducerTables * reordered;
+  try
+    {
+      t->count_state_visits(&visits);
+      for (size_t n = 0; n < profile_words.size(); ++n)
+        {
+          SymbolNumberVector input;
+          if (tokenize_input(tables, profile_words[n].c_str(), input))
+            {
+              input.push_back(NO_SYMBOL_NUMBER);
+              t->analyze(&input[0]);
+            }
+        }
+      reordered = tables->reordered(visits);
+    }
+  catch (...)
+    {
+      delete t;
+      throw;
+    }
+  delete t;
+  return reordered;
+}
+
+void compile_transducer(const char * source, const char * destination,
+                        const std::vector<std::string> & profile_words)
+{
+  TransducerTables * tables;
+  {
+    File file(source);
+    if (TransducerTables::is_compiled(file.f))
+      {
+        tables = TransducerTables::load(file.f);
+      }
+    else
+      {
+        TransducerHeader header(file.f);
+        TransducerAlphabet alphabet(file.f, header.symbol_count());
+        tables = TransducerTables::from_hfstol(file.f, header, alphabet);
+      }
+  }
+  if (!profile_words.empty())
+    {
+      tables = reorder_for(tables, profile_words);
+    }
+  try
+    {
+      tables->save(destination);
+    }
+  catch (...)
+    {
+      delete tables;
+      throw;
+    }
+  delete tables;
+}
+
+#if BUILD_HFSTOL_MAIN
+int setup(FILE * f)
+{
+  try
+    {
+      TransducerBase * T;
+      if (TransducerTables::is_compiled(f))
+        {
+          TransducerTables * tables = TransducerTables::load(f);
+          if (prefaultFlag)
+            {
+              tables->prefault();
+            }
+          T = instantiateTransducer(tables, true);
+        }
+      else
+        {
+          TransducerHeader header(f);
+          TransducerAlphabet alphabet(f, header.symbol_count());
+
+          T = instantiateTransducer(f,header, alphabet);
+        }
+      runTransducer(T);
+      delete T;
+    }
+  catch (const HeaderParsingException & e)
+    {
+      std::cerr << "Invalid transducer header.\n";
+      std::cerr << "The transducer must be in optimized lookup format.\n";
+      return EXIT_FAILURE;
+    }
+
+  return 0;
+}
+#endif
+
+#if BUILD_HFSTOL_MAIN
+/*
+ * Server mode
+ *
+ * The transducer is loaded once and shared by a pool of worker threads,
+ * each of which looks up words with a Transducer of its own. Clients
+ * connect to a unix domain socket and write one input per line. The
+ * server answers every input in order, in xerox format: a line of input
+ * TAB analysis for each analysis, or input TAB input TAB +? if there are
+ * none, followed by an empty line.
+ *
+ * All the complete lines a client has sent by the time the server reads
+ * from the socket are looked up together, as one InputBatch. A client
+ * that writes many inputs before reading the answers gets them looked up
+ * in batches.
+ */
+
+class ConnectionQueue
+{
+private:
+    std::deque<int> connections;
+    pthread_mutex_t mutex;
+    pthread_cond_t available;
+
+public:
+    ConnectionQueue(void)
+        {
+            pthread_mutex_init(&mutex, NULL);
+            pthread_cond_init(&available, NULL);
+        }
+
+    void push(int connection)
+        {
+            pthread_mutex_lock(&mutex);
+            connections.push_back(connection);
+            pthread_cond_signal(&available);
+            pthread_mutex_unlock(&mutex);
+        }
+
+    int pop(void)
+        {
+            pthread_mutex_lock(&mutex);
+            while (connections.empty())
+            {
+                pthread_cond_wait(&available, &mutex);
+            }
+            int connection = connections.front();
+            connections.pop_front();
+            pthread_mutex_unlock(&mutex);
+            return connection;
+        }
+};
+
+struct ServerWorker
+{
+    TransducerTables * tables;
+    ConnectionQueue * queue;
+};
+
+static bool write_all(int fd, const std::string & data)
+{
+  const char * p = data.data();
+  size_t left = data.size();
+  while (left > 0)
+    {
+      ssize_t written = write(fd, p, left);
+      if (written < 0)
+        {
+          if (errno == EINTR)
+            {
+              continue;
+            }
+          return false;
+        }
+      p += written;
+      left -= written;
+    }
+  return true;
+}
+
+// Append the answers for lines to out
+static void answer_lines(Transducer * T, TransducerTables * tables,
+                         const std::vector<std::string> & lines,
+                         std::string & out)
+{
+  std::vector<NumberedInput> inputs;
+  for (size_t n = 0; n < lines.size(); ++n)
+    {
+      if (lines[n].size() >= MAX_IO_STRING)
+        {
+          continue;
+        }
+      // inputs that don't tokenize have no analyses
+      SymbolNumberVector input;
+      if (tokenize_input(tables, lines[n].c_str(), input))
+        {
+          inputs.push_back(NumberedInput(input, n));
+        }
+    }
+
+  InputBatch batch(inputs);
+  std::vector<AnalysisVector> analyses;
+  T->analyze_batch(batch, analyses);
+
+  std::vector<const AnalysisVector *> results(lines.size(), (AnalysisVector *) NULL);
+  for (size_t r = 0; r < batch.row_count(); ++r)
+    {
+      const std::vector<size_t> & ids = batch.ids(r);
+      for (std::vector<size_t>::const_iterator it = ids.begin(); it != ids.end(); ++it)
+        {
+          results[*it] = &analyses[r];
+        }
+    }
+
+  for (size_t n = 0; n < lines.size(); ++n)
+    {
+      int count = 0;
+      if (results[n] != NULL)
+        {
+          DisplaySet seen;
+          for (AnalysisVector::const_iterator it = results[n]->begin();
+               it != results[n]->end() && count < maxAnalyses; ++it)
+            {
+              std::string analysis;
+              for (SymbolNumberVector::const_iterator s = it->begin(); s != it->end(); ++s)
+                {
+                  analysis.append(T->symbol_string(*s));
+                }
+              if (displayUniqueFlag && !seen.insert(analysis).second)
+                {
+                  continue;
+                }
+              out.append(lines[n]).append("\t").append(analysis).append("\n");
+              ++count;
+            }
+        }
+      if (count == 0)
+        {
+          out.append(lines[n]).append("\t").append(lines[n]).append("\t+?\n");
+        }
+      out.append("\n");
+    }
+}
+
+// Answers lines until the client closes the connection. Gives up on
+// clients that send nothing for server_timeout seconds, that don't read
+// their answers for as long, or that send a line of MAX_IO_STRING bytes or
+// more without a newline, so that they can't keep a worker, or ever more
+// memory, to themselves.
+static void serve_connection(Transducer * T, TransducerTables * tables, int fd)
+{
+  struct timeval timeout;
+  timeout.tv_sec = server_timeout;
+  timeout.tv_usec = 0;
+  setsockopt(fd, SOL_SOCKET, SO_RCVTIMEO, &timeout, sizeof(timeout));
+  setsockopt(fd, SOL_SOCKET, SO_SNDTIMEO, &timeout, sizeof(timeout));
+
+  std::string pending;
+  std::vector<char> buffer(65536);
+  while (true)
+    {
+      ssize_t got = read(fd, &buffer[0], buffer.size());
+      if (got < 0)
+        {
+          if (errno == EINTR)
+            {
+              continue;
+            }
+          return; // timed out, or the connection failed
+        }
+      bool finished = got == 0;
+      if (!finished)
+        {
+          pending.append(&buffer[0], got);
+        }
+      else if (!pending.empty())
+        { // an unterminated last line
+          pending.push_back('\n');
+        }
+
+      size_t end = pending.rfind('\n');
+      if (end != std::string::npos)
+        {
+          std::vector<std::string> lines;
+          size_t start = 0;
+          while (start <= end)
+            {
+              size_t newline = pending.find('\n', start);
+              size_t length = newline - start;
+              if (length > 0 && pending[newline - 1] == '\r')
+                {
+                  --length;
+                }
+              lines.push_back(pending.substr(start, length));
+              start = newline + 1;
+            }
+          pending.erase(0, end + 1);
+
+          std::string out;
+          answer_lines(T, tables, lines, out);
+          if (!write_all(fd, out))
+            {
+              return;
+            }
+        }
+      if (finished || pending.size() >= MAX_IO_STRING)
+        {
+          return;
+        }
+    }
+}
+
+static void * serve_connections(void * arg)
+{
+  ServerWorker * worker = (ServerWorker *) arg;
+  Transducer * T;
+  if (worker->tables->flag_feature_count() == 0)
+    {
+      T = new Transducer(worker->tables, false);
+    }
+  else
+    {
+      T = new TransducerFd(worker->tables, false);
+    }
+  while (true)
+    {
+      int connection = worker->queue->pop();
+      serve_connection(T, worker->tables, connection);
+      close(connection);
+    }
+  return NULL;
+}
+
+static void stop_server(int)
+{
+  unlink(server_socket_path);
+  _exit(EXIT_SUCCESS);
+}
+
+int serve(FILE * f)
+{
+  if (time_cutoff > 0.0)
+    {
+      std::cerr << "--time-cutoff can't be used with --server\n";
+      return EXIT_FAILURE;
+    }
+
+  TransducerTables * tables;
+  try
+    {
+      if (TransducerTables::is_compiled(f))
+        {
+          tables = TransducerTables::load(f);
+          if (prefaultFlag)
+            {
+              tables->prefault();
+            }
+        }
+      else
+        {
+          TransducerHeader header(f);
+          if (header.probe_flag(Weighted))
+            {
+              std::cerr << "--server only supports unweighted transducers\n";
+              return EXIT_FAILURE;
+            }
+          TransducerAlphabet alphabet(f, header.symbol_count());
+          tables = TransducerTables::from_hfstol(f, header, alphabet);
+        }
+    }
+  catch (const HeaderParsingException & e)
+    {
+      std::cerr << "Invalid transducer header.\n";
+      std::cerr << "The transducer must be in optimized lookup format.\n";
+      return EXIT_FAILURE;
+    }
+  fclose(f);
+  compute_epsilon_closures(tables);
+
+  struct sockaddr_un address;
+  memset(&address, 0, sizeof(address));
+  address.sun_family = AF_UNIX;
+  if (strlen(server_socket_path) >= sizeof(address.sun_path))
+    {
+      std::cerr << "Socket path too long: " << server_socket_path << "\n";
+      return EXIT_FAILURE;
+    }
+  strcpy(address.sun_path, server_socket_path);
+
+  int listener = socket(AF_UNIX, SOCK_STREAM, 0);
+  if (listener < 0)
+    {
+      std::cerr << "Could not create socket: " << strerror(errno) << "\n";
+      return EXIT_FAILURE;
+    }
+  // A socket left behind by a server that is no longer running can be
+  // replaced, but not one that another server is still listening on
+  struct stat status;
+  if (lstat(server_socket_path, &status) == 0 && S_ISSOCK(status.st_mode))
+    {
+      int probe = socket(AF_UNIX, SOCK_STREAM, 0);
+      bool in_use = connect(probe, (struct sockaddr *) &address, sizeof(address)) == 0;
+      close(probe);
+      if (in_use)
+        {
+          std::cerr << "Another server is listening on " << server_socket_path << "\n";
+          return EXIT_FAILURE;
+        }
+      unlink(server_socket_path);
+    }
+  if (bind(listener, (struct sockaddr *) &address, sizeof(address)) != 0 ||
+      listen(listener, SOMAXCONN) != 0)
+    {
+      std::cerr << "Could not listen on " << server_socket_path << ": "
+                << strerror(errno) << "\n";
+      return EXIT_FAILURE;
+    }
+
+  signal(SIGPIPE, SIG_IGN);
+  signal(SIGINT, stop_server);
+  signal(SIGTERM, stop_server);
+
+  int threads = server_threads;
+  if (threads <= 0)
+    {
+      threads = std::max(1L, sysconf(_SC_NPROCESSORS_ONLN));
+    }
+  ConnectionQueue queue;
+  ServerWorker worker = {tables, &queue};
+  for (int n = 0; n < threads; ++n)
+    {
+      pthread_t thread;
+      if (pthread_create(&thread, NULL, serve_connections, &worker) != 0)
+        {
+          std::cerr << "Could not start server threads\n";
+          stop_server(0);
+        }
+      pthread_detach(thread);
+    }
+  if (verboseFlag)
+    {
+      std::cerr << "Serving " << server_socket_path << " with "
+                << threads << " worker thread(s)\n";
+    }
+
+  while (true)
+    {
+      int connection = accept(listener, NULL, NULL);
+      if (connection < 0)
+        {
+          if (errno == EINTR || errno == ECONNABORTED)
+            {
+              continue;
+            }
+          std::cerr << "Could not accept connection: " << strerror(errno) << "\n";
+          unlink(server_socket_path);
+          return EXIT_FAILURE;
+        }
+      queue.push(connection);
+    }
+}
+#endif
+
+/**
+ * BEGIN old transducer.cc
+ */
+
+InputBatch::InputBatch(std::vector<NumberedInput> & inputs)
+{
+  std::sort(inputs.begin(), inputs.end());
+
+  // path[d] is the row that inputs sharing the current prefix of length d
+  // are following
+  std::vector<size_t> path;
+  // (position the branch leaves from, (symbol, position it continues at))
+  std::vector<std::pair<size_t, std::pair<SymbolNumber, size_t> > > found;
+
+  for (size_t k = 0; k < inputs.size(); ++k)
+    {
+      const SymbolNumberVector & input = inputs[k].first;
+      if (k > 0 && input == inputs[k-1].first)
+        { // a duplicate; it gets looked up as part of the previous row
+          row_ids.back().push_back(inputs[k].second);
+          continue;
+        }
+
+      size_t start = symbols.size();
+      size_t shared = 0;
+      if (k > 0)
+        {
+          // Since the inputs are sorted and distinct, this input can't be
+          // a prefix of the previous one, so input[shared] exists.
+          const SymbolNumberVector & previous = inputs[k-1].first;
+          while (shared < previous.size() && previous[shared] == input[shared])
+            {
+              ++shared;
+            }
+          found.push_back(std::make_pair(row_starts[path[shared]] + shared,
+                                         std::make_pair(input[shared],
+                                                        start + shared + 1)));
+        }
+
+      row_starts.push_back(start);
+      row_ids.push_back(std::vector<size_t>(1, inputs[k].second));
+      symbols.insert(symbols.end(), input.begin(), input.end());
+      symbols.push_back(NO_SYMBOL_NUMBER);
+
+      path.resize(input.size() + 1);
+      for (size_t d = (k > 0 ? shared + 1 : 0); d <= input.size(); ++d)
+        {
+          path[d] = row_starts.size() - 1;
+        }
+    }
+
+  branch_offsets.assign(symbols.size() + 1, 0);
+  for (size_t b = 0; b < found.size(); ++b)
+    {
+      ++branch_offsets[found[b].first + 1];
+    }
+  for (size_t p = 0; p < symbols.size(); ++p)
+    {
+      branch_offsets[p + 1] += branch_offsets[p];
+    }
+  branches.resize(found.size());
+  std::vector<size_t> next(branch_offsets.begin(), branch_offsets.end() - 1);
+  for (size_t b = 0; b < found.size(); ++b)
+    {
+      branches[next[found[b].first]++] = found[b].second;
+    }
+}
+
+size_t InputBatch::row_at(const SymbolNumber * p)
+{
+  size_t position = p - &symbols[0];
+  return std::upper_bound(row_starts.begin(), row_starts.end(), position)
+    - row_starts.begin() - 1;
+}
+
+// Map all of f into memory where possible, or read it into memory from
+// malloc() if not, setting mapped to which. Returns NULL if f holds fewer
+// than min_size bytes or can't be read.
+static char * map_file(FILE * f, size_t min_size, size_t & size, bool & mapped)
+{
+#ifndef _MSC_VER
+  struct stat status;
+  if (fstat(fileno(f), &status) == 0 && status.st_size > 0)
+    {
+      if ((size_t)status.st_size < min_size)
+        {
+          return NULL;
+        }
+      void * image = mmap(NULL, status.st_size, PROT_READ, MAP_PRIVATE,
+                          fileno(f), 0);
+      if (image != MAP_FAILED)
+        {
+          size = status.st_size;
+          mapped = true;
+          return (char*)image;
+        }
+    }
+#endif
+  // No mmap(), so read the file in instead
+  fseek(f, 0, SEEK_END);
+  long length = ftell(f);
+  fseek(f, 0, SEEK_SET);
+  if (length < (long)min_size)
+    {
+      return NULL;
+    }
+  char * image = (char*)(malloc(length));
+  if (image == NULL)
+    {
+      throw std::bad_alloc();
+    }
+  if (fread(image, length, 1, f) != 1)
+    {
+      free(image);
+      return NULL;
+    }
+  size = length;
+  mapped = false;
+  return image;
+}
+
+static void unmap_file(char * image, size_t size, bool mapped)
+{
+#ifndef _MSC_VER
+  if (mapped)
+    {
+      munmap(image, size);
+      return;
+    }
+#else
+  (void)size;
+  (void)mapped;
+#endif
+  free(image);
+}
+
+const char TransducerTables::MAGIC[8] = {'H', 'F', 'S', 'T', 'O', 'L', 'C', '\0'};
+
+static size_t section_size(const TransducerTables::Header & header,
+                           TransducerTables::Section section)
+{
+  size_t trie_slots = (size_t)header.trie_node_count * 256;
+  switch (section) {
+  case TransducerTables::IndexInputs:
+    return header.index_count * sizeof(SymbolNumber);
+  case TransducerTables::IndexTargets:
+    return header.index_count * sizeof(TransitionTableIndex);
+  case TransducerTables::TransitionInputs:
+  case TransducerTables::TransitionOutputs:
+    return header.transition_count * sizeof(SymbolNumber);
+  case TransducerTables::TransitionTargets:
+    return header.transition_count * sizeof(TransitionTableIndex);
+  case TransducerTables::SymbolOffsets:
+    return (header.symbol_count + 1) * sizeof(unsigned int);
+  case TransducerTables::SymbolPool:
+    return header.symbol_pool_size;
+  case TransducerTables::SymbolKinds:
+  case TransducerTables::FlagOperators:
+    return header.symbol_count;
+  case TransducerTables::FlagFeatures:
+    return header.symbol_count * sizeof(SymbolNumber);
+  case TransducerTables::FlagValues:
+    return header.symbol_count * sizeof(ValueNumber);
+  case TransducerTables::AsciiSymbols:
+    return 256 * sizeof(SymbolNumber);
+  case TransducerTables::TrieChildren:
+    return trie_slots * sizeof(unsigned int);
+  case TransducerTables::TrieSymbols:
+    return trie_slots * sizeof(SymbolNumber);
+  case TransducerTables::SECTION_COUNT:
+    break;
+  }
+  return 0;
+}
+
+const char * TransducerTables::section_name(Section s)
+{
+  static const char * const names[SECTION_COUNT] =
+    {"index_inputs", "index_targets",
+     "transition_inputs", "transition_outputs", "transition_targets",
+     "symbol_offsets", "symbol_pool", "symbol_kinds",
+     "flag_operators", "flag_features", "flag_values",
+     "ascii_symbols", "trie_children", "trie_symbols"};
+  return names[s];
+}
+
+size_t TransducerTables::section_bytes(Section s)
+{
+  return section_size(*header, s);
+}
+
+static size_t align_section(size_t offset)
+{
+  return (offset + TransducerTables::ALIGNMENT - 1)
+    / TransducerTables::ALIGNMENT * TransducerTables::ALIGNMENT;
+}
+
+// Read a table of count entries from f, each made up of field_count
+// fields of the given sizes, and split it into one array per field.
+static void read_table(FILE * f, size_t count, size_t field_count,
+                       const size_t * field_sizes, char ** fields)
+{
+  size_t entry_size = 0;
+  for (size_t n = 0; n < field_count; ++n)
+    {
+      entry_size += field_sizes[n];
+    }
+  std::vector<char> table(count * entry_size);
+  if (count > 0 && fread(&table[0], entry_size, count, f) != count)
+    {
+      throw HeaderParsingException();
+    }
+  for (size_t i = 0; i < count; ++i)
+    {
+      const char * entry = &table[i * entry_size];
+      for (size_t n = 0; n < field_count; ++n)
+        {
+          memcpy(fields[n] + i * field_sizes[n], entry, field_sizes[n]);
+          entry += field_sizes[n];
+        }
+    }
+}
+
+TransducerTables::TransducerTables(char * i, size_t size, Storage s):
+  image(i),
+  image_size(size),
+  storage(s),
+  header(reinterpret_cast<const Header*>(i)),
+  closures(NULL)
+{
+  bool valid = image_size >= sizeof(Header) &&
+    memcmp(header->magic, MAGIC, sizeof(MAGIC)) == 0 &&
+    header->byte_order == BYTE_ORDER_MARK &&
+    header->version == FORMAT_VERSION &&
+    header->header_size == sizeof(Header) &&
+    header->image_size == image_size;
+  for (int n = 0; valid && n < SECTION_COUNT; ++n)
+    {
+      size_t offset = header->section_offsets[n];
+      valid = offset % ALIGNMENT == 0 && offset >= sizeof(Header) &&
+        offset + section_size(*header, (Section)n) <= image_size;
+    }
+  if (!valid)
+    {
+      release();
+      throw HeaderParsingException();
+    }
+
+  index_inputs = section<SymbolNumber>(IndexInputs);
+  index_targets = section<TransitionTableIndex>(IndexTargets);
+  transition_inputs = section<SymbolNumber>(TransitionInputs);
+  transition_outputs = section<SymbolNumber>(TransitionOutputs);
+  transition_targets = section<TransitionTableIndex>(TransitionTargets);
+  symbol_offsets = section<unsigned int>(SymbolOffsets);
+  symbol_pool = section<char>(SymbolPool);
+  symbol_kinds = section<unsigned char>(SymbolKinds);
+  flag_operators = section<unsigned char>(FlagOperators);
+  flag_features = section<SymbolNumber>(FlagFeatures);
+  flag_values = section<ValueNumber>(FlagValues);
+  ascii_symbols = section<SymbolNumber>(AsciiSymbols);
+  trie_children = section<unsigned int>(TrieChildren);
+  trie_symbols = section<SymbolNumber>(TrieSymbols);
+
+  if (header->symbol_pool_size == 0 ||
+      symbol_pool[header->symbol_pool_size - 1] != 0 ||
+      symbol_offsets[header->symbol_count] > header->symbol_pool_size)
+    {
+      release();
+      throw HeaderParsingException();
+    }
+}
+
+void TransducerTables::release(void)
+{
+  unmap_file(image, image_size, storage == Mapped);
+}
+
+TransducerTables::~TransducerTables()
+{
+  delete closures;
+  release();
+}
+
+void TransducerTables::compute_epsilon_closures(void)
+{
+  if (closures == NULL)
+    {
+      closures = new EpsilonClosures(*this);
+    }
+}
+
+namespace
+{
+  // A closure while it's being worked out: the target states, each with
+  // the outputs on the way there
+  typedef std::vector<std::pair<TransitionTableIndex, SymbolNumberVector> > Closure;
+
+  class ClosureBuilder
+  {
+  private:
+    TransducerTables & tables;
+    std::set<TransitionTableIndex> visiting;
+    // states with too large or infinite closures
+    std::set<TransitionTableIndex> lazy;
+    Closure no_closure;
+
+  public:
+    std::map<TransitionTableIndex, Closure> closures;
+
+    ClosureBuilder(TransducerTables & t):
+      tables(t)
+    {}
+
+    // The first epsilon arc of state i, or NO_TABLE_INDEX if it has none
+    TransitionTableIndex epsilon_arcs(TransitionTableIndex i)
+    {
+      TransitionTableIndex j;
+      if (i >= TRANSITION_TARGET_TABLE_START)
+        {
+          j = i - TRANSITION_TARGET_TABLE_START + 1;
+        }
+      else if (tables.index_input(i + 1) == 0)
+        {
+          j = tables.index_target(i + 1) - TRANSITION_TARGET_TABLE_START;
+        }
+      else
+        {
+          return NO_TABLE_INDEX;
+        }
+      return tables.transition_input(j) == 0 ? j : NO_TABLE_INDEX;
+    }
+
+    // The closure of state i, or NULL if it's too large or infinite
+    const Closure * closure(TransitionTableIndex i)
+    {
+      std::map<TransitionTableIndex, Closure>::const_iterator done = closures.find(i);
+      if (done != closures.end())
+        {
+          return &done->second;
+        }
+      TransitionTableIndex j = epsilon_arcs(i);
+      if (j == NO_TABLE_INDEX)
+        {
+          return &no_closure;
+        }
+      // Coming back to a state on the way means an epsilon cycle
+      if (lazy.count(i) != 0 || !visiting.insert(i).second)
+        {
+          return NULL;
+        }
+
+      Closure c;
+      for (; tables.transition_input(j) == 0; ++j)
+        {
+          TransitionTableIndex target = tables.transition_target(j);
+          SymbolNumber output = tables.transition_output(j);
+          const Closure * rest = closure(target);
+          if (rest == NULL || c.size() + rest->size() + 1 > EpsilonClosures::MAX_CLOSURE_SIZE)
+            {
+              visiting.erase(i);
+              lazy.insert(i);
+              return NULL;
+            }
+          // Depth-first order, finishing with the target itself
+          for (Closure::const_iterator it = rest->begin(); it != rest->end(); ++it)
+            {
+              c.push_back(std::make_pair(it->first, SymbolNumberVector(1, output)));
+              c.back().second.insert(c.back().second.end(),
+                                     it->second.begin(), it->second.end());
+            }
+          c.push_back(std::make_pair(target, SymbolNumberVector(1, output)));
+        }
+      visiting.erase(i);
+      return &(closures[i] = c);
+    }
+  };
+}
+
+EpsilonClosures::EpsilonClosures(TransducerTables & tables):
+  index_count(tables.index_count())
+{
+  ClosureBuilder builder(tables);
+  // Every state with an epsilon index, and every transition table state
+  // starting with an epsilon arc. A few positions that aren't states may
+  // turn up too, but they're never looked up.
+  for (TransitionTableIndex i = 0; i + 1 < tables.index_count(); ++i)
+    {
+      if (tables.index_input(i + 1) == 0)
+        {
+          builder.closure(i);
+        }
+    }
+  for (TransitionTableIndex i = 0; i + 1 < tables.transition_count(); ++i)
+    {
+      if (tables.transition_input(i) == NO_SYMBOL_NUMBER &&
+          tables.transition_input(i + 1) == 0)
+        {
+          builder.closure(i + TRANSITION_TARGET_TABLE_START);
+        }
+    }
+
+  offsets.assign((size_t)tables.index_count() + tables.transition_count() + 1, 0);
+  size_t k = 0;
+  for (std::map<TransitionTableIndex, Closure>::const_iterator c = builder.closures.begin();
+       c != builder.closures.end(); ++c)
     {
-        unsigned short remaining_header_len;
-        if (fread(&remaining_header_len,
-                  sizeof(remaining_header_len), 1, f) != 1 ||
-            getc(f) != '\0') {
-            throw HeaderParsingException();
+      for (; k <= key(c->first); ++k)
+        {
+          offsets[k] = entries.size();
         }
-        char * headervalue = new char[remaining_header_len];
-        if (fread(headervalue, remaining_header_len, 1, f) != 1)
+      for (Closure::const_iterator it = c->second.begin(); it != c->second.end(); ++it)
         {
-            throw HeaderParsingException();
+          Entry e;
+          e.target = it->first;
+          e.outputs_begin = outputs.size();
+          outputs.insert(outputs.end(), it->second.begin(), it->second.end());
+          e.outputs_end = outputs.size();
+          entries.push_back(e);
         }
-        if (headervalue[remaining_header_len - 1] != '\0') {
-            throw HeaderParsingException();
+    }
+  for (; k < offsets.size(); ++k)
+    {
+      offsets[k] = entries.size();
+    }
+  entries.shrink_to_fit();
+  outputs.shrink_to_fit();
+}
+
+size_t EpsilonClosures::size(void) const
+{
+  return offsets.capacity() * sizeof(unsigned int) +
+    entries.capacity() * sizeof(Entry) +
+    outputs.capacity() * sizeof(SymbolNumber);
+}
+
+bool TransducerTables::is_compiled(FILE * f)
+{
+  long position = ftell(f);
+  char magic[sizeof(MAGIC)];
+  size_t read = fread(magic, 1, sizeof(magic), f);
+  fseek(f, position, SEEK_SET);
+  return read == sizeof(magic) && memcmp(magic, MAGIC, sizeof(MAGIC)) == 0;
+}
+
+TransducerTables * TransducerTables::from_hfstol(FILE * f,
+                                                 TransducerHeader & transducer_header,
+                                                 TransducerAlphabet & alphabet,
+                                                 LoadProfile * profile)
+{
+  if (transducer_header.probe_flag(Weighted))
+    {
+      throw std::runtime_error("Weighted transducers not yet supported");
+    }
+  LoadProfile unused_profile;
+  PhaseTimer timer(profile == NULL ? unused_profile : *profile);
+
+  KeyTable * kt = alphabet.get_key_table();
+  OperationVector operations = alphabet.get_operation_vector();
+  SymbolNumber symbol_count = transducer_header.symbol_count();
+
+  // The tokenizer, following the same rules as Encoder: a single ascii
+  // character is looked up directly, unless a longer symbol starts with it
+  std::vector<unsigned int> children(256, 0);
+  SymbolNumberVector trie(256, NO_SYMBOL_NUMBER);
+  SymbolNumberVector ascii(256, NO_SYMBOL_NUMBER);
+  for (SymbolNumber k = 0; k < transducer_header.input_symbol_count(); ++k)
+    {
+      const char * p = kt->operator[](k);
+      size_t length = strlen(p);
+      unsigned char first = *p;
+      if (length == 1 && first <= 127 && children[first] == 0)
+        {
+          ascii[first] = k;
         }
-        std::string header_tail(headervalue, remaining_header_len);
-        size_t type_field = header_tail.find("type");
-        if (type_field != std::string::npos) {
-            if (header_tail.find("HFST_OL") != type_field + 5 &&
-                header_tail.find("HFST_OLW") != type_field + 5) {
-                delete[] headervalue;
-                throw HeaderParsingException();
+      if (length > 1 && first <= 127)
+        {
+          ascii[first] = NO_SYMBOL_NUMBER;
+        }
+      if (length == 0)
+        {
+          continue;
+        }
+      unsigned int node = 0;
+      for (; *(p+1) != 0; ++p)
+        {
+          size_t slot = 256 * node + (unsigned char)(*p);
+          if (children[slot] == 0)
+            {
+              children[slot] = trie.size() / 256;
+              children.resize(children.size() + 256, 0);
+              trie.resize(trie.size() + 256, NO_SYMBOL_NUMBER);
             }
+          node = children[slot];
         }
-    } else // nope. put back what we've taken
+      trie[256 * node + (unsigned char)(*p)] = k;
+    }
+
+  std::string pool;
+  std::vector<unsigned int> offsets;
+  for (SymbolNumber k = 0; k < symbol_count; ++k)
     {
-        ungetc(c, f); // first the non-matching character
-            for(int i = header_loc - 1; i>=0; i--) {
-// then the characters that did match (if any)
-                ungetc(header1[i], f);
+      offsets.push_back(pool.size());
+      pool.append(kt->operator[](k));
+      pool.push_back('\0');
+    }
+  offsets.push_back(pool.size());
+
+  Header header;
+  memset(&header, 0, sizeof(header));
+  memcpy(header.magic, MAGIC, sizeof(MAGIC));
+  header.byte_order = BYTE_ORDER_MARK;
+  header.version = FORMAT_VERSION;
+  header.header_size = sizeof(Header);
+  for (int flag = Weighted; flag <= Has_unweighted_input_epsilon_cycles; ++flag)
+    {
+      if (transducer_header.probe_flag((HeaderFlag)flag))
+        {
+          header.properties |= 1u << flag;
+        }
+    }
+  header.symbol_count = symbol_count;
+  header.input_symbol_count = transducer_header.input_symbol_count();
+  header.flag_feature_count = alphabet.get_state_size();
+  header.index_count = transducer_header.index_table_size();
+  header.transition_count = transducer_header.target_table_size();
+  header.trie_node_count = trie.size() / 256;
+  header.symbol_pool_size = pool.size();
+
+  size_t size = align_section(sizeof(Header));
+  for (int n = 0; n < SECTION_COUNT; ++n)
+    {
+      header.section_offsets[n] = size;
+      size = align_section(size + section_size(header, (Section)n));
+      if (size > UINT_MAX)
+        {
+          throw std::runtime_error("Transducer too large to compile");
+        }
+    }
+  header.image_size = size;
+  timer.finish("index build");
+
+  char * image = (char*)(calloc(size, 1));
+  if (image == NULL)
+    {
+      throw std::bad_alloc();
+    }
+  try
+    {
+      memcpy(image, &header, sizeof(header));
+      const size_t index_fields[] = {sizeof(SymbolNumber),
+                                     sizeof(TransitionTableIndex)};
+      char * index_tables[] = {image + header.section_offsets[IndexInputs],
+                               image + header.section_offsets[IndexTargets]};
+      read_table(f, header.index_count, 2, index_fields, index_tables);
+
+      const size_t transition_fields[] = {sizeof(SymbolNumber),
+                                          sizeof(SymbolNumber),
+                                          sizeof(TransitionTableIndex)};
+      char * transition_tables[] = {
+        image + header.section_offsets[TransitionInputs],
+        image + header.section_offsets[TransitionOutputs],
+        image + header.section_offsets[TransitionTargets]};
+      read_table(f, header.transition_count, 3, transition_fields,
+                 transition_tables);
+    }
+  catch (...)
+    {
+      free(image);
+      throw;
+    }
+  timer.finish("table read");
+
+  memcpy(image + header.section_offsets[SymbolOffsets], &offsets[0],
+         offsets.size() * sizeof(unsigned int));
+  memcpy(image + header.section_offsets[SymbolPool], pool.data(), pool.size());
+  for (SymbolNumber k = 0; k < symbol_count; ++k)
+    {
+      // count the utf-8 characters, i.e., the bytes that aren't
+      // continuation bytes
+      size_t characters = 0;
+      for (const char * c = kt->operator[](k); *c != 0; ++c)
+        {
+          if ((*c & 0xC0) != 0x80)
+            {
+              ++characters;
             }
+        }
+      unsigned char kind = characters == 0 ? Hidden :
+        (characters == 1 ? Lexical : Multichar);
+      image[header.section_offsets[SymbolKinds] + k] = kind;
+
+      FlagDiacriticOperation op = operations[k];
+      image[header.section_offsets[FlagOperators] + k] = op.Operation();
+      SymbolNumber feature = op.Feature();
+      ValueNumber value = op.Value();
+      memcpy(image + header.section_offsets[FlagFeatures] + k * sizeof(SymbolNumber),
+             &feature, sizeof(SymbolNumber));
+      memcpy(image + header.section_offsets[FlagValues] + k * sizeof(ValueNumber),
+             &value, sizeof(ValueNumber));
     }
+  memcpy(image + header.section_offsets[AsciiSymbols], &ascii[0],
+         ascii.size() * sizeof(SymbolNumber));
+  memcpy(image + header.section_offsets[TrieChildren], &children[0],
+         children.size() * sizeof(unsigned int));
+  memcpy(image + header.section_offsets[TrieSymbols], &trie[0],
+         trie.size() * sizeof(SymbolNumber));
+  timer.finish("symbol tables");
+
+  return new TransducerTables(image, size, Allocated);
 }
 
-void TransducerAlphabet::get_next_symbol(FILE * f, SymbolNumber k)
+// The first free position from p on, where next_free leads from each
+// taken position to a later one
+static TransitionTableIndex first_free_from(std::vector<TransitionTableIndex> & next_free,
+                                            TransitionTableIndex p)
 {
-  int byte;
-  char * sym = line;
-  while ( (byte = fgetc(f)) != 0 )
+  while (next_free[p] != p)
     {
-      if (byte == EOF || sym - line >= LINE_SIZE)
+      next_free[p] = next_free[next_free[p]];
+      p = next_free[p];
+    }
+  return p;
+}
+
+TransducerTables * TransducerTables::reordered(const std::vector<unsigned int> & state_visits)
+{
+  // The transition table is made up of blocks, each a state's finality
+  // entry followed by its arcs, except for the first, which only holds
+  // index table states' arcs. No arc run goes past the start of the next
+  // block, so blocks can be moved around as long as every reference into
+  // one moves with it. The first block has no finality entry to end the
+  // block before it, and the last one ends the table, so those two stay
+  // where they are.
+  TransitionTableIndex count = header->transition_count;
+  std::vector<TransitionTableIndex> block_starts;
+  std::vector<unsigned int> block_of(count);
+  for (TransitionTableIndex i = 0; i < count; ++i)
+    {
+      if (i == 0 || transition_inputs[i] == NO_SYMBOL_NUMBER)
         {
-          throw HeaderParsingException();
+          block_starts.push_back(i);
         }
-      *sym = byte;
-      ++sym;
+      block_of[i] = block_starts.size() - 1;
     }
-  *sym = 0;
-  if (strlen(line) >= 5 && line[0] == '@' && line[strlen(line) - 1] == '@' && line[2] == '.')
-    { // a special symbol needs to be parsed
-      std::string feat;
-      std::string val;
-      FlagDiacriticOperator op = P; // g++ worries about this falling through uninitialized
-      switch (line[1]) {
-      case 'P': op = P; break;
-      case 'N': op = N; break;
-      case 'R': op = R; break;
-      case 'D': op = D; break;
-      case 'C': op = C; break;
-      case 'U': op = U; break;
-      }
-      char * c = line;
-      // as long as we're working with utf-8, this should be ok
-      for (c +=3; *c != '.' && *c != '@'; c++) { feat.append(c,1); }
-      if (*c == '.')
+  size_t block_count = block_starts.size();
+  block_starts.push_back(count);
+
+  std::vector<unsigned long long> heat(block_count, 0);
+  for (TransitionTableIndex i = 0; i < header->index_count; ++i)
+    {
+      if (state_visits[i] == 0)
         {
-          for (++c; *c != '@'; c++) { val.append(c,1); }
+          continue;
         }
-      if (feature_bucket.count(feat) == 0)
+      // An index table state's arcs are in the runs its slots point to
+      for (SymbolNumber s = 0; s < header->input_symbol_count &&
+             i + 1 + s < header->index_count; ++s)
         {
-          feature_bucket[feat] = feat_num;
-          ++feat_num;
+          if (index_inputs[i + 1 + s] == s &&
+              index_targets[i + 1 + s] >= TRANSITION_TARGET_TABLE_START)
+            {
+              heat[block_of[index_targets[i + 1 + s] - TRANSITION_TARGET_TABLE_START]] +=
+                state_visits[i];
+            }
         }
-      if (value_bucket.count(val) == 0)
+    }
+  for (TransitionTableIndex i = 0; i < count; ++i)
+    {
+      heat[block_of[i]] += state_visits[header->index_count + i];
+    }
+
+  // hottest first, ties in their original order
+  std::vector<std::pair<unsigned long long, size_t> > order;
+  for (size_t b = 1; b + 1 < block_count; ++b)
+    {
+      order.push_back(std::make_pair(~heat[b], b));
+    }
+  std::sort(order.begin(), order.end());
+  std::vector<size_t> layout(1, 0);
+  for (size_t n = 0; n < order.size(); ++n)
+    {
+      layout.push_back(order[n].second);
+    }
+  if (block_count > 1)
+    {
+      layout.push_back(block_count - 1);
+    }
+
+  // where each entry goes
+  std::vector<TransitionTableIndex> moved(count);
+  TransitionTableIndex position = 0;
+  TransitionTableIndex hot_count = 0;
+  for (size_t n = 0; n < layout.size(); ++n)
+    {
+      size_t b = layout[n];
+      for (TransitionTableIndex i = block_starts[b]; i < block_starts[b + 1]; ++i)
         {
-          value_bucket[val] = val_num;
-          ++val_num;
+          moved[i] = position++;
         }
-      operations.push_back(FlagDiacriticOperation(op, feature_bucket[feat], value_bucket[val]));
-      kt->operator[](k) = strdup("");
+      if (heat[b] > 0)
+        {
+          hot_count = position;
+        }
+    }
 
-#if OL_FULL_DEBUG
-      std::cout << "symbol number " << k << " (flag) is \"" << line << "\"" << std::endl;
-      kt->operator[](k) = strdup(line);
-#endif
+  // Index table states are packed so that their entries interleave:
+  // state i has its finality entry at i and its slot for input symbol s
+  // at i + 1 + s, which belongs to it only if it holds s. So they can't
+  // be moved one by one like blocks, but are packed again, the start
+  // state first and then the hottest, each at the first position where
+  // its entries fit and lookup can read all the slots it may look at.
+  // If they don't all fit, the file's packing is kept.
+  TransitionTableIndex index_count = header->index_count;
+  std::vector<bool> is_state(index_count, false);
+  if (index_count > 0)
+    {
+      is_state[0] = true;
+    }
+  for (TransitionTableIndex i = 0; i < count; ++i)
+    {
+      if (transition_inputs[i] != NO_SYMBOL_NUMBER &&
+          transition_targets[i] < TRANSITION_TARGET_TABLE_START)
+        {
+          is_state[transition_targets[i]] = true;
+        }
+    }
+  for (TransitionTableIndex i = 0; i < index_count; ++i)
+    {
+      if (index_inputs[i] != NO_SYMBOL_NUMBER &&
+          index_targets[i] < TRANSITION_TARGET_TABLE_START)
+        {
+          is_state[index_targets[i]] = true;
+        }
+    }
+  std::vector<std::pair<unsigned int, TransitionTableIndex> > index_order;
+  for (TransitionTableIndex i = 1; i < index_count; ++i)
+    {
+      if (is_state[i])
+        {
+          index_order.push_back(std::make_pair(~state_visits[i], i));
+        }
+    }
+  std::sort(index_order.begin(), index_order.end());
+  if (index_count > 0)
+    {
+      index_order.insert(index_order.begin(), std::make_pair(0u, 0u));
+    }
 
-      return;
+  std::vector<TransitionTableIndex> index_moved(index_count, NO_TABLE_INDEX);
+  std::vector<bool> taken(index_count, false);
+  // leads from each position to the first free one from there on
+  std::vector<TransitionTableIndex> next_free(index_count + 1);
+  for (TransitionTableIndex j = 0; j <= index_count; ++j)
+    {
+      next_free[j] = j;
+    }
+  std::vector<TransitionTableIndex> entries;
+  // Positions are only ever taken, so where states with the same entries
+  // didn't fit before, the next one won't either
+  std::map<std::vector<TransitionTableIndex>, TransitionTableIndex> tried;
+  for (size_t n = 0; n < index_order.size(); ++n)
+    {
+      TransitionTableIndex i = index_order[n].second;
+      entries.assign(1, 0);
+      for (SymbolNumber s = 0; s < header->input_symbol_count &&
+             i + 1 + s < index_count; ++s)
+        {
+          if (index_inputs[i + 1 + s] == s)
+            {
+              entries.push_back(1 + s);
+            }
+        }
+      TransitionTableIndex & place = tried[entries];
+      for (place = first_free_from(next_free, place);
+           place + header->input_symbol_count < index_count;
+           place = first_free_from(next_free, place + 1))
+        {
+          size_t e = 1;
+          while (e < entries.size() && !taken[place + entries[e]])
+            {
+              ++e;
+            }
+          if (e == entries.size())
+            {
+              break;
+            }
+        }
+      if (place + header->input_symbol_count >= index_count)
+        {
+          for (TransitionTableIndex j = 0; j < index_count; ++j)
+            {
+              index_moved[j] = j;
+            }
+          break;
+        }
+      for (size_t e = 0; e < entries.size(); ++e)
+        {
+          taken[place + entries[e]] = true;
+          next_free[place + entries[e]] = place + entries[e] + 1;
+        }
+      index_moved[i] = place;
     }
-  operations.push_back(FlagDiacriticOperation()); // dummy flag
 
-#if OL_FULL_DEBUG
-  std::cout << "symbol number " << k << " is \"" << line << "\"" << std::endl;
-#endif
+  char * copy = (char*)(malloc(image_size));
+  if (copy == NULL)
+    {
+      throw std::bad_alloc();
+    }
+  memcpy(copy, image, image_size);
+  reinterpret_cast<Header*>(copy)->hot_transition_count = hot_count;
+  SymbolNumber * inputs = reinterpret_cast<SymbolNumber*>(copy + header->section_offsets[TransitionInputs]);
+  SymbolNumber * outputs = reinterpret_cast<SymbolNumber*>(copy + header->section_offsets[TransitionOutputs]);
+  TransitionTableIndex * targets = reinterpret_cast<TransitionTableIndex*>(
+    copy + header->section_offsets[TransitionTargets]);
+  SymbolNumber * new_index_inputs = reinterpret_cast<SymbolNumber*>(
+    copy + header->section_offsets[IndexInputs]);
+  TransitionTableIndex * new_index_targets = reinterpret_cast<TransitionTableIndex*>(
+    copy + header->section_offsets[IndexTargets]);
+
+  for (TransitionTableIndex i = 0; i < count; ++i)
+    {
+      TransitionTableIndex j = moved[i];
+      inputs[j] = transition_inputs[i];
+      outputs[j] = transition_outputs[i];
+      targets[j] = transition_targets[i];
+      // finality entries hold finality rather than a target
+      if (transition_inputs[i] != NO_SYMBOL_NUMBER)
+        {
+          targets[j] = transition_targets[i] >= TRANSITION_TARGET_TABLE_START ?
+            TRANSITION_TARGET_TABLE_START +
+            moved[transition_targets[i] - TRANSITION_TARGET_TABLE_START] :
+            index_moved[transition_targets[i]];
+        }
+    }
+  for (TransitionTableIndex i = 0; i < index_count; ++i)
+    {
+      new_index_inputs[i] = NO_SYMBOL_NUMBER;
+      new_index_targets[i] = NO_TABLE_INDEX;
+    }
+  for (TransitionTableIndex i = 0; i < index_count; ++i)
+    {
+      if (!is_state[i])
+        {
+          continue;
+        }
+      TransitionTableIndex j = index_moved[i];
+      if (index_inputs[i] == NO_SYMBOL_NUMBER)
+        {
+          new_index_targets[j] = index_targets[i];
+        }
+      for (SymbolNumber s = 0; s < header->input_symbol_count &&
+             i + 1 + s < index_count; ++s)
+        {
+          TransitionTableIndex slot = i + 1 + s;
+          if (index_inputs[slot] != s)
+            {
+              continue;
+            }
+          new_index_inputs[j + 1 + s] = s;
+          new_index_targets[j + 1 + s] =
+            index_targets[slot] >= TRANSITION_TARGET_TABLE_START ?
+            TRANSITION_TARGET_TABLE_START +
+            moved[index_targets[slot] - TRANSITION_TARGET_TABLE_START] :
+            index_moved[index_targets[slot]];
+        }
+    }
 
-  kt->operator[](k) = strdup(line);
+  return new TransducerTables(copy, image_size, Allocated);
 }
 
-void LetterTrie::add_string(const char * p, SymbolNumber symbol_key)
+// Read in the pages of size bytes at start, telling the system first
+static void prefault_range(const char * start, size_t size)
 {
-  if (*(p+1) == 0)
+  if (size == 0)
     {
-      symbols[(unsigned char)(*p)] = symbol_key;
       return;
     }
-  if (letters[(unsigned char)(*p)] == NULL)
+  size_t page_size = 4096;
+#ifndef _MSC_VER
+  page_size = sysconf(_SC_PAGESIZE);
+  const char * page = start - ((size_t)start % page_size);
+  madvise((void*)page, start + size - page, MADV_WILLNEED);
+#endif
+  volatile char sink = 0;
+  for (const char * p = start; p < start + size; p += page_size)
     {
-      letters[(unsigned char)(*p)] = new LetterTrie();
+      sink = sink + *p;
     }
-  letters[(unsigned char)(*p)]->add_string(p+1,symbol_key);
+  sink = sink + start[size - 1];
 }
 
-bool LetterTrie::has_key_starting_with(const char c) const
+void TransducerTables::prefault(void)
 {
-    return letters[(unsigned char) c] != NULL;
+  if (storage != Mapped)
+    {
+      // in memory already
+      return;
+    }
+  size_t hot = header->hot_transition_count;
+  if (hot == 0)
+    {
+      hot = header->transition_count;
+    }
+  for (int n = 0; n < SECTION_COUNT; ++n)
+    {
+      size_t size = section_bytes((Section)n);
+      if (n == TransitionInputs || n == TransitionOutputs)
+        {
+          size = hot * sizeof(SymbolNumber);
+        }
+      else if (n == TransitionTargets)
+        {
+          size = hot * sizeof(TransitionTableIndex);
+        }
+      prefault_range(image + header->section_offsets[n], size);
+    }
 }
 
-SymbolNumber LetterTrie::find_key(const char ** p)
+TransducerTables * TransducerTables::load(FILE * f)
 {
-  const char * old_p = *p;
-  ++(*p);
-  if (letters[(unsigned char)(*old_p)] == NULL)
-    {
-      return symbols[(unsigned char)(*old_p)];
-    }
-  SymbolNumber s = letters[(unsigned char)(*old_p)]->find_key(p);
-  if (s == NO_SYMBOL_NUMBER)
+  size_t size;
+  bool mapped;
+  char * image = map_file(f, sizeof(Header), size, mapped);
+  if (image == NULL)
     {
-      --(*p);
-      return symbols[(unsigned char)(*old_p)];
+      throw HeaderParsingException();
     }
-  return s;
+  return new TransducerTables(image, size, mapped ? Mapped : Allocated);
 }
 
-void Encoder::read_input_symbols(KeyTable * kt)
+void TransducerTables::save(const char * path)
 {
-  for (SymbolNumber k = 0; k < number_of_input_symbols; ++k)
+  FILE * f = fopen(path, "wb");
+  if (f == NULL)
     {
-#if DEBUG
-      assert(kt->find(k) != kt->end());
-#endif
-      const char * p = kt->operator[](k);
-      if ((strlen(p) == 1) && (unsigned char)(*p) <= 127
-          // we have a single char ascii symbol
-          && !letters.has_key_starting_with(*p)) {
-          // make sure there isn't a longer symbol we would be shadowing
-          ascii_symbols[(unsigned char)(*p)] = k;
-      }
-      // If there's an ascii tokenized symbol shadowing this, remove it
-      if (strlen(p) > 1 &&
-          (unsigned char)(*p) <= 127 &&
-          ascii_symbols[(unsigned char)(*p)] != NO_SYMBOL_NUMBER) {
-          ascii_symbols[(unsigned char)(*p)] = NO_SYMBOL_NUMBER;
-      }
-      letters.add_string(p,k);
+      throw std::runtime_error(std::string("Could not open ") + path);
+    }
+  bool written = fwrite(image, 1, image_size, f) == image_size;
+  if (fclose(f) != 0 || !written)
+    {
+      throw std::runtime_error(std::string("Could not write ") + path);
     }
 }
 
-SymbolNumber Encoder::find_key(const char ** p)
+const char LookupSnapshot::MAGIC[8] = {'H', 'F', 'S', 'T', 'O', 'L', 'S', '\0'};
+
+LookupSnapshot::LookupSnapshot(char * i, size_t size, bool m):
+  image(i),
+  image_size(size),
+  mapped(m)
+{
+  header = reinterpret_cast<const Header*>(image);
+  entries = reinterpret_cast<const Entry*>(image + sizeof(Header));
+  analysis_offsets = reinterpret_cast<const unsigned int*>(entries + header->entry_count);
+  symbols = reinterpret_cast<const SymbolNumber*>(analysis_offsets + header->analysis_count + 1);
+  keys = reinterpret_cast<const char*>(symbols + header->symbol_count);
+}
+
+// 64-bit FNV-1a of the next up to limit bytes of f
+static unsigned long long fnv_hash(FILE * f, unsigned long long limit)
 {
-  if (ascii_symbols[(unsigned char)(**p)] == NO_SYMBOL_NUMBER)
+  unsigned long long hash = 14695981039346656037ULL;
+  unsigned char buffer[65536];
+  size_t count;
+  while (limit > 0 &&
+         (count = fread(buffer, 1, std::min((unsigned long long)sizeof(buffer), limit), f)) > 0)
     {
-      return letters.find_key(p);
+      for (size_t n = 0; n < count; ++n)
+        {
+          hash = (hash ^ buffer[n]) * 1099511628211ULL;
+        }
+      limit -= count;
     }
-  SymbolNumber s = ascii_symbols[(unsigned char)(**p)];
-  ++(*p);
-  return s;
+  return hash;
 }
 
-#if BUILD_HFSTOL_MAIN
-void runTransducer (TransducerBase * T)
+LookupSnapshot::Stamp LookupSnapshot::stamp(FILE * transducer)
 {
-  SymbolNumber * input_string = (SymbolNumber*)(malloc(2000));
-  for (int i = 0; i < 1000; ++i)
+  Stamp s;
+  memset(&s, 0, sizeof(s));
+#ifndef _MSC_VER
+  struct stat status;
+  if (fstat(fileno(transducer), &status) == 0)
+#else
+  struct _stat64 status;
+  if (_fstat64(_fileno(transducer), &status) == 0)
+#endif
     {
-      input_string[i] = NO_SYMBOL_NUMBER;
+      s.size = status.st_size;
+      s.mtime = status.st_mtime;
     }
+  long position = ftell(transducer);
+  fseek(transducer, 0, SEEK_SET);
+  s.head_hash = fnv_hash(transducer, HEAD_BYTES);
+  fseek(transducer, position, SEEK_SET);
+  return s;
+}
 
-  char * str = (char*)(malloc(MAX_IO_STRING*sizeof(char)));
-  *str = 0;
-  char * old_str = str;
+unsigned long long LookupSnapshot::content_hash(FILE * transducer)
+{
+  fseek(transducer, 0, SEEK_SET);
+  unsigned long long hash = fnv_hash(transducer, (unsigned long long)-1);
+  fseek(transducer, 0, SEEK_SET);
+  return hash;
+}
 
-  while(true)
+// Whether every offset and length in a snapshot image, whose sections
+// have the sizes its header gives, stays within those sections
+static bool snapshot_offsets_valid(const LookupSnapshot::Header * h,
+                                   const LookupSnapshot::Entry * entries,
+                                   const unsigned int * analysis_offsets,
+                                   const SymbolNumber * symbols,
+                                   SymbolNumber symbol_count)
+{
+  for (unsigned int e = 0; e < h->entry_count; ++e)
     {
-#ifdef WINDOWS
-      if (!pipe_input)
+      if ((unsigned long long)entries[e].key_offset + entries[e].key_length > h->key_bytes ||
+          entries[e].analyses_begin > entries[e].analyses_end ||
+          entries[e].analyses_end > h->analysis_count)
         {
-          free(str);
-          std::string linestr("");
-          if (! hfst::get_line_from_console(linestr, MAX_IO_STRING*sizeof(char)))
-            break;
-          str = strdup(linestr.c_str());
-          old_str = str;
+          return false;
         }
-      else
-#endif
+    }
+  if (analysis_offsets[0] != 0)
+    {
+      return false;
+    }
+  for (unsigned int a = 0; a < h->analysis_count; ++a)
+    {
+      if (analysis_offsets[a] > analysis_offsets[a + 1] ||
+          analysis_offsets[a + 1] > h->symbol_count)
         {
-          if (! std::cin.getline(str,MAX_IO_STRING))
-            break;
+          return false;
         }
-
-      if (echoInputsFlag)
+    }
+  for (unsigned int n = 0; n < h->symbol_count; ++n)
+    {
+      if (symbols[n] >= symbol_count)
         {
-#ifdef WINDOWS
-          if (!pipe_output)
-            hfst_fprintf_console(stdout, "%s\n", str); // fix: add \r?
-          else
-#endif
-            std::cout << str << std::endl;
+          return false;
         }
-      int i = 0;
-      SymbolNumber k = NO_SYMBOL_NUMBER;
-      bool failed = false;
-      for ( const char ** Str = (const char **)&str; **Str != 0; )
+    }
+  return true;
+}
+
+LookupSnapshot * LookupSnapshot::load(const char * path, FILE * transducer,
+                                      const Stamp & transducer_stamp,
+                                      SymbolNumber symbol_count)
+{
+  FILE * f = fopen(path, "rb");
+  if (f == NULL)
+    {
+      throw std::runtime_error(std::string("Could not open snapshot ‘") + path + "’");
+    }
+  size_t size;
+  bool mapped;
+  char * image;
+  try
+    {
+      image = map_file(f, sizeof(Header), size, mapped);
+    }
+  catch (...)
+    {
+      fclose(f);
+      throw;
+    }
+  fclose(f);
+  if (image == NULL)
+    {
+      throw std::runtime_error(std::string("Could not read snapshot ‘") + path + "’");
+    }
+
+  const Header * h = reinterpret_cast<const Header*>(image);
+  const char * problem = NULL;
+  if (memcmp(h->magic, MAGIC, sizeof(MAGIC)) != 0 ||
+      h->byte_order != TransducerTables::BYTE_ORDER_MARK ||
+      h->version != FORMAT_VERSION)
+    {
+      problem = "isn't a snapshot this version can read";
+    }
+  // The stamp matching is enough; the size or the first bytes not
+  // matching rule the transducer out. Only otherwise, such as when the
+  // file was copied, is all of it read to make sure.
+  else if (h->transducer_stamp.size != transducer_stamp.size ||
+           h->transducer_stamp.head_hash != transducer_stamp.head_hash ||
+           (h->transducer_stamp.mtime != transducer_stamp.mtime &&
+            h->transducer_hash != content_hash(transducer)))
+    {
+      problem = "was made from a different transducer";
+    }
+  else if ((unsigned long long)size != sizeof(Header) +
+           (unsigned long long)h->entry_count * sizeof(Entry) +
+           ((unsigned long long)h->analysis_count + 1) * sizeof(unsigned int) +
+           (unsigned long long)h->symbol_count * sizeof(SymbolNumber) +
+           h->key_bytes)
+    {
+      problem = "is truncated or corrupt";
+    }
+  else
+    {
+      const Entry * entries = reinterpret_cast<const Entry*>(image + sizeof(Header));
+      const unsigned int * analysis_offsets =
+        reinterpret_cast<const unsigned int*>(entries + h->entry_count);
+      const SymbolNumber * symbols =
+        reinterpret_cast<const SymbolNumber*>(analysis_offsets + h->analysis_count + 1);
+      if (!snapshot_offsets_valid(h, entries, analysis_offsets, symbols, symbol_count))
         {
-          k = T->find_next_key(Str);
-#if OL_FULL_DEBUG
-          std::cout << "INPUT STRING ENTRY " << i << " IS " << k << std::endl;
-#endif
-          if (k == NO_SYMBOL_NUMBER)
-            {
-              if (echoInputsFlag)
-                {
-                  std::cout << std::endl;
-                }
-              failed = true;
-              break;
-            }
-          input_string[i] = k;
-          ++i;
+          problem = "is truncated or corrupt";
         }
-      str = old_str;
-      if (failed)
-        { // tokenization failed
-          if (outputType == xerox)
-            {
-#ifdef WINDOWS
-          if (!pipe_output)
-              hfst_fprintf_console(stdout, "%s\t%s\t+?\n\n", str, str);
-          else
-#endif
-              std::cout << str << "\t" << str << "\t+?" << std::endl << std::endl;
+    }
+  if (problem != NULL)
+    {
+      unmap_file(image, size, mapped);
+      throw std::runtime_error(std::string("Snapshot ‘") + path + "’ " + problem);
+    }
+  return new LookupSnapshot(image, size, mapped);
+}
 
-#ifdef WINDOWS
-          if (!pipe_output)
-            hfst_fprintf_console(stdout, "\n\n");
-          else
-#endif
-              std::cout << std::endl << std::endl;
-            }
+void LookupSnapshot::save(const char * path, FILE * transducer,
+                          const Stamp & transducer_stamp,
+                          const std::vector<std::string> & inputs,
+                          const std::vector<AnalysisVector> & analyses)
+{
+  // Sorted byte by byte for binary search, repeated inputs in input order
+  std::vector<std::pair<std::string, size_t> > order;
+  for (size_t n = 0; n < inputs.size(); ++n)
+    {
+      order.push_back(std::make_pair(inputs[n], n));
+    }
+  std::sort(order.begin(), order.end());
+
+  std::vector<Entry> entry_table;
+  std::vector<unsigned int> offsets(1, 0);
+  SymbolNumberVector symbol_table;
+  std::string key_pool;
+  for (size_t k = 0; k < order.size(); ++k)
+    {
+      const std::string & input = order[k].first;
+      if (k > 0 && input == order[k - 1].first)
+        {
           continue;
         }
+      Entry e;
+      e.key_offset = key_pool.size();
+      e.key_length = input.size();
+      e.analyses_begin = offsets.size() - 1;
+      const AnalysisVector & a = analyses[order[k].second];
+      for (AnalysisVector::const_iterator it = a.begin(); it != a.end(); ++it)
+        {
+          symbol_table.insert(symbol_table.end(), it->begin(), it->end());
+          offsets.push_back(symbol_table.size());
+        }
+      e.analyses_end = offsets.size() - 1;
+      key_pool.append(input);
+      entry_table.push_back(e);
+    }
 
-      input_string[i] = NO_SYMBOL_NUMBER;
-
-      if (time_cutoff > 0.0) {
-          start_clock = clock();
-          call_counter = 0;
-          limit_reached = false;
-      }
-
-      T->analyze(input_string);
-      T->printAnalyses(std::string(str));
+  Header h;
+  memset(&h, 0, sizeof(h));
+  memcpy(h.magic, MAGIC, sizeof(MAGIC));
+  h.byte_order = TransducerTables::BYTE_ORDER_MARK;
+  h.version = FORMAT_VERSION;
+  h.transducer_hash = content_hash(transducer);
+  h.transducer_stamp = transducer_stamp;
+  h.entry_count = entry_table.size();
+  h.analysis_count = offsets.size() - 1;
+  h.symbol_count = symbol_table.size();
+  h.key_bytes = key_pool.size();
+
+  FILE * f = fopen(path, "wb");
+  if (f == NULL)
+    {
+      throw std::runtime_error(std::string("Could not open ") + path);
+    }
+  bool written =
+    fwrite(&h, sizeof(h), 1, f) == 1 &&
+    fwrite(entry_table.data(), sizeof(Entry), entry_table.size(), f) == entry_table.size() &&
+    fwrite(offsets.data(), sizeof(unsigned int), offsets.size(), f) == offsets.size() &&
+    fwrite(symbol_table.data(), sizeof(SymbolNumber), symbol_table.size(), f) == symbol_table.size() &&
+    fwrite(key_pool.data(), 1, key_pool.size(), f) == key_pool.size();
+  if (fclose(f) != 0 || !written)
+    {
+      throw std::runtime_error(std::string("Could not write ") + path);
     }
 }
-#endif
 
-TransducerBase * instantiateTransducer(FILE * f, TransducerHeader& header, TransducerAlphabet& alphabet)
+bool LookupSnapshot::find(const char * input, AnalysisVector & analyses) const
 {
-  if (header.probe_flag(Has_unweighted_input_epsilon_cycles) ||
-      header.probe_flag(Has_input_epsilon_cycles))
+  size_t length = strlen(input);
+  size_t low = 0;
+  size_t high = header->entry_count;
+  while (low < high)
     {
-      std::cerr << "!! Warning: transducer has epsilon cycles                  !!\n"
-                << "!! This is currently not handled - if they are encountered !!\n"
-                << "!! program *will* segfault.                                !!\n";
-    }
-
-  if (alphabet.get_state_size() == 0)
-    {      // if the state size is zero, there are no flag diacritics to handle
-      if (header.probe_flag(Weighted) == false)
-        {
-          if (displayUniqueFlag)
-            { // no flags, no weights, unique analyses only
-             return new TransducerUniq(f, header, alphabet);
-            } else if (!displayUniqueFlag)
-            { // no flags, no weights, all analyses
-           return new Transducer(f, header, alphabet);
-            }
+      size_t middle = low + (high - low) / 2;
+      const Entry & e = entries[middle];
+      int c = memcmp(keys + e.key_offset, input, std::min((size_t)e.key_length, length));
+      if (c == 0)
+        {
+          c = e.key_length < length ? -1 : (e.key_length > length ? 1 : 0);
         }
-      else if (header.probe_flag(Weighted) == true)
+      if (c < 0)
         {
-          if (displayUniqueFlag)
-            { // no flags, weights, unique analyses only
-             return new TransducerWUniq(f, header, alphabet);
-            } else if (!displayUniqueFlag)
-            { // no flags, weights, all analyses
-             return new TransducerW(f, header, alphabet);
-            }
+          low = middle + 1;
         }
-    } else // handle flag diacritics
-    {
-      if (header.probe_flag(Weighted) == false)
+      else if (c > 0)
         {
-          if (displayUniqueFlag)
-            { // flags, no weights, unique analyses only
-             // return new TransducerFdUniq(f, header, alphabet);
-            } else
-            { // flags, no weights, all analyses
-             return new TransducerFd(f, header, alphabet);
-            }
+          high = middle;
         }
-      else if (header.probe_flag(Weighted) == true)
+      else
         {
-          if (displayUniqueFlag)
-            { // flags, weights, unique analyses only
-             return new TransducerWFdUniq(f, header, alphabet);
-            } else
-            { // flags, no weights, all analyses
-             return new TransducerWFd(f, header, alphabet);
+          analyses.clear();
+          for (unsigned int a = e.analyses_begin; a < e.analyses_end; ++a)
+            {
+              analyses.push_back(SymbolNumberVector(symbols + analysis_offsets[a],
+                                                    symbols + analysis_offsets[a + 1]));
             }
+          return true;
         }
     }
-    throw std::runtime_error("should not happen");
+  return false;
 }
 
-#if BUILD_HFSTOL_MAIN
-int setup(FILE * f)
+LookupSnapshot::~LookupSnapshot()
 {
-  try
-    {
-      TransducerHeader header(f);
-      TransducerAlphabet alphabet(f, header.symbol_count());
+  unmap_file(image, image_size, mapped);
+}
 
-      TransducerBase * T = instantiateTransducer(f,header, alphabet);
-      runTransducer(T);
-      delete T;
+bool TransducerTables::same_input_symbols(TransducerTables & other)
+{
+  if (header->input_symbol_count != other.header->input_symbol_count)
+    {
+      return false;
     }
-  catch (const HeaderParsingException & e)
+  for (SymbolNumber k = 0; k < header->input_symbol_count; ++k)
     {
-      std::cerr << "Invalid transducer header.\n";
-      std::cerr << "The transducer must be in optimized lookup format.\n";
-      return EXIT_FAILURE;
+      if (strcmp(symbol_string(k), other.symbol_string(k)) != 0)
+        {
+          return false;
+        }
     }
-
-  return 0;
+  return true;
 }
-#endif
 
-/**
- * BEGIN old transducer.cc
- */
+SymbolNumber TransducerTables::find_key(const char ** p)
+{
+  unsigned char c = **p;
+  if (ascii_symbols[c] != NO_SYMBOL_NUMBER)
+    {
+      ++(*p);
+      return ascii_symbols[c];
+    }
+  // Walk down the trie as far as the input goes, remembering the longest
+  // symbol seen on the way
+  SymbolNumber found = NO_SYMBOL_NUMBER;
+  const char * end = *p + 1;
+  unsigned int node = 0;
+  for (const char * q = *p; ; )
+    {
+      size_t slot = 256 * node + (unsigned char)(*q);
+      ++q;
+      if (trie_symbols[slot] != NO_SYMBOL_NUMBER)
+        {
+          found = trie_symbols[slot];
+          end = q;
+        }
+      node = trie_children[slot];
+      if (node == 0 || *q == 0)
+        {
+          break;
+        }
+    }
+  *p = end;
+  return found;
+}
 
 bool TransducerFd::PushState(FlagDiacriticOperation op)
 { // try to alter the flag diacritic state stack
@@ -777,107 +3843,45 @@ bool TransducerFd::PushState(FlagDiacriticOperation op)
   throw; // for the compiler's peace of mind
 }
 
-bool TransitionIndex::matches(SymbolNumber s)
-{
-
-  if (input_symbol == NO_SYMBOL_NUMBER)
-    {
-      return false;
-    }
-  if (s == NO_SYMBOL_NUMBER)
-    {
-      return true;
-    }
-  return input_symbol == s;
-}
-
-bool Transition::matches(SymbolNumber s)
-{
-
-  if (input_symbol == NO_SYMBOL_NUMBER)
-    {
-      return false;
-    }
-  if (s == NO_SYMBOL_NUMBER)
-    {
-      return true;
-    }
-  return input_symbol == s;
-}
-
-
-void IndexTableReader::get_index_vector(void)
-{
-  for (size_t i = 0;
-       i < number_of_table_entries;
-       ++i)
-    {
-      size_t j = i * TransitionIndex::SIZE;
-      SymbolNumber * input = (SymbolNumber*)(TableIndices + j);
-      TransitionTableIndex * index =
-        (TransitionTableIndex*)(TableIndices + j + sizeof(SymbolNumber));
-      indices.push_back(new TransitionIndex(*input,*index));
-    }
-}
-
-void TransitionTableReader::Set(TransitionTableIndex pos)
-{
-  if (pos >= TRANSITION_TARGET_TABLE_START)
-    {
-      position = pos - TRANSITION_TARGET_TABLE_START;
-    }
-  else
-    {
-      position = pos;
-    }
-}
-
-void TransitionTableReader::get_transition_vector(void)
+TransitionTableIndex symbol_run_end(const SymbolNumber * inputs,
+                                    TransitionTableIndex end,
+                                    TransitionTableIndex i,
+                                    SymbolNumber symbol)
 {
-  for (size_t i = 0; i < number_of_table_entries; ++i)
+  // Most runs are a single transition, or none
+  if (i >= end || inputs[i] != symbol)
     {
-      size_t j = i * Transition::SIZE;
-      SymbolNumber * input = (SymbolNumber*)(TableTransitions + j);
-      SymbolNumber * output =
-        (SymbolNumber*)(TableTransitions + j + sizeof(SymbolNumber));
-      TransitionTableIndex * target =
-       (TransitionTableIndex*)(TableTransitions + j + 2 * sizeof(SymbolNumber));
-      transitions.push_back(new Transition(*input,
-                                           *output,
-                                           *target));
-
+      return i;
     }
-}
-
-bool TransitionTableReader::Matches(SymbolNumber s)
-{
-  Transition * t = transitions[position];
-  return t->matches(s);
-}
-
-bool TransitionTableReader::get_finality(TransitionTableIndex i)
-{
-  if (i >= TRANSITION_TARGET_TABLE_START)
+  ++i;
+#if OL_SSE2_SCAN
+  const __m128i wanted = _mm_set1_epi16((short)symbol);
+  for (; i + 8 <= end; i += 8)
     {
-      return transitions[i - TRANSITION_TARGET_TABLE_START]->final();
+      __m128i block = _mm_loadu_si128((const __m128i*)(inputs + i));
+      if (_mm_movemask_epi8(_mm_cmpeq_epi16(block, wanted)) != 0xFFFF)
+        {
+          // the run ends in this block; the loop below finds where
+          break;
+        }
     }
-  else
+#elif !defined(OL_SCALAR_SCAN)
+  const unsigned long long wanted = symbol * 0x0001000100010001ull;
+  for (; i + 4 <= end; i += 4)
     {
-      return transitions[i]->final();
+      unsigned long long block;
+      memcpy(&block, inputs + i, sizeof(block));
+      if (block != wanted)
+        {
+          break;
+        }
     }
-}
-
-void Transducer::set_symbol_table(void)
-{
-  for(KeyTable::iterator it = keys->begin();
-      it != keys->end();
-      ++it)
+#endif
+  while (i < end && inputs[i] == symbol)
     {
-      const char * key_name =
-        it->second;
-
-      symbol_table.push_back(key_name);
+      ++i;
     }
+  return i;
 }
 
 void Transducer::try_epsilon_transitions(SymbolNumber * input_symbol,
@@ -888,14 +3892,13 @@ void Transducer::try_epsilon_transitions(SymbolNumber * input_symbol,
 #if OL_FULL_DEBUG
   std::cout << "try_epsilon_transitions " << i << std::endl;
 #endif
-  while (transitions[i]->get_input() == 0)
+  for (TransitionTableIndex end = tables->transition_run_end(i, 0); i < end; ++i)
     {
-      *output_symbol = transitions[i]->get_output();
+      *output_symbol = tables->transition_output(i);
       get_analyses(input_symbol,
                    output_symbol+1,
                    original_output_string,
-                   transitions[i]->target());
-      ++i;
+                   tables->transition_target(i));
     }
 }
 
@@ -910,44 +3913,121 @@ void TransducerFd::try_epsilon_transitions(SymbolNumber * input_symbol,
 
   while (true)
     {
-    if (transitions[i]->get_input() == 0) // epsilon
+    if (tables->transition_input(i) == 0) // epsilon
         {
-          *output_symbol = transitions[i]->get_output();
+          *output_symbol = tables->transition_output(i);
           get_analyses(input_symbol,
                        output_symbol+1,
                        original_output_string,
-                       transitions[i]->target());
+                       tables->transition_target(i));
           ++i;
-        } else if (transitions[i]->get_input() != NO_SYMBOL_NUMBER &&
-                   operations[transitions[i]->get_input()].isFlag())
+        } else if (tables->transition_input(i) != NO_SYMBOL_NUMBER &&
+                   tables->is_flag(tables->transition_input(i)))
         {
-          if (PushState(operations[transitions[i]->get_input()]))
-            {
+          try_flag_transition(input_symbol, output_symbol, original_output_string, i);
+          ++i;
+        } else
+        {
+          return;
+        }
+    }
+}
+
+void TransducerFd::try_flag_transitions(SymbolNumber * input_symbol,
+                                        SymbolNumber * output_symbol,
+                                        SymbolNumber * original_output_string,
+                                        TransitionTableIndex i)
+{
+  for (; tables->transition_input(i) != NO_SYMBOL_NUMBER; ++i)
+    {
+      if (tables->transition_input(i) == 0)
+        {
+          // in the closure already
+          continue;
+        }
+      if (!tables->is_flag(tables->transition_input(i)))
+        {
+          return;
+        }
+      try_flag_transition(input_symbol, output_symbol, original_output_string, i);
+    }
+}
+
+void TransducerFd::try_flag_transition(SymbolNumber * input_symbol,
+                                       SymbolNumber * output_symbol,
+                                       SymbolNumber * original_output_string,
+                                       TransitionTableIndex i)
+{
+  if (PushState(tables->flag_operation(tables->transition_input(i))))
+    {
 #if OL_FULL_DEBUG
-              std::cout << "flag diacritic " <<
-                symbol_table[transitions[i]->get_input()] << " allowed\n";
+      std::cout << "flag diacritic " <<
+        tables->symbol_string(tables->transition_input(i)) << " allowed\n";
 #endif
-              // flag diacritic allowed
-              *output_symbol = transitions[i]->get_output();
-              get_analyses(input_symbol,
-                           output_symbol+1,
-                           original_output_string,
-                           transitions[i]->target());
-              statestack.pop_back();
-            }
-          else
-            {
+      // flag diacritic allowed
+      *output_symbol = tables->transition_output(i);
+      get_analyses(input_symbol,
+                   output_symbol+1,
+                   original_output_string,
+                   tables->transition_target(i));
+      statestack.pop_back();
+    }
+  else
+    {
 #if OL_FULL_DEBUG
-              std::cout << "flag diacritic " <<
-                symbol_table[transitions[i]->get_input()] << " disallowed\n";
+      std::cout << "flag diacritic " <<
+        tables->symbol_string(tables->transition_input(i)) << " disallowed\n";
 #endif
-            }
-          ++i;
-        } else
+    }
+}
+
+bool Transducer::try_epsilon_closure(SymbolNumber * input_symbol,
+                                     SymbolNumber * output_symbol,
+                                     SymbolNumber * original_output_string,
+                                     TransitionTableIndex i)
+{
+  const EpsilonClosures * closures = tables->epsilon_closures();
+  if (closures == NULL || closures->begin(i) == closures->end(i))
+    {
+      return false;
+    }
+  for (const EpsilonClosures::Entry * e = closures->begin(i); e != closures->end(i); ++e)
+    {
+      const SymbolNumber * outputs = closures->entry_outputs(*e);
+      SymbolNumber * o = output_symbol;
+      for (unsigned int n = e->outputs_begin; n < e->outputs_end; ++n)
         {
-          return;
+          *o++ = *outputs++;
+        }
+      // the closure of the target is part of this one, so only the rest
+      // of its arcs are left
+      TransitionTableIndex target = e->target;
+      if (target >= TRANSITION_TARGET_TABLE_START)
+        {
+          try_flag_transitions(input_symbol, o, original_output_string,
+                               target - TRANSITION_TARGET_TABLE_START + 1);
         }
+      else if (tables->index_input(target + 1) == 0)
+        {
+          try_flag_transitions(input_symbol, o, original_output_string,
+                               tables->index_target(target + 1) -
+                               TRANSITION_TARGET_TABLE_START);
+        }
+      try_input(input_symbol, o, original_output_string, target);
+    }
+  // A closure is only made for states with epsilon arcs, so the arcs of
+  // state i always start with them
+  if (i >= TRANSITION_TARGET_TABLE_START)
+    {
+      try_flag_transitions(input_symbol, output_symbol, original_output_string,
+                           i - TRANSITION_TARGET_TABLE_START + 1);
+    }
+  else
+    {
+      try_flag_transitions(input_symbol, output_symbol, original_output_string,
+                           tables->index_target(i + 1) - TRANSITION_TARGET_TABLE_START);
     }
+  return true;
 }
 
 void Transducer::try_epsilon_indices(SymbolNumber * input_symbol,
@@ -958,12 +4038,12 @@ void Transducer::try_epsilon_indices(SymbolNumber * input_symbol,
 #if OL_FULL_DEBUG
   std::cout << "try_epsilon_indices " << i << std::endl;
 #endif
-  if (indices[i]->get_input() == 0)
+  if (tables->index_input(i) == 0)
     {
       try_epsilon_transitions(input_symbol,
                               output_symbol,
                               original_output_string,
-                              indices[i]->target() -
+                              tables->index_target(i) -
                               TRANSITION_TARGET_TABLE_START);
     }
 }
@@ -975,25 +4055,16 @@ void Transducer::find_transitions(SymbolNumber input,
                                     TransitionTableIndex i)
 {
 #if OL_FULL_DEBUG
-  std::cout << "find_transitions " << i << "\t" << transitions[i]->get_input() << std::endl;
+  std::cout << "find_transitions " << i << "\t" << tables->transition_input(i) << std::endl;
 #endif
 
-  while (transitions[i]->get_input() != NO_SYMBOL_NUMBER)
+  for (TransitionTableIndex end = tables->transition_run_end(i, input); i < end; ++i)
     {
-      if (transitions[i]->get_input() == input)
-        {
-
-          *output_symbol = transitions[i]->get_output();
-          get_analyses(input_symbol,
-                       output_symbol+1,
-                       original_output_string,
-                       transitions[i]->target());
-        }
-      else
-        {
-          return;
-        }
-      ++i;
+      *output_symbol = tables->transition_output(i);
+      get_analyses(input_symbol,
+                   output_symbol+1,
+                   original_output_string,
+                   tables->transition_target(i));
     }
 }
 
@@ -1004,15 +4075,15 @@ void Transducer::find_index(SymbolNumber input,
                             TransitionTableIndex i)
 {
 #if OL_FULL_DEBUG
-  std::cout << "find_index " << i << "\t" << indices[i+input]->get_input() << std::endl;
+  std::cout << "find_index " << i << "\t" << tables->index_input(i+input) << std::endl;
 #endif
-  if (indices[i+input]->get_input() == input)
+  if (tables->index_input(i+input) == input)
     {
       find_transitions(input,
                        input_symbol,
                        output_symbol,
                        original_output_string,
-                       indices[i+input]->target() -
+                       tables->index_target(i+input) -
                        TRANSITION_TARGET_TABLE_START);
     }
 }
@@ -1025,10 +4096,10 @@ void Transducer::note_analysis(SymbolNumber * whole_output_string)
         {
 #ifdef WINDOWS
           if (!pipe_output)
-            hfst_fprintf_console(stdout, "%s", symbol_table[*num]);
+            hfst_fprintf_console(stdout, "%s", tables->symbol_string(*num));
           else
 #endif
-            std::cout << symbol_table[*num];
+            std::cout << tables->symbol_string(*num);
         }
 
 #ifdef WINDOWS
@@ -1039,16 +4110,15 @@ void Transducer::note_analysis(SymbolNumber * whole_output_string)
         std::cout << std::endl;
     } else
     {
-      std::vector<std::string> str;
+      SymbolNumberVector analysis;
       for (SymbolNumber * num = whole_output_string; *num != NO_SYMBOL_NUMBER; ++num)
         {
-          const char* symbol = symbol_table[*num];
           // Assuming we don't care about Epsilon transitions in the output
-          if (*symbol) {
-            str.push_back(symbol);
+          if (tables->symbol_kind(*num) != Hidden) {
+            analysis.push_back(*num);
           }
         }
-      display_vector.push_back(str);
+      display_vector.push_back(analysis);
     }
 }
 
@@ -1057,7 +4127,7 @@ void TransducerUniq::note_analysis(SymbolNumber * whole_output_string)
   std::string str = "";
   for (SymbolNumber * num = whole_output_string; *num != NO_SYMBOL_NUMBER; ++num)
     {
-      str.append(symbol_table[*num]);
+      str.append(tables->symbol_string(*num));
     }
   display_vector.insert(str);
 }
@@ -1067,11 +4137,201 @@ void TransducerFdUniq::note_analysis(SymbolNumber * whole_output_string)
   std::string str = "";
   for (SymbolNumber * num = whole_output_string; *num != NO_SYMBOL_NUMBER; ++num)
     {
-      str.append(symbol_table[*num]);
+      str.append(tables->symbol_string(*num));
     }
   display_vector.insert(str);
 }
 
+void Transducer::note_batch_analysis(SymbolNumber * input_end,
+                                     SymbolNumber * whole_output_string)
+{
+  SymbolNumberVector analysis;
+  for (SymbolNumber * num = whole_output_string; *num != NO_SYMBOL_NUMBER; ++num)
+    {
+      if (tables->symbol_kind(*num) != Hidden) {
+        analysis.push_back(*num);
+      }
+    }
+  (*batch_results)[batch->row_at(input_end)].push_back(analysis);
+}
+
+void Transducer::analyze_batch(InputBatch & inputs,
+                               std::vector<AnalysisVector> & results)
+{
+  results.assign(inputs.row_count(), AnalysisVector());
+  if (inputs.row_count() == 0)
+    {
+      return;
+    }
+  batch = &inputs;
+  batch_results = &results;
+  // Every input shares the empty prefix with the first row
+  get_analyses(inputs.row(0), output_string, output_string, START_INDEX);
+  batch = NULL;
+  batch_results = NULL;
+}
+
+void Transducer::try_batch_branches(SymbolNumber * input_symbol,
+                                    SymbolNumber * output_symbol,
+                                    SymbolNumber * original_output_string,
+                                    TransitionTableIndex i,
+                                    bool transition_side)
+{
+  size_t end = batch->branch_end(input_symbol);
+  for (size_t b = batch->branch_begin(input_symbol); b < end; ++b)
+    {
+      if (transition_side)
+        {
+          find_transitions(batch->branch_symbol(b),
+                           batch->branch_target(b),
+                           output_symbol,
+                           original_output_string,
+                           i);
+        }
+      else
+        {
+          find_index(batch->branch_symbol(b),
+                     batch->branch_target(b),
+                     output_symbol,
+                     original_output_string,
+                     i);
+        }
+    }
+}
+
+bool Transducer::complete(SymbolNumber * prefix,
+                          const CompletionSearch & search,
+                          std::vector<SymbolCompletion> & results)
+{
+  results.clear();
+  completion_search = &search;
+  completion_results = &results;
+  completion_input.clear();
+  completion_steps = 0;
+  completion_truncated = false;
+  completion_depth_reached = false;
+  if (search.max_seconds > 0)
+    {
+      completion_deadline = std::chrono::steady_clock::now() +
+        std::chrono::duration_cast<std::chrono::steady_clock::duration>(
+          std::chrono::duration<double>(search.max_seconds));
+    }
+  get_analyses(prefix, output_string, output_string, START_INDEX);
+  completion_search = NULL;
+  completion_results = NULL;
+  return completion_truncated || completion_depth_reached;
+}
+
+bool Transducer::completion_stopped(void)
+{
+  if (completion_truncated)
+    {
+      return true;
+    }
+  // Reading the clock is slow next to following an arc
+  if (completion_search->max_seconds > 0 && ++completion_steps % 1024 == 0 &&
+      std::chrono::steady_clock::now() > completion_deadline)
+    {
+      completion_truncated = true;
+    }
+  return completion_truncated;
+}
+
+void Transducer::note_completion(SymbolNumber * whole_output_string)
+{
+  if (completion_stopped())
+    {
+      return;
+    }
+  const SymbolNumberVector & required = completion_search->required;
+  for (SymbolNumberVector::const_iterator it = required.begin(); it != required.end(); ++it)
+    {
+      if (std::find(completion_input.begin(), completion_input.end(), *it) ==
+          completion_input.end())
+        {
+          return;
+        }
+    }
+  if (completion_results->size() >= completion_search->max_results)
+    {
+      completion_truncated = true;
+      return;
+    }
+  SymbolCompletion completion;
+  completion.input = completion_input;
+  for (SymbolNumber * num = whole_output_string; *num != NO_SYMBOL_NUMBER; ++num)
+    {
+      if (tables->symbol_kind(*num) != Hidden) {
+        completion.output.push_back(*num);
+      }
+    }
+  completion_results->push_back(completion);
+}
+
+void Transducer::follow_completion_arc(SymbolNumber * input_symbol,
+                                       SymbolNumber * output_symbol,
+                                       SymbolNumber * original_output_string,
+                                       TransitionTableIndex i)
+{
+  SymbolNumber input = tables->transition_input(i);
+  if (input == 0 || tables->is_flag(input) || completion_search->excluded[input])
+    {
+      // epsilon and flag diacritic arcs are followed by get_analyses()
+      return;
+    }
+  if (completion_input.size() >= completion_search->max_depth ||
+      output_symbol + 1 >= original_output_string + OUTPUT_STRING_LENGTH)
+    {
+      completion_depth_reached = true;
+      return;
+    }
+  completion_input.push_back(input);
+  *output_symbol = tables->transition_output(i);
+  // the input stays at its end, so that every state on the way gets here
+  // again
+  get_analyses(input_symbol,
+               output_symbol+1,
+               original_output_string,
+               tables->transition_target(i));
+  completion_input.pop_back();
+}
+
+void Transducer::try_completion_branches(SymbolNumber * input_symbol,
+                                         SymbolNumber * output_symbol,
+                                         SymbolNumber * original_output_string,
+                                         TransitionTableIndex i,
+                                         bool transition_side)
+{
+  if (transition_side)
+    {
+      for (; tables->transition_input(i) != NO_SYMBOL_NUMBER; ++i)
+        {
+          if (completion_stopped())
+            {
+              return;
+            }
+          follow_completion_arc(input_symbol, output_symbol, original_output_string, i);
+        }
+      return;
+    }
+  for (SymbolNumber s = 1; s < tables->input_symbol_count(); ++s)
+    {
+      if (tables->index_input(i+s) != s)
+        {
+          continue;
+        }
+      for (TransitionTableIndex t = tables->index_target(i+s) - TRANSITION_TARGET_TABLE_START;
+           tables->transition_input(t) == s; ++t)
+        {
+          if (completion_stopped())
+            {
+              return;
+            }
+          follow_completion_arc(input_symbol, output_symbol, original_output_string, t);
+        }
+    }
+}
+
 void Transducer::get_analyses(SymbolNumber * input_symbol,
                               SymbolNumber * output_symbol,
                               SymbolNumber * original_output_string,
@@ -1091,14 +4351,39 @@ void Transducer::get_analyses(SymbolNumber * input_symbol,
 #if OL_FULL_DEBUG
   std::cout << "get_analyses " << i << std::endl;
 #endif
-  if (i >= TRANSITION_TARGET_TABLE_START )
+  if (state_visits != NULL)
     {
-      i -= TRANSITION_TARGET_TABLE_START;
-
-      try_epsilon_transitions(input_symbol,
+      ++(*state_visits)[i < TRANSITION_TARGET_TABLE_START ? i :
+                        tables->index_count() + (i - TRANSITION_TARGET_TABLE_START)];
+    }
+  if (!try_epsilon_closure(input_symbol, output_symbol, original_output_string, i))
+    {
+      if (i >= TRANSITION_TARGET_TABLE_START)
+        {
+          try_epsilon_transitions(input_symbol,
+                                  output_symbol,
+                                  original_output_string,
+                                  i - TRANSITION_TARGET_TABLE_START + 1);
+        }
+      else
+        {
+          try_epsilon_indices(input_symbol,
                               output_symbol,
                               original_output_string,
                               i+1);
+        }
+    }
+  try_input(input_symbol, output_symbol, original_output_string, i);
+}
+
+void Transducer::try_input(SymbolNumber * input_symbol,
+                           SymbolNumber * output_symbol,
+                           SymbolNumber * original_output_string,
+                           TransitionTableIndex i)
+{
+  if (i >= TRANSITION_TARGET_TABLE_START )
+    {
+      i -= TRANSITION_TARGET_TABLE_START;
 
 #if OL_FULL_DEBUG
       std::cout << "Testing input string on transition side, " << *input_symbol << " at pointer" << std::endl;
@@ -1110,8 +4395,19 @@ void Transducer::get_analyses(SymbolNumber * input_symbol,
           *output_symbol = NO_SYMBOL_NUMBER;
           if (final_transition(i))
             {
-              note_analysis(original_output_string);
+              if (batch)
+                note_batch_analysis(input_symbol, original_output_string);
+              else if (completion_search)
+                note_completion(original_output_string);
+              else
+                note_analysis(original_output_string);
             }
+          if (batch)
+            try_batch_branches(input_symbol, output_symbol,
+                               original_output_string, i+1, true);
+          if (completion_search)
+            try_completion_branches(input_symbol, output_symbol,
+                                    original_output_string, i+1, true);
           return;
         }
 
@@ -1123,15 +4419,13 @@ void Transducer::get_analyses(SymbolNumber * input_symbol,
                        output_symbol,
                        original_output_string,
                        i+1);
+      if (batch)
+        try_batch_branches(input_symbol - 1, output_symbol,
+                           original_output_string, i+1, true);
     }
   else
     {
 
-      try_epsilon_indices(input_symbol,
-                          output_symbol,
-                          original_output_string,
-                          i+1);
-
 #if OL_FULL_DEBUG
       std::cout << "Testing input string on index side, " << *input_symbol << " at pointer" << std::endl;
 #endif
@@ -1141,8 +4435,19 @@ void Transducer::get_analyses(SymbolNumber * input_symbol,
           *output_symbol = NO_SYMBOL_NUMBER;
           if (final_index(i))
             {
-              note_analysis(original_output_string);
+              if (batch)
+                note_batch_analysis(input_symbol, original_output_string);
+              else if (completion_search)
+                note_completion(original_output_string);
+              else
+                note_analysis(original_output_string);
             }
+          if (batch)
+            try_batch_branches(input_symbol, output_symbol,
+                               original_output_string, i+1, false);
+          if (completion_search)
+            try_completion_branches(input_symbol, output_symbol,
+                                    original_output_string, i+1, false);
           return;
         }
 
@@ -1154,6 +4459,9 @@ void Transducer::get_analyses(SymbolNumber * input_symbol,
                  output_symbol,
                  original_output_string,
                  i+1);
+      if (batch)
+        try_batch_branches(input_symbol - 1, output_symbol,
+                           original_output_string, i+1, false);
     }
   *output_symbol = NO_SYMBOL_NUMBER;
 }
@@ -1180,7 +4488,7 @@ void Transducer::printAnalyses(std::string prepend)
           return;
         }
       int i = 0;
-      DisplayVector::iterator it = display_vector.begin();
+      AnalysisVector::iterator it = display_vector.begin();
       while ( (it != display_vector.end()) && i < maxAnalyses )
         {
           if (outputType == xerox)
@@ -1198,9 +4506,9 @@ void Transducer::printAnalyses(std::string prepend)
             hfst_fprintf_console(stdout, "%s\n", it->c_str());
           else
 #endif
-            std::vector<std::string>::iterator it2 = it->begin();
+            SymbolNumberVector::iterator it2 = it->begin();
             while ( it2 != it->end() ) {
-              std::cout << *it2 << std::endl;
+              std::cout << tables->symbol_string(*it2) << std::endl;
               ++it2;
             }
 
@@ -1466,10 +4774,11 @@ void TransitionTableReaderW::get_transition_vector(void)
                                             *output,
                                             *target,
                                             *weight));
-
+      inputs.push_back(*input);
     }
   transitions.push_back(new TransitionW());
   transitions.push_back(new TransitionW());
+  inputs.resize(transitions.size(), NO_SYMBOL_NUMBER);
 }
 
 bool TransitionTableReaderW::Matches(SymbolNumber s)
@@ -1519,7 +4828,9 @@ void TransducerW::try_epsilon_transitions(SymbolNumber * input_symbol,
       return;
     }
 
-  while ((transitions[i] != NULL) && (transitions[i]->get_input() == 0))
+  TransitionTableIndex end = symbol_run_end(&transition_inputs[0],
+                                            transition_inputs.size(), i, 0);
+  for (; i < end; ++i)
     {
       *output_symbol = transitions[i]->get_output();
       current_weight += transitions[i]->get_weight();
@@ -1528,7 +4839,6 @@ void TransducerW::try_epsilon_transitions(SymbolNumber * input_symbol,
                    original_output_string,
                    transitions[i]->target());
       current_weight -= transitions[i]->get_weight();
-      ++i;
     }
   *output_symbol = NO_SYMBOL_NUMBER;
 }
@@ -1631,26 +4941,18 @@ void TransducerW::find_transitions(SymbolNumber input,
     return;
   }
 
-  while (transitions[i]->get_input() != NO_SYMBOL_NUMBER)
+  TransitionTableIndex end = symbol_run_end(&transition_inputs[0],
+                                            transition_inputs.size(), i, input);
+  for (; i < end; ++i)
     {
-
-      if (transitions[i]->get_input() == input)
-        {
-          current_weight += transitions[i]->get_weight();
-          *output_symbol = transitions[i]->get_output();
-          get_analyses(input_symbol,
-                       output_symbol+1,
-                       original_output_string,
-                       transitions[i]->target());
-          current_weight -= transitions[i]->get_weight();
-        }
-      else
-        {
-          return;
-        }
-      ++i;
+      current_weight += transitions[i]->get_weight();
+      *output_symbol = transitions[i]->get_output();
+      get_analyses(input_symbol,
+                   output_symbol+1,
+                   original_output_string,
+                   transitions[i]->target());
+      current_weight -= transitions[i]->get_weight();
     }
-
 }
 
 void TransducerW::find_index(SymbolNumber input,
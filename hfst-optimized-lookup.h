@@ -41,16 +41,22 @@
 #endif
 #endif
 
+#include <algorithm>
+#include <atomic>
 #include <vector>
 #include <map>
+#include <memory>
+#include <mutex>
 #include <set>
 #include <cstdlib>
 #include <climits>
 #include <cstring>
 #include <cassert>
+#include <chrono>
 #include <ctime>
 #include <iostream>
 #include <sstream>
+#include <stdexcept>
 #include <string>
 #include <time.h>
 
@@ -73,9 +79,6 @@ const StateIdNumber NO_ID_NUMBER = UINT_MAX;
 const SymbolNumber NO_SYMBOL_NUMBER = USHRT_MAX;
 const TransitionTableIndex NO_TABLE_INDEX = UINT_MAX;
 
-class TransitionIndex;
-class Transition;
-
 // the flag diacritic operators as given in
 // Beesley & Karttunen, Finite State Morphology (U of C Press 2003)
 enum FlagDiacriticOperator {P, N, R, D, C, U};
@@ -85,13 +88,18 @@ enum HeaderFlag {Weighted, Deterministic, Input_deterministic, Minimized,
                  Has_input_epsilon_transitions, Has_input_epsilon_cycles,
                  Has_unweighted_input_epsilon_cycles};
 
-typedef std::vector<TransitionIndex*> TransitionIndexVector;
-typedef std::vector<Transition*> TransitionVector;
-
 // This is 2^31, hopefully equal to UINT_MAX/2 rounded up.
 // For some profound reason it can't be replaced with (UINT_MAX+1)/2.
 const TransitionTableIndex TRANSITION_TARGET_TABLE_START = 2147483648u;
 
+// The first index from i on, and before end, at which inputs[] isn't
+// symbol. Compares eight entries at a time with SSE2 where available, and
+// four at a time otherwise, unless OL_SCALAR_SCAN is defined.
+TransitionTableIndex symbol_run_end(const SymbolNumber * inputs,
+                                    TransitionTableIndex end,
+                                    TransitionTableIndex i,
+                                    SymbolNumber symbol);
+
 class HeaderParsingException: public std::exception
 {
 public:
@@ -326,6 +334,10 @@ typedef std::vector<FlagDiacriticState> FlagDiacriticStateStack;
 #if BUILD_HFSTOL_MAIN
 // GLOBAL FUNCTION, TODO: SUBSUME IN MAIN FOR SINGLE-FILE VERSION
 int setup(FILE * f);
+
+// Load the transducer from f and answer lookups from clients of the
+// --server socket
+int serve(FILE * f);
 #endif
 
 /*
@@ -335,190 +347,295 @@ int setup(FILE * f);
 typedef std::vector<std::vector<std::string> > DisplayVector;
 typedef std::set<std::string> DisplaySet;
 
-class TransitionIndex
+// Analyses as sequences of output symbol numbers, leaving out symbols
+// that aren't displayed (epsilon and flag diacritics)
+typedef std::vector<SymbolNumberVector> AnalysisVector;
+
+// How a symbol shows up in analyses; worked out once, when loading
+enum SymbolKind {Hidden, Lexical, Multichar};
+
+typedef std::pair<SymbolNumberVector, size_t> NumberedInput;
+
+/*
+ * A batch of tokenized inputs, laid out so that inputs sharing a prefix
+ * are looked up together.
+ *
+ * The distinct inputs are sorted and stored back to back, each one
+ * terminated by NO_SYMBOL_NUMBER, so a pointer into the buffer is an
+ * ordinary input string as far as the traversal is concerned. Inputs
+ * sharing a prefix are only followed along the first of them; a branch
+ * records a position where a later input leaves that path, and where in
+ * the buffer its own continuation is.
+ */
+class InputBatch
 {
-protected:
-    SymbolNumber input_symbol;
-    TransitionTableIndex first_transition_index;
+private:
+    SymbolNumberVector symbols;
+    std::vector<size_t> row_starts;
+    std::vector<std::vector<size_t> > row_ids;
+
+    // branches leaving position p are branches[branch_offsets[p]] up to
+    // branches[branch_offsets[p+1]]
+    std::vector<size_t> branch_offsets;
+    std::vector<std::pair<SymbolNumber, size_t> > branches;
 
 public:
+    // Sorts the inputs in place. The size_t of each input is an id of the
+    // caller's choosing, reported back by ids().
+    InputBatch(std::vector<NumberedInput> & inputs);
 
-    // Each TransitionIndex has an input symbol and a target index.
-    static const size_t SIZE =
-        sizeof(SymbolNumber) + sizeof(TransitionTableIndex);
+    size_t row_count(void)
+        { return row_starts.size(); }
 
-    TransitionIndex(SymbolNumber input,
-                    TransitionTableIndex first_transition):
-        input_symbol(input),
-        first_transition_index(first_transition)
-        {}
+    SymbolNumber * row(size_t r)
+        { return &symbols[row_starts[r]]; }
 
-    bool matches(SymbolNumber s);
+    size_t row_at(const SymbolNumber * p);
 
-    TransitionTableIndex target(void)
-        {
-            return first_transition_index;
-        }
+    // the ids of the inputs that tokenized to row r
+    const std::vector<size_t> & ids(size_t r)
+        { return row_ids[r]; }
 
-    bool final(void)
-        {
-            return first_transition_index == 1;
-        }
+    size_t branch_begin(const SymbolNumber * p)
+        { return branch_offsets[p - &symbols[0]]; }
 
-    SymbolNumber get_input(void)
-        {
-            return input_symbol;
-        }
+    size_t branch_end(const SymbolNumber * p)
+        { return branch_offsets[p - &symbols[0] + 1]; }
+
+    SymbolNumber branch_symbol(size_t b)
+        { return branches[b].first; }
+
+    SymbolNumber * branch_target(size_t b)
+        { return &symbols[branches[b].second]; }
 };
 
-class Transition
+class EpsilonClosures;
+
+// How long each phase of loading a transducer took, in the order they ran
+struct LoadProfile
 {
-protected:
-    SymbolNumber input_symbol;
-    SymbolNumber output_symbol;
+    // phase name and seconds
+    std::vector<std::pair<std::string, double> > phases;
+};
 
-    TransitionTableIndex target_index;
+/*
+ * The tables of an unweighted transducer, laid out for lookup.
+ *
+ * Everything is kept in a single image: the index and transition tables
+ * with one array per field, the symbol strings, the symbol kinds, the
+ * flag diacritic operations and the tokenizer. The image is either built
+ * in memory from an .hfstol file, or is a compiled transducer written by
+ * save() and mapped into memory as it is, without any parsing.
+ *
+ * The tables aren't changed after loading, so any number of Transducers
+ * can share them.
+ */
+class TransducerTables
+{
+public:
+    // The sections of the image, in the order they're laid out in
+    enum Section {IndexInputs, IndexTargets,
+                  TransitionInputs, TransitionOutputs, TransitionTargets,
+                  SymbolOffsets, SymbolPool, SymbolKinds,
+                  FlagOperators, FlagFeatures, FlagValues,
+                  AsciiSymbols, TrieChildren, TrieSymbols,
+                  SECTION_COUNT};
+
+    // Each section starts at a multiple of this many bytes
+    static const size_t ALIGNMENT = 64;
+
+    static const unsigned int BYTE_ORDER_MARK = 0x01020304u;
+    static const unsigned int FORMAT_VERSION = 2;
+
+    // The first bytes of the image. Compiled transducers are only read
+    // on machines with the byte order and type sizes they were written
+    // with; byte_order and header_size catch the others.
+    struct Header
+    {
+        char magic[8];
+        unsigned int byte_order;
+        unsigned int version;
+        unsigned int header_size;
+        // bit n is set if HeaderFlag n is
+        unsigned int properties;
+        SymbolNumber symbol_count;
+        SymbolNumber input_symbol_count;
+        SymbolNumber flag_feature_count;
+        SymbolNumber unused;
+        TransitionTableIndex index_count;
+        TransitionTableIndex transition_count;
+        unsigned int trie_node_count;
+        unsigned int symbol_pool_size;
+        // The transition table entries before this one belong to the
+        // states visited while profiling, if the tables were reordered()
+        unsigned int hot_transition_count;
+        unsigned int section_offsets[SECTION_COUNT];
+        unsigned int image_size;
+    };
+
+private:
+    enum Storage {Allocated, Mapped};
+
+    char * image;
+    size_t image_size;
+    Storage storage;
+
+    const Header * header;
+    const SymbolNumber * index_inputs;
+    const TransitionTableIndex * index_targets;
+    const SymbolNumber * transition_inputs;
+    const SymbolNumber * transition_outputs;
+    const TransitionTableIndex * transition_targets;
+    const unsigned int * symbol_offsets;
+    const char * symbol_pool;
+    const unsigned char * symbol_kinds;
+    const unsigned char * flag_operators;
+    const SymbolNumber * flag_features;
+    const ValueNumber * flag_values;
+    const SymbolNumber * ascii_symbols;
+    // The tokenizer trie has 256 slots per node, one for each byte.
+    // trie_symbols[256*n + c] is the symbol spelled by the path to node n
+    // followed by c, and trie_children[256*n + c] the node continuing that
+    // path; 0, the root, for none.
+    const unsigned int * trie_children;
+    const SymbolNumber * trie_symbols;
+
+    // NULL unless compute_epsilon_closures() was called
+    EpsilonClosures * closures;
+
+    TransducerTables(char * image, size_t image_size, Storage storage);
+
+    void release(void);
+
+    template<class T> const T * section(Section s)
+        {
+            return reinterpret_cast<const T*>(image + header->section_offsets[s]);
+        }
 
 public:
+    static const char MAGIC[8];
 
-    // Each transition has an input symbol an output symbol and
-    // a target index.
-    static const size_t SIZE =
-        2 * sizeof(SymbolNumber) + sizeof(TransitionTableIndex);
+    // Whether f, positioned at its start, holds a compiled transducer.
+    // Leaves f where it was.
+    static bool is_compiled(FILE * f);
 
-    Transition(SymbolNumber input,
-               SymbolNumber output,
-               TransitionTableIndex target):
-        input_symbol(input),
-        output_symbol(output),
-        target_index(target)
-        {}
+    // Build the tables of an unweighted .hfstol transducer whose header
+    // and alphabet have already been read from f. If profile isn't NULL,
+    // the time taken is added to it.
+    static TransducerTables * from_hfstol(FILE * f,
+                                          TransducerHeader & header,
+                                          TransducerAlphabet & alphabet,
+                                          LoadProfile * profile = NULL);
 
-    bool matches(SymbolNumber s);
+    // Load a compiled transducer, mapping it into memory where possible
+    static TransducerTables * load(FILE * f);
 
-    TransitionTableIndex target(void)
-        {
-            return target_index;
-        }
+    // Write the image out as a compiled transducer
+    void save(const char * path);
 
-    SymbolNumber get_output(void)
-        {
-            return output_symbol;
-        }
+    ~TransducerTables();
 
-    SymbolNumber get_input(void)
-        {
-            return input_symbol;
-        }
+    bool probe_flag(HeaderFlag flag)
+        { return (header->properties >> flag) & 1; }
 
-    bool final(void)
-        {
-            return target_index == 1;
-        }
-};
+    SymbolNumber symbol_count(void)
+        { return header->symbol_count; }
 
-class IndexTableReader
-{
-private:
-    TransitionTableIndex number_of_table_entries;
-    char * TableIndices;
-    TransitionIndexVector indices;
-    size_t table_size;
+    SymbolNumber flag_feature_count(void)
+        { return header->flag_feature_count; }
 
-    void get_index_vector(void);
-public:
-    IndexTableReader(FILE * f,
-                     TransitionTableIndex index_count):
-        number_of_table_entries(index_count)
-        {
-            table_size = number_of_table_entries*TransitionIndex::SIZE;
-            TableIndices = (char*)(malloc(table_size));
+    TransitionTableIndex index_count(void)
+        { return header->index_count; }
 
-            // This dummy variable is needed, since the compiler complains
-            // for not catching the return value of fread().
-            int dummy_number_of_bytes;
+    TransitionTableIndex transition_count(void)
+        { return header->transition_count; }
 
-            dummy_number_of_bytes = fread(TableIndices,table_size,1,f);
-            (void)dummy_number_of_bytes;
-            get_index_vector();
-        }
+    SymbolNumber input_symbol_count(void)
+        { return header->input_symbol_count; }
 
-    bool get_finality(TransitionTableIndex i)
-        {
-            return indices[i]->final();
-        }
+    unsigned int trie_node_count(void)
+        { return header->trie_node_count; }
 
-    TransitionIndex * at(TransitionTableIndex i)
-        {
-            return indices[i];
-        }
+    size_t size(void)
+        { return image_size; }
 
-    TransitionIndexVector &operator() (void)
-        { return indices; }
-};
+    // Whether the image is a compiled transducer file mapped into memory,
+    // whose pages the system can share between processes
+    bool is_mapped(void)
+        { return storage == Mapped; }
 
-class TransitionTableReader
-{
-protected:
-    TransitionTableIndex number_of_table_entries;
-    char * TableTransitions;
-    TransitionVector transitions;
-    size_t table_size;
-    size_t transition_size;
+    static const char * section_name(Section s);
 
-    TransitionTableIndex position;
+    // Bytes taken up by a section, not counting alignment
+    size_t section_bytes(Section s);
 
-    void get_transition_vector(void);
-public:
-    TransitionTableReader(FILE * f,
-                          TransitionTableIndex transition_count):
-        number_of_table_entries(transition_count),
-        position(0)
-        {
-            table_size = number_of_table_entries*Transition::SIZE;
-            TableTransitions = (char*)(malloc(table_size));
-            int bytes;
-            bytes = fread(TableTransitions,table_size,1,f);
-            (void)bytes;
-            get_transition_vector();
+    // A copy of the tables with the states of both the index table and the
+    // transition table laid out from the most visited to the least, for
+    // better cache locality, and hot_transition_count set. state_visits
+    // counts the visits to each state, indexed like
+    // Transducer::count_state_visits() does.
+    TransducerTables * reordered(const std::vector<unsigned int> & state_visits);
 
-        }
+    // Ask the system to bring the pages of a mapped image into memory now,
+    // rather than on the first lookup to touch each one: all of them but
+    // those of the transition table beyond hot_transition_count, if set
+    void prefault(void);
 
-    void Set(TransitionTableIndex pos);
+    // Work out the epsilon closure of every state, for Transducers to use
+    // instead of following epsilon arcs one by one. Call it before any
+    // Transducer uses the tables.
+    void compute_epsilon_closures(void);
 
-    Transition * at(TransitionTableIndex i)
-        {
-            return transitions[i - TRANSITION_TARGET_TABLE_START];
-        }
+    const EpsilonClosures * epsilon_closures(void)
+        { return closures; }
 
-    void Next(void)
-        {
-            ++position;
-        }
+    SymbolNumber index_input(TransitionTableIndex i)
+        { return index_inputs[i]; }
 
-    bool Matches(SymbolNumber s);
+    TransitionTableIndex index_target(TransitionTableIndex i)
+        { return index_targets[i]; }
 
-    TransitionTableIndex get_target(void)
-        {
-            return transitions[position]->target();
-        }
+    bool index_final(TransitionTableIndex i)
+        { return index_targets[i] == 1; }
 
-    SymbolNumber get_output(void)
-        {
-            return transitions[position]->get_output();
-        }
+    SymbolNumber transition_input(TransitionTableIndex i)
+        { return transition_inputs[i]; }
 
-    SymbolNumber get_input(void)
-        {
-            return transitions[position]->get_input();
-        }
+    // The end of the run of transitions from i on with input symbol s
+    TransitionTableIndex transition_run_end(TransitionTableIndex i, SymbolNumber s)
+        { return symbol_run_end(transition_inputs, header->transition_count, i, s); }
 
-    bool get_finality(TransitionTableIndex i);
+    SymbolNumber transition_output(TransitionTableIndex i)
+        { return transition_outputs[i]; }
+
+    TransitionTableIndex transition_target(TransitionTableIndex i)
+        { return transition_targets[i]; }
+
+    bool transition_final(TransitionTableIndex i)
+        { return transition_targets[i] == 1; }
 
-    TransitionVector &operator() (void)
+    const char * symbol_string(SymbolNumber s)
+        { return symbol_pool + symbol_offsets[s]; }
+
+    SymbolKind symbol_kind(SymbolNumber s)
+        { return static_cast<SymbolKind>(symbol_kinds[s]); }
+
+    bool is_flag(SymbolNumber s)
+        { return flag_features[s] != NO_SYMBOL_NUMBER; }
+
+    FlagDiacriticOperation flag_operation(SymbolNumber s)
         {
-            return transitions;
+            return FlagDiacriticOperation(
+                static_cast<FlagDiacriticOperator>(flag_operators[s]),
+                flag_features[s], flag_values[s]);
         }
+
+    // Read the longest input symbol at *p and move *p past it
+    SymbolNumber find_key(const char ** p);
+
+    // Whether other has the same input symbols, so that find_key() reads
+    // the same symbol numbers from any input in both
+    bool same_input_symbols(TransducerTables & other);
 };
 
 class TransducerBase
@@ -531,41 +648,152 @@ public:
     virtual ~TransducerBase() {};
 };
 
+/*
+ * For each state, the states reachable from it through input epsilon arcs
+ * alone, along with the output symbols of the arcs on the way there, so
+ * that lookups can skip straight to them instead of following the arcs
+ * one at a time at every visit.
+ *
+ * A closure lists the states in the order a depth-first walk of the arcs
+ * finishes with them, so that lookups find analyses in the same order
+ * either way. Flag diacritic arcs aren't part of closures, since whether
+ * they can be followed depends on the flags set so far. States whose
+ * closure would be too large, or infinite because of an epsilon cycle,
+ * get an empty closure, and their arcs are followed one by one as usual.
+ */
+class EpsilonClosures
+{
+public:
+    struct Entry
+    {
+        TransitionTableIndex target;
+        // the outputs on the way are outputs[outputs_begin] up to
+        // outputs[outputs_end]
+        unsigned int outputs_begin;
+        unsigned int outputs_end;
+    };
+
+    // No closure gets more entries than this
+    static const size_t MAX_CLOSURE_SIZE = 256;
+
+private:
+    TransitionTableIndex index_count;
+    // The closure of the state with key k is entries[offsets[k]] up to
+    // entries[offsets[k+1]]
+    std::vector<unsigned int> offsets;
+    std::vector<Entry> entries;
+    SymbolNumberVector outputs;
+
+    size_t key(TransitionTableIndex state) const
+        {
+            return state < TRANSITION_TARGET_TABLE_START ?
+                state : index_count + (state - TRANSITION_TARGET_TABLE_START);
+        }
+
+public:
+    EpsilonClosures(TransducerTables & tables);
+
+    const Entry * begin(TransitionTableIndex state) const
+        { return entries.data() + offsets[key(state)]; }
+
+    const Entry * end(TransitionTableIndex state) const
+        { return entries.data() + offsets[key(state) + 1]; }
+
+    const SymbolNumber * entry_outputs(const Entry & e) const
+        { return outputs.data() + e.outputs_begin; }
+
+    // Bytes of memory taken up
+    size_t size(void) const;
+};
+
+// What Transducer::complete() looks for
+struct CompletionSearch
+{
+    // input symbols consumed after the prefix
+    size_t max_depth;
+    size_t max_results;
+    // no deadline if zero
+    double max_seconds;
+    // arcs consuming symbol s aren't followed if excluded[s]
+    std::vector<bool> excluded;
+    // every completion consumes all of these after the prefix
+    SymbolNumberVector required;
+};
+
+// The input a completion consumes after the prefix, and its whole output
+struct SymbolCompletion
+{
+    SymbolNumberVector input;
+    SymbolNumberVector output;
+};
+
 class Transducer: public TransducerBase
 {
 protected:
-    TransducerHeader header;
-    TransducerAlphabet alphabet;
-    KeyTable * keys;
-    IndexTableReader index_reader;
-    TransitionTableReader transition_reader;
-    Encoder encoder;
-    DisplayVector display_vector;
+    TransducerTables * tables;
+    bool owns_tables;
+    AnalysisVector display_vector;
 
     SymbolNumber * output_string;
 
     static const TransitionTableIndex START_INDEX = 0;
 
-    std::vector<const char*> symbol_table;
+    // set only while analyze_batch() runs
+    InputBatch * batch;
+    std::vector<AnalysisVector> * batch_results;
 
-    TransitionIndexVector &indices;
+    virtual void note_analysis(SymbolNumber * whole_output_string);
 
-    TransitionVector &transitions;
+    void note_batch_analysis(SymbolNumber * input_end,
+                             SymbolNumber * whole_output_string);
 
-    void set_symbol_table(void);
+    // NULL unless counting state visits
+    std::vector<unsigned int> * state_visits;
 
-    virtual void note_analysis(SymbolNumber * whole_output_string);
+    // set only while complete() runs
+    const CompletionSearch * completion_search;
+    std::vector<SymbolCompletion> * completion_results;
+    SymbolNumberVector completion_input;
+    std::chrono::steady_clock::time_point completion_deadline;
+    size_t completion_steps;
+    // the search stops once a limit other than the depth is reached
+    bool completion_truncated;
+    bool completion_depth_reached;
+
+    void note_completion(SymbolNumber * whole_output_string);
 
     bool final_transition(TransitionTableIndex i)
         {
-            return transitions[i]->final();
+            return tables->transition_final(i);
         }
 
     bool final_index(TransitionTableIndex i)
         {
-            return indices[i]->final();
+            return tables->index_final(i);
         }
 
+    void try_batch_branches(SymbolNumber * input_symbol,
+                            SymbolNumber * output_symbol,
+                            SymbolNumber * original_output_string,
+                            TransitionTableIndex i,
+                            bool transition_side);
+
+    // Follow every arc leaving the state whose arcs start at i, whatever
+    // its input symbol, once the prefix is consumed
+    void try_completion_branches(SymbolNumber * input_symbol,
+                                 SymbolNumber * output_symbol,
+                                 SymbolNumber * original_output_string,
+                                 TransitionTableIndex i,
+                                 bool transition_side);
+
+    void follow_completion_arc(SymbolNumber * input_symbol,
+                               SymbolNumber * output_symbol,
+                               SymbolNumber * original_output_string,
+                               TransitionTableIndex i);
+
+    // Whether the search has to stop, counting a step towards the deadline
+    bool completion_stopped(void);
+
     void try_epsilon_indices(SymbolNumber * input_symbol,
                              SymbolNumber * output_symbol,
                              SymbolNumber * original_output_string,
@@ -576,6 +804,28 @@ protected:
                                          SymbolNumber * original_output_string,
                                          TransitionTableIndex i);
 
+    // Follow the precomputed epsilon closure of state i, if it has one,
+    // and the flag diacritic arcs leaving it
+    bool try_epsilon_closure(SymbolNumber * input_symbol,
+                             SymbolNumber * output_symbol,
+                             SymbolNumber * original_output_string,
+                             TransitionTableIndex i);
+
+    // Follow the flag diacritic arcs among the epsilon arcs starting at
+    // transition i, but not the epsilon arcs themselves
+    virtual void try_flag_transitions(SymbolNumber *,
+                                      SymbolNumber *,
+                                      SymbolNumber *,
+                                      TransitionTableIndex)
+        {}
+
+    // Consume the next input symbol from state i, or note an analysis if
+    // the input has ended
+    void try_input(SymbolNumber * input_symbol,
+                   SymbolNumber * output_symbol,
+                   SymbolNumber * original_output_string,
+                   TransitionTableIndex i);
+
     void find_index(SymbolNumber input,
                     SymbolNumber * input_symbol,
                     SymbolNumber * output_symbol,
@@ -595,34 +845,35 @@ protected:
 
 
 public:
-    Transducer(FILE * f, TransducerHeader h, TransducerAlphabet a):
-        header(h),
-        alphabet(a),
-        keys(alphabet.get_key_table()),
-        index_reader(f,header.index_table_size()),
-        transition_reader(f,header.target_table_size()),
-        encoder(keys,header.input_symbol_count()),
+    // If owns is true, the tables are deleted along with the transducer
+    Transducer(TransducerTables * t, bool owns):
+        tables(t),
+        owns_tables(owns),
         display_vector(),
-        output_string((SymbolNumber*)(malloc(2000))),
-        indices(index_reader()),
-        transitions(transition_reader())
+        output_string((SymbolNumber*)(malloc(OUTPUT_STRING_LENGTH * sizeof(SymbolNumber)))),
+        batch(NULL),
+        batch_results(NULL),
+        state_visits(NULL),
+        completion_search(NULL),
+        completion_results(NULL),
+        completion_input(),
+        completion_deadline(),
+        completion_steps(0),
+        completion_truncated(false),
+        completion_depth_reached(false)
         {
-            for (int i = 0; i < 1000; ++i)
+            for (size_t i = 0; i < OUTPUT_STRING_LENGTH; ++i)
             {
                 output_string[i] = NO_SYMBOL_NUMBER;
             }
-            set_symbol_table();
         }
 
-
-    KeyTable * get_key_table(void)
-        {
-            return keys;
-        }
+    // The longest output, in symbols, including the end marker
+    static const size_t OUTPUT_STRING_LENGTH = 1000;
 
     SymbolNumber find_next_key(const char ** p)
         {
-            return encoder.find_key(p);
+            return tables->find_key(p);
         }
 
     void analyze(SymbolNumber * input_string)
@@ -631,13 +882,51 @@ public:
             get_analyses(input_string,output_string,output_string,START_INDEX);
         }
 
-    const DisplayVector get_display_vector() {
+    // While visits isn't NULL, count every visit to state i in
+    // (*visits)[i] for index table states, and in
+    // (*visits)[index_count + i - TRANSITION_TARGET_TABLE_START] for
+    // transition table ones. The vector has to be big enough for all.
+    void count_state_visits(std::vector<unsigned int> * visits)
+        {
+            state_visits = visits;
+        }
+
+    // Analyze every input of the batch in one traversal, walking each
+    // shared prefix only once. results[r] receives the analyses of row r.
+    void analyze_batch(InputBatch & inputs,
+                       std::vector<AnalysisVector> & results);
+
+    // Find what the input can continue with after prefix, up to the limits
+    // of search, and the outputs of the whole input. Returns true if a
+    // limit cut the search short.
+    bool complete(SymbolNumber * prefix,
+                  const CompletionSearch & search,
+                  std::vector<SymbolCompletion> & results);
+
+    const AnalysisVector & get_analysis_vector() {
         return display_vector;
     }
 
+    const char * symbol_string(SymbolNumber s)
+        {
+            return tables->symbol_string(s);
+        }
+
+    SymbolKind symbol_kind(SymbolNumber s)
+        {
+            return tables->symbol_kind(s);
+        }
+
     void printAnalyses(std::string prepend);
 
-    virtual ~Transducer() {}
+    virtual ~Transducer()
+        {
+            free(output_string);
+            if (owns_tables)
+            {
+                delete tables;
+            }
+        }
 };
 
 class TransducerUniq: public Transducer
@@ -646,8 +935,8 @@ private:
     DisplaySet display_vector;
     void note_analysis(SymbolNumber * whole_output_string);
 public:
-    TransducerUniq(FILE * f, TransducerHeader h, TransducerAlphabet a):
-        Transducer(f, h, a),
+    TransducerUniq(TransducerTables * t, bool owns):
+        Transducer(t, owns),
         display_vector()
         {}
 
@@ -657,20 +946,29 @@ public:
 class TransducerFd: public Transducer
 {
     FlagDiacriticStateStack statestack;
-    OperationVector operations;
 
     void try_epsilon_transitions(SymbolNumber * input_symbol,
                                  SymbolNumber * output_symbol,
                                  SymbolNumber * original_output_string,
                                  TransitionTableIndex i);
 
+    void try_flag_transitions(SymbolNumber * input_symbol,
+                              SymbolNumber * output_symbol,
+                              SymbolNumber * original_output_string,
+                              TransitionTableIndex i);
+
+    // Follow the flag diacritic arc at transition i, if the flags allow it
+    void try_flag_transition(SymbolNumber * input_symbol,
+                             SymbolNumber * output_symbol,
+                             SymbolNumber * original_output_string,
+                             TransitionTableIndex i);
+
     bool PushState(FlagDiacriticOperation op);
 
 public:
-    TransducerFd(FILE * f, TransducerHeader h, TransducerAlphabet a):
-        Transducer(f, h, a),
-        statestack(1, FlagDiacriticState (a.get_state_size(), 0)),
-        operations(a.get_operation_vector())
+    TransducerFd(TransducerTables * t, bool owns):
+        Transducer(t, owns),
+        statestack(1, FlagDiacriticState (t->flag_feature_count(), 0))
         {}
 };
 
@@ -680,8 +978,8 @@ private:
     DisplaySet display_vector;
     void note_analysis(SymbolNumber * whole_output_string);
 public:
-    TransducerFdUniq(FILE * f, TransducerHeader h, TransducerAlphabet a):
-        TransducerFd(f, h, a),
+    TransducerFdUniq(TransducerTables * t, bool owns):
+        TransducerFd(t, owns),
         display_vector()
         {}
 
@@ -862,6 +1160,8 @@ private:
     TransitionTableIndex number_of_table_entries;
     char * TableTransitions;
     TransitionWVector transitions;
+    // the input symbols of transitions, for scanning runs of them
+    SymbolNumberVector inputs;
     size_t table_size;
 
     TransitionTableIndex position;
@@ -917,6 +1217,11 @@ public:
         {
             return transitions;
         }
+
+    SymbolNumberVector &input_symbols(void)
+        {
+            return inputs;
+        }
 };
 
 class TransducerW: public TransducerBase
@@ -941,6 +1246,8 @@ protected:
 
     TransitionWVector &transitions;
 
+    SymbolNumberVector &transition_inputs;
+
     Weight current_weight;
 
     void set_symbol_table(void);
@@ -1003,6 +1310,7 @@ public:
         display_map(),
         indices(index_reader()),
         transitions(transition_reader()),
+        transition_inputs(transition_reader.input_symbols()),
         current_weight(0.0)
         {
             output_string.resize(1000, NO_SYMBOL_NUMBER);
@@ -1052,6 +1360,17 @@ class TransducerWFd: public TransducerW
                                  SymbolNumber * original_output_string,
                                  TransitionTableIndex i);
 
+    void try_flag_transitions(SymbolNumber * input_symbol,
+                              SymbolNumber * output_symbol,
+                              SymbolNumber * original_output_string,
+                              TransitionTableIndex i);
+
+    // Follow the flag diacritic arc at transition i, if the flags allow it
+    void try_flag_transition(SymbolNumber * input_symbol,
+                             SymbolNumber * output_symbol,
+                             SymbolNumber * original_output_string,
+                             TransitionTableIndex i);
+
     bool PushState(FlagDiacriticOperation op);
 
 
@@ -1080,6 +1399,9 @@ public:
 
 TransducerBase * instantiateTransducer(FILE * f, TransducerHeader& header, TransducerAlphabet& alphabet);
 
+// If owns_tables is true, the transducer deletes the tables when it's deleted
+TransducerBase * instantiateTransducer(TransducerTables * tables, bool owns_tables);
+
 class TransducerNotFoundException: public std::exception
 {
 public:
@@ -1119,25 +1441,588 @@ public:
     }
 };
 
+// Write the unweighted .hfstol transducer at source to destination as a
+// compiled transducer, which TransducerFile loads without any parsing. If
+// profile_words isn't empty, they're looked up first, and the states their
+// lookups visit most are packed together at the start of the tables.
+void compile_transducer(const char * source, const char * destination,
+                        const std::vector<std::string> & profile_words =
+                        std::vector<std::string>());
+
+// An analysis split into the multicharacter symbols before the first
+// lexical one, the lexical symbols, and the multicharacter symbols after.
+struct LemmaAnalysis
+{
+    std::vector<std::string> prefixes;
+    std::string lemma;
+    std::vector<std::string> suffixes;
+    // false if a lexical symbol came after a suffix; those lexical symbols
+    // are still added to the lemma
+    bool contiguous;
+};
+
+// Ways of rewriting an input that has no analyses, to find the analyses
+// of a differently written variant of it. They are fixed folds over a few
+// Unicode blocks, not Unicode normalization or case mapping: anything
+// outside those blocks is left as it is.
+enum InputRule
+{
+    // Combine an ASCII letter and a following combining grave, acute,
+    // circumflex, tilde, macron, diaeresis or cedilla into one of the
+    // accented letters of Latin-1 and Latin Extended-A, where there is
+    // one. Unlike Unicode NFC, leaves every other sequence alone, such as
+    // those making letters of Latin Extended Additional.
+    COMPOSE_LATIN,
+    // Split those accented letters into the letter and combining accent
+    DECOMPOSE_LATIN,
+    // Lowercase the letters of Basic Latin, Latin-1, Latin Extended-A,
+    // and the basic Greek and Cyrillic alphabets
+    LOWERCASE,
+    // Swap vowels with a circumflex for ones with a macron (â to ā), or the
+    // other way round
+    CIRCUMFLEX_TO_MACRON,
+    MACRON_TO_CIRCUMFLEX
+};
+
+// Rules have names like "compose-latin" and "macron-to-circumflex"
+InputRule input_rule_from_name(const std::string & name);
+const char * input_rule_name(InputRule rule);
+std::string apply_input_rule(InputRule rule, const std::string & input);
+
+// The variant of an input that was found, the rules applied to the input
+// to get it, and its analyses
+struct VariantLookup
+{
+    std::string variant;
+    std::vector<InputRule> rules;
+    std::vector<std::vector<std::string> > analyses;
+};
+
+// Limits on TransducerFile::complete(), with tags named by their symbols
+struct CompletionLimits
+{
+    // the most input symbols to consume after the prefix
+    size_t max_depth;
+    size_t max_results;
+    // no time limit if zero
+    double max_seconds;
+    // completions have to consume all of these after the prefix
+    std::vector<std::string> require;
+    // completions can't consume any of these after the prefix
+    std::vector<std::string> exclude;
+
+    CompletionLimits():
+        max_depth(16),
+        max_results(1000),
+        max_seconds(0),
+        require(),
+        exclude()
+        {}
+};
+
+// The rest of an input after the prefix, and the output of the whole input
+struct Completion
+{
+    std::vector<std::string> input;
+    std::vector<std::string> output;
+};
+
+struct Completions
+{
+    std::vector<Completion> completions;
+    // whether a limit cut the search short, so there may be more
+    bool truncated;
+};
+
+// The memory taken up by a TransducerFile
+struct MemoryUsage
+{
+    // whether the tables are mapped in from a compiled transducer
+    bool mapped;
+    // bytes taken up by each part
+    std::vector<std::pair<std::string, size_t> > structures;
+    // the number of entries in the transducer's tables
+    std::vector<std::pair<std::string, size_t> > counts;
+    size_t total;
+};
+
+// The analyses of a batch of inputs in columns, laid out the way Arrow and
+// NumPy like them. Analysis a is an analysis of input word_index[a]; its
+// symbols are symbols[symbol_offsets[a]] up to symbols[symbol_offsets[a+1]],
+// and its UTF-8 text is text[text_offsets[a]] up to text[text_offsets[a+1]].
+struct AnalysisColumns
+{
+    std::vector<long long> word_index;
+    std::vector<long long> symbol_offsets;
+    std::vector<SymbolNumber> symbols;
+    std::vector<long long> text_offsets;
+    std::vector<char> text;
+};
+
+// A histogram, as TransducerFile::metrics() reports it. counts[b] values
+// were at most bounds[b] and more than bounds[b-1]; the last count, one
+// more than there are bounds, is of the values above every bound.
+struct Histogram
+{
+    std::vector<double> bounds;
+    std::vector<unsigned long long> counts;
+    unsigned long long count;
+    double sum;
+};
+
+// An input that took at least the slow lookup threshold to look up
+struct SlowLookup
+{
+    std::string method;
+    std::string input;
+    double seconds;
+    size_t analyses;
+};
+
+struct LookupMetrics
+{
+    // seconds taken, by lookup method
+    std::vector<std::pair<std::string, Histogram> > latencies;
+    // analyses per input looked up
+    Histogram analyses;
+    // the most recent slow lookups, oldest first
+    std::vector<SlowLookup> slow_lookups;
+    unsigned long long slow_lookup_count;
+
+    // In the Prometheus text exposition format, with metric names
+    // starting with prefix
+    std::string prometheus(const std::string & prefix) const;
+};
+
+// Counts lookups into histograms with atomic counters, so that recording
+// never waits for a lock, except for slow lookups, which are rare and go
+// into a ring buffer.
+class LookupRecorder
+{
+public:
+    enum Method
+    {
+        LOOKUP,
+        LOOKUP_LEMMA_WITH_AFFIXES,
+        LOOKUP_VARIANTS,
+        BULK_LOOKUP,
+        COMPLETE,
+        METHOD_COUNT
+    };
+
+    // 1µs, 2µs, 4µs and so on up to about 17s, then the rest
+    static const size_t LATENCY_BUCKETS = 26;
+    // 0, 1, 2, 4 and so on up to 512 analyses, then the rest
+    static const size_t ANALYSES_BUCKETS = 12;
+
+    typedef std::chrono::steady_clock::time_point TimePoint;
+
+private:
+    std::atomic<bool> enabled;
+    std::atomic<unsigned long long> latency_counts[METHOD_COUNT][LATENCY_BUCKETS];
+    std::atomic<unsigned long long> latency_nanoseconds[METHOD_COUNT];
+    std::atomic<unsigned long long> analyses_counts[ANALYSES_BUCKETS];
+    std::atomic<unsigned long long> analyses_sum;
+
+    std::atomic<unsigned long long> slow_nanoseconds;
+    std::atomic<unsigned long long> slow_count;
+    std::mutex slow_mutex;
+    std::vector<SlowLookup> slow_lookups;
+    size_t slow_capacity;
+    // where the next slow lookup goes once slow_lookups is full
+    size_t slow_next;
+
+    void note_latency(Method m, unsigned long long nanoseconds);
+
+public:
+    LookupRecorder();
+
+    static const char * method_name(Method m);
+
+    // Start or stop recording. Lookups taking at least slow_seconds are
+    // kept, the last slow_log_size of them.
+    void configure(bool enable, double slow_seconds, size_t slow_log_size);
+
+    // Forget everything recorded so far
+    void reset(void);
+
+    // When a lookup starts; TimePoint() if not recording
+    TimePoint start(void)
+        {
+            if (!enabled.load(std::memory_order_relaxed))
+                {
+                    return TimePoint();
+                }
+            return std::chrono::steady_clock::now();
+        }
+
+    // A lookup of one input that started at began
+    void finish(Method m, TimePoint began, const char * input, size_t analyses);
+
+    // A lookup of many inputs that started at began; the analyses of each
+    // are counted with count_analyses()
+    void finish(Method m, TimePoint began);
+
+    void count_analyses(size_t analyses);
+
+    LookupMetrics metrics(void);
+};
+
+/*
+ * The analyses of a transducer's most frequently looked-up inputs, saved
+ * to a file so that a freshly started process can answer those lookups
+ * straight away, before the pages of the transducer's tables it needs
+ * have been touched. Like a compiled transducer, the file is mapped into
+ * memory where possible. It records a hash of the transducer file it was
+ * made from, and isn't loaded for any other transducer. So that loading
+ * it doesn't have to read all of the transducer file, it also records the
+ * file's Stamp; the whole file is only hashed when that doesn't match,
+ * such as when the file was copied.
+ */
+class LookupSnapshot
+{
+public:
+    // Cheaply tells transducer files apart: by size, modification time
+    // and a hash of their first HEAD_BYTES bytes
+    struct Stamp
+    {
+        unsigned long long size;
+        long long mtime;
+        unsigned long long head_hash;
+    };
+
+    static const size_t HEAD_BYTES = 65536;
+
+    struct Header
+    {
+        char magic[8];
+        unsigned int byte_order;
+        unsigned int version;
+        // 64-bit FNV-1a of the whole transducer file
+        unsigned long long transducer_hash;
+        Stamp transducer_stamp;
+        unsigned int entry_count;
+        unsigned int analysis_count;
+        unsigned int symbol_count;
+        unsigned int key_bytes;
+    };
+
+    // The input is keys[key_offset] up to keys[key_offset + key_length],
+    // and its analyses are analyses_begin up to analyses_end; analysis a
+    // is symbols[analysis_offsets[a]] up to symbols[analysis_offsets[a+1]].
+    // Entries are sorted by input, byte by byte.
+    struct Entry
+    {
+        unsigned int key_offset;
+        unsigned int key_length;
+        unsigned int analyses_begin;
+        unsigned int analyses_end;
+    };
+
+    static const char MAGIC[8];
+    static const unsigned int FORMAT_VERSION = 2;
+
+private:
+    char * image;
+    size_t image_size;
+    bool mapped;
+
+    const Header * header;
+    const Entry * entries;
+    const unsigned int * analysis_offsets;
+    const SymbolNumber * symbols;
+    const char * keys;
+
+    LookupSnapshot(char * image, size_t image_size, bool mapped);
+
+    LookupSnapshot(const LookupSnapshot &);
+    LookupSnapshot & operator=(const LookupSnapshot &);
+
+public:
+    static Stamp stamp(FILE * transducer);
+
+    // The hash of all of transducer, which is left at its start
+    static unsigned long long content_hash(FILE * transducer);
+
+    // Throws std::runtime_error if the snapshot at path can't be read, is
+    // corrupt, or wasn't made from transducer, an open transducer file
+    // with this stamp and symbol_count symbols
+    static LookupSnapshot * load(const char * path, FILE * transducer,
+                                 const Stamp & transducer_stamp,
+                                 SymbolNumber symbol_count);
+
+    // Write a snapshot where inputs[n] has the analyses analyses[n], for
+    // transducer, an open transducer file with this stamp
+    static void save(const char * path, FILE * transducer,
+                     const Stamp & transducer_stamp,
+                     const std::vector<std::string> & inputs,
+                     const std::vector<AnalysisVector> & analyses);
+
+    // If input is in the snapshot, set analyses to its analyses and return
+    // true
+    bool find(const char * input, AnalysisVector & analyses) const;
+
+    size_t entry_count(void) const
+        {
+            return header->entry_count;
+        }
+
+    // Bytes of memory taken up
+    size_t size(void) const
+        {
+            return image_size;
+        }
+
+    ~LookupSnapshot();
+};
+
 class TransducerFile
 {
+    friend class TransducerCascade;
+
 protected:
-    std::string path;
-    File file;
-    TransducerHeader header;
-    TransducerAlphabet alphabet;
-    TransducerBase* transducer;
+    // Everything loaded from one transducer file. Each lookup holds on to
+    // the one current when it started, so that reload() can switch to
+    // another without waiting for lookups in progress; the old one is
+    // deleted once the last of them finishes.
+    class Loaded
+    {
+    private:
+        Loaded(const Loaded &);
+        Loaded & operator=(const Loaded &);
+
+        // Every lookup needs a Transducer of its own, so that lookups can
+        // run in different threads at once; these are the ones not in use,
+        // all sharing the tables.
+        std::vector<Transducer*> idle_transducers;
+        std::mutex idle_transducers_mutex;
+
+    public:
+        std::string path;
+        SymbolNumber number_of_symbols;
+        // NULL for weighted transducers, which only have the one transducer
+        TransducerTables * tables;
+        TransducerBase* transducer;
+
+        LoadProfile profile;
+
+        // NULL unless a snapshot was loaded
+        LookupSnapshot * snapshot;
+
+        Loaded(const char* p, bool epsilon_closures, const char* snapshot_path,
+               bool prefault);
+        ~Loaded();
+
+        // The transducer file's, as it was when loaded
+        LookupSnapshot::Stamp stamp;
+
+        Transducer * acquire_transducer(void);
+        void release_transducer(Transducer * t);
+        size_t idle_transducer_count(void);
+
+        bool tokenize(const char * input_string, SymbolNumberVector & input);
+        std::vector<std::string> symbol_strings(const SymbolNumberVector & analysis);
+
+        // Throws std::invalid_argument if there's no such symbol
+        SymbolNumber symbol_number(const std::string & symbol);
+
+        // Look one input up, in the snapshot if it's there
+        void analyze(const char * input_string, AnalysisVector & analyses);
+
+        // Look up all the inputs in one pass, repeated inputs only once.
+        // The analyses of input n are analyses[rows[n]], or rows[n] is
+        // NO_ROW if the input couldn't be tokenized.
+        void analyze_inputs(const std::vector<std::string>& input_strings,
+                            std::vector<AnalysisVector> & analyses,
+                            std::vector<size_t> & rows);
+
+        // Like analyze_inputs(), for inputs already tokenized, numbered
+        // from 0 up to input_count. Sorts inputs in place.
+        void analyze_tokenized(std::vector<NumberedInput> & inputs,
+                               size_t input_count,
+                               std::vector<AnalysisVector> & analyses,
+                               std::vector<size_t> & rows);
+    };
+
+    // An idle Transducer, held on to for as long as the lease is in scope
+    class Lease
+    {
+    private:
+        Loaded & loaded;
+        Transducer * t;
+
+        Lease(const Lease &);
+        Lease & operator=(const Lease &);
+    public:
+        Lease(Loaded & l):
+            loaded(l),
+            t(l.acquire_transducer())
+            {}
+
+        ~Lease()
+            {
+                loaded.release_transducer(t);
+            }
+
+        Transducer * operator->(void)
+            {
+                return t;
+            }
+    };
+
+    // the options to load with again on reload()
+    bool with_epsilon_closures;
+    bool with_prefault;
+
+    std::shared_ptr<Loaded> loaded;
+    std::mutex loaded_mutex;
+
+    // The transducer to use for a lookup starting now
+    std::shared_ptr<Loaded> current(void);
+
+    std::atomic<bool> counting_hits;
+    std::map<std::string, size_t> hits;
+    std::mutex hits_mutex;
+
+    void count_hit(const char * input_string);
+
+    LookupRecorder recorder;
+
+    static const size_t NO_ROW;
 
 public:
-    TransducerFile(const char* p);
+    // p is either an .hfstol file or a compiled transducer. With
+    // epsilon_closures, the epsilon closures of unweighted transducers are
+    // worked out while loading, for faster lookups. If snapshot isn't NULL,
+    // the inputs in the snapshot saved there are looked up in the snapshot
+    // instead of the transducer. With prefault, the pages of a compiled
+    // transducer's hot states are read in while loading.
+    TransducerFile(const char* p, bool epsilon_closures = false,
+                   const char* snapshot = NULL, bool prefault = false);
+
+    // The lookup functions can be called from several threads at once
 
     std::vector<std::vector<std::string> > lookup(const char* input_string);
 
-    int symbol_count() {
-        return header.symbol_count();
-    }
+    std::vector<LemmaAnalysis> lookup_lemma_with_affixes(const char* input_string);
 
-    ~TransducerFile() {
-        delete transducer;
-    }
+    // Like lookup(), but if the input has no analyses, try variants of it
+    // made with the rules until one does. Returns the input itself, with
+    // no analyses, if none of them do.
+    VariantLookup lookup_variants(const char* input_string,
+                                  const std::vector<InputRule>& rules);
+
+    // Like lookup(), for many inputs at once; inputs with a common prefix
+    // share the work of looking it up. The results are in input order.
+    std::vector<std::vector<std::vector<std::string> > > bulk_lookup(
+        const std::vector<std::string>& input_strings);
+
+    // Every way the input prefix can continue to be accepted, with the
+    // outputs, found in one walk of the transducer from where the prefix
+    // leads. With a generator, a lemma and its part-of-speech tags give the
+    // lemma's whole paradigm. Throws std::invalid_argument if a tag to
+    // require or exclude isn't a symbol of the transducer.
+    Completions complete(const char* prefix, const CompletionLimits& limits);
+
+    // Like bulk_lookup(), with the results in columns
+    void bulk_lookup_columns(const std::vector<std::string>& input_strings,
+                             AnalysisColumns & columns);
+
+    // Load the transducer at p, or at the same path again if p is NULL,
+    // with the options this one was loaded with, and switch to it. Lookups
+    // can go on in other threads meanwhile: those that start after the
+    // switch use the new transducer, and those already running finish on
+    // the old one, which is freed after them. The old snapshot goes with
+    // the old transducer; snapshot is loaded along with the new one if it
+    // isn't NULL. If loading fails, the old transducer stays.
+    void reload(const char* p = NULL, const char* snapshot = NULL);
+
+    // Save a snapshot of the analyses of inputs, for loading along with
+    // this transducer later
+    void save_snapshot(const char* snapshot_path,
+                       const std::vector<std::string>& inputs);
+
+    // Number of inputs in the loaded snapshot, if any
+    size_t snapshot_entry_count(void);
+
+    // While enabled, count how many times each input is looked up, to
+    // choose the inputs to save snapshots of
+    void set_hit_counting(bool enabled);
+
+    // The inputs looked up while counting, most often looked up first
+    std::vector<std::pair<std::string, size_t> > hit_counts(void);
+
+    // While enabled, time every lookup and count the analyses of every
+    // input, keeping the last slow_log_size inputs that took at least
+    // slow_seconds. lookup() and bulk_lookup_columns() count as lookup and
+    // bulk_lookup, as they do the same work.
+    void set_metrics(bool enabled, double slow_seconds = 0.01,
+                     size_t slow_log_size = 100);
+
+    // What was recorded while metrics were enabled
+    LookupMetrics metrics(void);
+
+    void reset_metrics(void);
+
+    // The symbol strings, indexed by symbol number
+    std::vector<std::string> symbol_table(void);
+
+    int symbol_count(void);
+
+    // Bytes of memory taken up by the epsilon closures, if any
+    size_t epsilon_closures_size(void);
+
+    MemoryUsage memory_usage(void);
+
+    LoadProfile load_profile(void);
+};
+
+// An analysis found by a TransducerCascade, with the stage that found it
+struct CascadeAnalysis
+{
+    size_t stage;
+    std::vector<std::string> symbols;
+};
+
+// Looks inputs up in several transducers in turn, such as a strict
+// analyzer, then a relaxed one, then a guesser. Each stage looks up the
+// inputs that reach it as a TransducerFile::bulk_lookup() would: from its
+// snapshot if it has one, counting hits, and recording metrics.
+class TransducerCascade
+{
+public:
+    enum Policy
+    {
+        // Stop at the first stage with any analyses
+        FIRST_NONEMPTY,
+        // The analyses of every stage, in stage order
+        UNION
+    };
+
+private:
+    std::vector<TransducerFile*> stages;
+    Policy policy;
+
+    // tokenizer_stages[i] is the first stage that tokenizes inputs the way
+    // stage i does, for the stages as they were loaded in tokenizers_loaded
+    std::vector<std::weak_ptr<TransducerFile::Loaded> > tokenizers_loaded;
+    std::vector<size_t> tokenizer_stages;
+    std::mutex tokenizers_mutex;
+
+    // tokenizer_stages for the stages as loaded, working it out again only
+    // if one of them has been reloaded since
+    std::vector<size_t> tokenizers_for(
+        const std::vector<std::shared_ptr<TransducerFile::Loaded> >& loaded);
+
+public:
+    // The stages must outlive the cascade
+    TransducerCascade(const std::vector<TransducerFile*>& stages, Policy policy);
+
+    std::vector<CascadeAnalysis> lookup(const char* input_string);
+
+    // Like lookup(), for many inputs at once, each stage looking up all
+    // the inputs still without analyses in one batch. The results are in
+    // input order.
+    std::vector<std::vector<CascadeAnalysis> > bulk_lookup(
+        const std::vector<std::string>& input_strings);
 };
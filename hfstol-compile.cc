@@ -0,0 +1,61 @@
+/*
+  hfstol-compile: write an .hfstol transducer out in the compiled format
+  of hfst-optimized-lookup.h, which loads without any parsing.
+
+  With --profile, the index table and transition table states are laid out
+  hottest first, going by how often looking up the words of the file visits
+  them.
+
+  Licensed under the Apache License, Version 2.0; see
+  hfst-optimized-lookup.cc.
+*/
+
+#include "hfst-optimized-lookup.h"
+
+#include <fstream>
+#include <cstring>
+
+int main(int argc, char **argv)
+{
+  const char * profile = NULL;
+  if (argc == 5 && strcmp(argv[1], "--profile") == 0)
+    {
+      profile = argv[2];
+      argv += 2;
+      argc -= 2;
+    }
+  if (argc != 3)
+    {
+      std::cerr << "Usage: " << argv[0] << " [--profile WORDS] INPUT.hfstol OUTPUT\n"
+                << "Compile an unweighted optimized-lookup transducer for fast loading.\n"
+                << "WORDS is a file of typical inputs, one per line.\n";
+      return EXIT_FAILURE;
+    }
+  try
+    {
+      std::vector<std::string> words;
+      if (profile != NULL)
+        {
+          std::ifstream in(profile);
+          if (!in)
+            {
+              throw std::runtime_error(std::string("Could not open ") + profile);
+            }
+          std::string line;
+          while (std::getline(in, line))
+            {
+              if (!line.empty())
+                {
+                  words.push_back(line);
+                }
+            }
+        }
+      compile_transducer(argv[1], argv[2], words);
+    }
+  catch (const std::exception & e)
+    {
+      std::cerr << argv[0] << ": " << e.what() << "\n";
+      return EXIT_FAILURE;
+    }
+  return EXIT_SUCCESS;
+}
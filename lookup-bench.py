@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# type: ignore
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare the lookup speed of several `hfst-optimized-lookup` builds.
+
+Each build looks up the same words in the same transducer several times,
+and the fastest run of each is reported, along with a check that all the
+builds gave the same output. For instance, to compare scanning
+transitions several at a time against one at a time:
+
+    make hfst-optimized-lookup hfst-optimized-lookup-scalar
+    ./lookup-bench.py analyzer.hfstol words.txt \\
+        ./hfst-optimized-lookup ./hfst-optimized-lookup-scalar
+"""
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import subprocess
+import sys
+import time
+
+
+def run(binary, options, fst, words):
+    began = time.perf_counter()
+    output = subprocess.run(
+        [binary, *options, fst],
+        input=words,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    ).stdout
+    return time.perf_counter() - began, output
+
+
+def main():
+    parser = ArgumentParser(
+        description=__doc__.split("\n\n")[0],
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("fst", help="the transducer to look words up in")
+    parser.add_argument("words", help="file with one word per line, or - for stdin")
+    parser.add_argument("binaries", nargs="+", help="hfst-optimized-lookup builds")
+    parser.add_argument(
+        "--runs", type=int, default=5, help="runs of each build, the fastest counts"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="times each run looks up the words"
+    )
+    parser.add_argument(
+        "--option",
+        action="append",
+        default=[],
+        dest="options",
+        help="pass an option on to every build, e.g. --option=-E",
+    )
+    args = parser.parse_args()
+
+    if args.words == "-":
+        words = sys.stdin.buffer.read()
+    else:
+        with open(args.words, "rb") as f:
+            words = f.read()
+    words = words * args.repeat
+    count = words.count(b"\n") or 1
+
+    outputs = {}
+    for binary in args.binaries:
+        best = None
+        for _ in range(args.runs):
+            elapsed, outputs[binary] = run(binary, args.options, args.fst, words)
+            best = elapsed if best is None else min(best, elapsed)
+        print(
+            f"{binary}: {count} lookups in {best:.3f}s: {count / best:.0f} lookups/s"
+        )
+
+    if len(set(outputs.values())) > 1:
+        print("The builds gave different output!", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
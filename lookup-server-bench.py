@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# type: ignore
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measure the throughput and latency of `hfst-optimized-lookup --server`.
+
+Several clients connect to the server at once, each sending the words in
+batches of --batch-size lines and waiting for all of a batch’s answers
+before sending the next one.
+
+    ./hfst-optimized-lookup --server /tmp/hfstol.sock analyzer.hfstol &
+    ./lookup-server-bench.py /tmp/hfstol.sock words.txt --clients 4
+"""
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from threading import Thread
+import socket
+import sys
+import time
+
+
+def connect(path, timeout):
+    """Connect to the server, waiting up to timeout seconds for it to start"""
+    deadline = time.monotonic() + timeout
+    while True:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(path)
+            return s
+        except (FileNotFoundError, ConnectionRefusedError):
+            s.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def run_client(path, words, batch_size, timeout, latencies):
+    with connect(path, timeout) as s:
+        reader = s.makefile("rb")
+        for start in range(0, len(words), batch_size):
+            batch = words[start : start + batch_size]
+            request = "".join(w + "\n" for w in batch).encode("UTF-8")
+
+            began = time.perf_counter()
+            # Write from another thread, so that a large batch can’t fill up
+            # the socket buffers in both directions at once
+            writer = Thread(target=s.sendall, args=(request,))
+            writer.start()
+            # Every answer ends with an empty line
+            answered = 0
+            while answered < len(batch):
+                line = reader.readline()
+                if not line:
+                    raise Exception("Server closed the connection")
+                if line == b"\n":
+                    answered += 1
+            writer.join()
+            latencies.append(time.perf_counter() - began)
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def main():
+    parser = ArgumentParser(
+        description=__doc__.split("\n\n")[0],
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("socket", help="the --server socket to connect to")
+    parser.add_argument("words", help="file with one word per line, or - for stdin")
+    parser.add_argument(
+        "--clients", type=int, default=1, help="number of concurrent clients"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=100, help="words sent per request"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="times each client sends the words"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=10,
+        help="seconds to wait for the server to start listening",
+    )
+    args = parser.parse_args()
+
+    if args.words == "-":
+        words = sys.stdin.read().splitlines()
+    else:
+        with open(args.words, encoding="UTF-8") as f:
+            words = f.read().splitlines()
+    words = words * args.repeat
+
+    latencies = []
+    clients = [
+        Thread(
+            target=run_client,
+            args=(args.socket, words, args.batch_size, args.timeout, latencies),
+        )
+        for _ in range(args.clients)
+    ]
+    began = time.perf_counter()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.perf_counter() - began
+
+    total = len(words) * args.clients
+    latencies.sort()
+    print(f"{total} lookups in {elapsed:.3f}s: {total / elapsed:.0f} lookups/s")
+    if latencies:
+        print(
+            f"batch latency: "
+            f"p50 {percentile(latencies, 0.5) * 1000:.2f}ms, "
+            f"p90 {percentile(latencies, 0.9) * 1000:.2f}ms, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.2f}ms, "
+            f"max {latencies[-1] * 1000:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
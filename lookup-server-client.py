@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# type: ignore
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Send standard input to `hfst-optimized-lookup --server` and print its answers.
+
+    ./hfst-optimized-lookup --server /tmp/hfstol.sock analyzer.hfstol &
+    printf 'atim\\nnipâw\\n' | ./lookup-server-client.py /tmp/hfstol.sock
+
+Unless --keep-open is given, the connection is half-closed once all of
+standard input is sent, so that the server answers an unterminated last
+line and then closes it. Exits with an error if the server doesn't close
+the connection within --timeout seconds.
+"""
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from threading import Thread
+import socket
+import sys
+import time
+
+
+def connect(path, timeout):
+    """Connect to the server, waiting up to timeout seconds for it to start"""
+    deadline = time.monotonic() + timeout
+    while True:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(path)
+            return s
+        except (FileNotFoundError, ConnectionRefusedError):
+            s.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def main():
+    parser = ArgumentParser(
+        description=__doc__.split("\n\n")[0],
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("socket", help="the --server socket to connect to")
+    parser.add_argument(
+        "--keep-open",
+        action="store_true",
+        help="don’t half-close the connection after sending standard input",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=10,
+        help="seconds to wait for the server to start, and then to close the connection",
+    )
+    args = parser.parse_args()
+
+    request = sys.stdin.buffer.read()
+    with connect(args.socket, args.timeout) as s:
+        s.settimeout(args.timeout)
+
+        def send():
+            try:
+                s.sendall(request)
+                if not args.keep_open:
+                    s.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass  # the server may close the connection first
+
+        # Write from another thread, so that a large request can’t fill up
+        # the socket buffers in both directions at once
+        writer = Thread(target=send)
+        writer.start()
+        try:
+            while True:
+                data = s.recv(65536)
+                if not data:
+                    break
+                sys.stdout.buffer.write(data)
+        except socket.timeout:
+            sys.exit("Server did not close the connection")
+        except ConnectionResetError:
+            pass
+        writer.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,12 @@
 #include "hfst-optimized-lookup.h"
+#include <limits>
+#include <map>
+#include <memory>
+#include <mutex>
 #include <napi.h>
+#include <sstream>
+#include <sys/stat.h>
+#include <sys/types.h>
 
 #define VALUE_TO_CSTR(v) ((v).As<Napi::String>().Utf8Value().c_str())
 
@@ -15,6 +22,95 @@ static bool isArgumentCountValid(const Napi::CallbackInfo &info,
   return true;
 }
 
+/**
+ * Every Transducer in the process, in the main thread or in any worker
+ * thread, shares one TransducerFile per file, so that a transducer is
+ * only loaded once however many workers use it. TransducerFile lookups
+ * can run in several threads at once, each with a lookup context of its
+ * own. A file is unloaded when the last Transducer using it is collected.
+ *
+ * Files are told apart by their canonical path along with their device,
+ * inode, modification time and size, so that a file replaced on disk is
+ * loaded again rather than answered from the old tables. Since the
+ * TransducerFile is shared, so are its metrics.
+ */
+static std::mutex transducer_cache_mutex;
+static std::map<std::string, std::weak_ptr<TransducerFile>> transducer_cache;
+
+static std::string canonical_path(const std::string &path) {
+#ifdef _WIN32
+  char *resolved = _fullpath(NULL, path.c_str(), 0);
+#else
+  char *resolved = realpath(path.c_str(), NULL);
+#endif
+  if (resolved == NULL) {
+    // Loading will fail with a better error message than we could give
+    return path;
+  }
+  std::string ret(resolved);
+  free(resolved);
+  return ret;
+}
+
+// The cache key of the file at path as it is now
+static std::string cache_key(const std::string &path) {
+  std::ostringstream key;
+  key << canonical_path(path);
+#ifdef _WIN32
+  struct _stat64 status;
+  if (_stat64(path.c_str(), &status) == 0) {
+#else
+  struct stat status;
+  if (stat(path.c_str(), &status) == 0) {
+#endif
+    key << '\0' << status.st_dev << ':' << status.st_ino << ':'
+        << status.st_mtime << ':' << status.st_size;
+  }
+  return key.str();
+}
+
+static std::shared_ptr<TransducerFile> load_transducer(const std::string &path) {
+  std::string key = cache_key(path);
+  std::lock_guard<std::mutex> lock(transducer_cache_mutex);
+  // Forget files no Transducer uses any more, such as replaced ones
+  for (auto it = transducer_cache.begin(); it != transducer_cache.end();) {
+    if (it->second.expired()) {
+      it = transducer_cache.erase(it);
+    } else {
+      ++it;
+    }
+  }
+  auto cached = transducer_cache[key].lock();
+  if (cached) {
+    return cached;
+  }
+  std::shared_ptr<TransducerFile> loaded(new TransducerFile(path.c_str()));
+  // If the file was replaced while loading, it isn't known which one was
+  // loaded, so it isn't shared
+  if (cache_key(path) == key) {
+    transducer_cache[key] = loaded;
+  } else {
+    transducer_cache.erase(key);
+  }
+  return loaded;
+}
+
+static Napi::Value loaded_transducer_count(const Napi::CallbackInfo &info) {
+  auto env = info.Env();
+
+  if (!isArgumentCountValid(info, 0))
+    return env.Null();
+
+  std::lock_guard<std::mutex> lock(transducer_cache_mutex);
+  size_t count = 0;
+  for (auto it = transducer_cache.begin(); it != transducer_cache.end(); ++it) {
+    if (!it->second.expired()) {
+      ++count;
+    }
+  }
+  return Napi::Number::New(env, (double)count);
+}
+
 /**
  * C++ node-addon-api wrapper for hfst-optimized-lookup
  *
@@ -26,6 +122,23 @@ static bool isArgumentCountValid(const Napi::CallbackInfo &info,
  *           ["a", "t", "i", "m", "ê", "w", "+V", "+TA", "+Imp", "+Imm",
  *            "+2Sg", "+3SgO"]
 *          ]
+ *     .lookup_lemma_with_affixes(string) => array of
+ *             [array of prefixes, lemma, array of suffixes]
+ *         example: lookup_lemma_with_affixes("kî-atimik") => [
+ *           [["PV/ki+"], "atimêw", ["+V", "+TA", "+Ind", "+4Sg/Pl", "+3SgO"]]
+ *         ]
+ *     .memory_usage() => {total, mapped, structures, counts}, with bytes by
+ *             structure and entry counts by table
+ *     .load_profile() => seconds taken by each load phase, by phase name
+ *     .set_metrics(enabled, slow_seconds, slow_log_size) => start or stop
+ *             recording lookup latencies and analyses per input
+ *     .metrics() => {latency, analyses, slow_lookups, slow_lookup_count}
+ *     .metrics_prometheus(prefix) => the metrics as Prometheus text
+ *     .reset_metrics() => forget the metrics recorded so far
+ *     .bulk_lookup_packed(array of strings) => {word_index, text_offsets,
+ *             text}, typed arrays sharing one ArrayBuffer; analysis i is of
+ *             input word_index[i], and its UTF-8 text is
+ *             text[text_offsets[i]] up to text[text_offsets[i+1]]
  */
 class TransducerWrapper : public Napi::ObjectWrap<TransducerWrapper> {
 
@@ -38,7 +151,7 @@ public:
       return;
 
     try {
-      tr = new TransducerFile(VALUE_TO_CSTR(info[0]));
+      tr = load_transducer(info[0].As<Napi::String>().Utf8Value());
     } catch (const std::exception &e) {
       throw Napi::Error::New(env, std::string(e.what()));
     }
@@ -64,8 +177,241 @@ public:
     return ret;
   }
 
+  Napi::Value lookup_lemma_with_affixes(const Napi::CallbackInfo &info) {
+    auto env = info.Env();
+
+    if (!isArgumentCountValid(info, 1))
+      return env.Null();
+
+    std::string text = info[0].As<Napi::String>().Utf8Value();
+    auto transducer_results = tr->lookup_lemma_with_affixes(text.c_str());
+
+    auto ret = Napi::Array::New(env, transducer_results.size());
+    for (size_t i = 0; i < transducer_results.size(); i++) {
+      auto &analysis = transducer_results[i];
+      if (!analysis.contiguous) {
+        Napi::Error::New(env, "Unable to parse an analysis of " + text +
+                                  " into lemma and affixes")
+            .ThrowAsJavaScriptException();
+        return env.Null();
+      }
+
+      auto prefixes = Napi::Array::New(env, analysis.prefixes.size());
+      for (size_t j = 0; j < analysis.prefixes.size(); j++) {
+        prefixes.Set((uint32_t)j, analysis.prefixes[j]);
+      }
+      auto suffixes = Napi::Array::New(env, analysis.suffixes.size());
+      for (size_t j = 0; j < analysis.suffixes.size(); j++) {
+        suffixes.Set((uint32_t)j, analysis.suffixes[j]);
+      }
+
+      auto item = Napi::Array::New(env, 3);
+      item.Set((uint32_t)0, prefixes);
+      item.Set((uint32_t)1, analysis.lemma);
+      item.Set((uint32_t)2, suffixes);
+      ret.Set((uint32_t)i, item);
+    }
+    return ret;
+  }
+
+  Napi::Value memory_usage(const Napi::CallbackInfo &info) {
+    auto env = info.Env();
+
+    if (!isArgumentCountValid(info, 0))
+      return env.Null();
+
+    MemoryUsage usage;
+    try {
+      usage = tr->memory_usage();
+    } catch (const std::exception &e) {
+      Napi::Error::New(env, e.what()).ThrowAsJavaScriptException();
+      return env.Null();
+    }
+
+    auto structures = Napi::Object::New(env);
+    for (size_t i = 0; i < usage.structures.size(); i++) {
+      structures.Set(usage.structures[i].first,
+                     Napi::Number::New(env, (double)usage.structures[i].second));
+    }
+    auto counts = Napi::Object::New(env);
+    for (size_t i = 0; i < usage.counts.size(); i++) {
+      counts.Set(usage.counts[i].first,
+                 Napi::Number::New(env, (double)usage.counts[i].second));
+    }
+
+    auto ret = Napi::Object::New(env);
+    ret.Set("total", Napi::Number::New(env, (double)usage.total));
+    ret.Set("mapped", Napi::Boolean::New(env, usage.mapped));
+    ret.Set("structures", structures);
+    ret.Set("counts", counts);
+    return ret;
+  }
+
+  Napi::Value load_profile(const Napi::CallbackInfo &info) {
+    auto env = info.Env();
+
+    if (!isArgumentCountValid(info, 0))
+      return env.Null();
+
+    auto profile = tr->load_profile();
+    auto &phases = profile.phases;
+    auto ret = Napi::Object::New(env);
+    for (size_t i = 0; i < phases.size(); i++) {
+      ret.Set(phases[i].first, Napi::Number::New(env, phases[i].second));
+    }
+    return ret;
+  }
+
+  Napi::Value set_metrics(const Napi::CallbackInfo &info) {
+    auto env = info.Env();
+
+    if (!isArgumentCountValid(info, 3))
+      return env.Null();
+    if (!info[0].IsBoolean() || !info[1].IsNumber() || !info[2].IsNumber()) {
+      Napi::TypeError::New(env, "Boolean, number and number expected")
+          .ThrowAsJavaScriptException();
+      return env.Null();
+    }
+
+    tr->set_metrics(info[0].As<Napi::Boolean>().Value(),
+                    info[1].As<Napi::Number>().DoubleValue(),
+                    (size_t)info[2].As<Napi::Number>().Int64Value());
+    return env.Undefined();
+  }
+
+  static Napi::Object histogram_object(Napi::Env env, const Histogram &h) {
+    auto buckets = Napi::Array::New(env, h.counts.size());
+    for (size_t b = 0; b < h.counts.size(); b++) {
+      auto bucket = Napi::Array::New(env, 2);
+      bucket.Set((uint32_t)0,
+                 Napi::Number::New(env, b < h.bounds.size()
+                                            ? h.bounds[b]
+                                            : std::numeric_limits<double>::infinity()));
+      bucket.Set((uint32_t)1, Napi::Number::New(env, (double)h.counts[b]));
+      buckets.Set((uint32_t)b, bucket);
+    }
+    auto ret = Napi::Object::New(env);
+    ret.Set("count", Napi::Number::New(env, (double)h.count));
+    ret.Set("sum", Napi::Number::New(env, h.sum));
+    ret.Set("buckets", buckets);
+    return ret;
+  }
+
+  Napi::Value metrics(const Napi::CallbackInfo &info) {
+    auto env = info.Env();
+
+    if (!isArgumentCountValid(info, 0))
+      return env.Null();
+
+    LookupMetrics metrics = tr->metrics();
+    auto latency = Napi::Object::New(env);
+    for (size_t i = 0; i < metrics.latencies.size(); i++) {
+      latency.Set(metrics.latencies[i].first,
+                  histogram_object(env, metrics.latencies[i].second));
+    }
+    auto slow_lookups = Napi::Array::New(env, metrics.slow_lookups.size());
+    for (size_t i = 0; i < metrics.slow_lookups.size(); i++) {
+      const SlowLookup &slow = metrics.slow_lookups[i];
+      auto item = Napi::Object::New(env);
+      item.Set("method", slow.method);
+      item.Set("input", slow.input);
+      item.Set("seconds", Napi::Number::New(env, slow.seconds));
+      item.Set("analyses", Napi::Number::New(env, (double)slow.analyses));
+      slow_lookups.Set((uint32_t)i, item);
+    }
+
+    auto ret = Napi::Object::New(env);
+    ret.Set("latency", latency);
+    ret.Set("analyses", histogram_object(env, metrics.analyses));
+    ret.Set("slow_lookups", slow_lookups);
+    ret.Set("slow_lookup_count",
+            Napi::Number::New(env, (double)metrics.slow_lookup_count));
+    return ret;
+  }
+
+  Napi::Value metrics_prometheus(const Napi::CallbackInfo &info) {
+    auto env = info.Env();
+
+    if (!isArgumentCountValid(info, 1))
+      return env.Null();
+
+    return Napi::String::New(
+        env, tr->metrics().prometheus(info[0].As<Napi::String>().Utf8Value()));
+  }
+
+  Napi::Value reset_metrics(const Napi::CallbackInfo &info) {
+    auto env = info.Env();
+
+    if (!isArgumentCountValid(info, 0))
+      return env.Null();
+
+    tr->reset_metrics();
+    return env.Undefined();
+  }
+
+  Napi::Value bulk_lookup_packed(const Napi::CallbackInfo &info) {
+    auto env = info.Env();
+
+    if (!isArgumentCountValid(info, 1))
+      return env.Null();
+    if (!info[0].IsArray()) {
+      Napi::TypeError::New(env, "Array of strings expected")
+          .ThrowAsJavaScriptException();
+      return env.Null();
+    }
+
+    auto words = info[0].As<Napi::Array>();
+    std::vector<std::string> inputs;
+    for (uint32_t i = 0; i < words.Length(); i++) {
+      Napi::Value word = words[i];
+      if (!word.IsString()) {
+        Napi::TypeError::New(env, "Array of strings expected")
+            .ThrowAsJavaScriptException();
+        return env.Null();
+      }
+      inputs.push_back(word.As<Napi::String>().Utf8Value());
+    }
+
+    AnalysisColumns columns;
+    try {
+      tr->bulk_lookup_columns(inputs, columns);
+    } catch (const std::exception &e) {
+      Napi::Error::New(env, e.what()).ThrowAsJavaScriptException();
+      return env.Null();
+    }
+
+    // One buffer for all three arrays, so that there's only one allocation
+    // for the garbage collector to track
+    size_t count = columns.word_index.size();
+    size_t index_bytes = count * sizeof(uint32_t);
+    size_t offsets_bytes = (count + 1) * sizeof(uint32_t);
+    auto buffer = Napi::ArrayBuffer::New(
+        env, index_bytes + offsets_bytes + columns.text.size());
+    uint32_t *word_index = static_cast<uint32_t *>(buffer.Data());
+    uint32_t *text_offsets = word_index + count;
+    for (size_t i = 0; i < count; i++) {
+      word_index[i] = (uint32_t)columns.word_index[i];
+    }
+    for (size_t i = 0; i <= count; i++) {
+      text_offsets[i] = (uint32_t)columns.text_offsets[i];
+    }
+    if (!columns.text.empty()) {
+      memcpy(static_cast<char *>(buffer.Data()) + index_bytes + offsets_bytes,
+             &columns.text[0], columns.text.size());
+    }
+
+    auto ret = Napi::Object::New(env);
+    ret.Set("word_index",
+            Napi::Uint32Array::New(env, count, buffer, 0));
+    ret.Set("text_offsets",
+            Napi::Uint32Array::New(env, count + 1, buffer, index_bytes));
+    ret.Set("text", Napi::Uint8Array::New(env, columns.text.size(), buffer,
+                                          index_bytes + offsets_bytes));
+    return ret;
+  }
+
 private:
-  TransducerFile *tr;
+  std::shared_ptr<TransducerFile> tr;
 };
 
 Napi::Object Init(Napi::Env env, Napi::Object exports) {
@@ -74,9 +420,28 @@ Napi::Object Init(Napi::Env env, Napi::Object exports) {
       {
           TransducerWrapper::InstanceMethod("_lookup_symbols",
                                             &TransducerWrapper::lookup_symbols),
+          TransducerWrapper::InstanceMethod(
+              "_lookup_lemma_with_affixes",
+              &TransducerWrapper::lookup_lemma_with_affixes),
+          TransducerWrapper::InstanceMethod("_memory_usage",
+                                            &TransducerWrapper::memory_usage),
+          TransducerWrapper::InstanceMethod("_load_profile",
+                                            &TransducerWrapper::load_profile),
+          TransducerWrapper::InstanceMethod(
+              "_bulk_lookup_packed", &TransducerWrapper::bulk_lookup_packed),
+          TransducerWrapper::InstanceMethod("_set_metrics",
+                                            &TransducerWrapper::set_metrics),
+          TransducerWrapper::InstanceMethod("_metrics",
+                                            &TransducerWrapper::metrics),
+          TransducerWrapper::InstanceMethod(
+              "_metrics_prometheus", &TransducerWrapper::metrics_prometheus),
+          TransducerWrapper::InstanceMethod("_reset_metrics",
+                                            &TransducerWrapper::reset_metrics),
       });
 
   exports.Set("Transducer", transducerFile);
+  exports.Set("_loaded_transducer_count",
+              Napi::Function::New(env, loaded_transducer_count));
 
   return exports;
 }
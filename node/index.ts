@@ -1,13 +1,76 @@
 import bindings from 'bindings';
 const addon = bindings('hfstol_addon');
 
+export interface MemoryUsage {
+  /** Bytes taken up altogether */
+  total: number;
+  /** Whether the tables are mapped in from a compiled transducer */
+  mapped: boolean;
+  /** Bytes taken up by each table, the epsilon closures and idle lookup buffers */
+  structures: { [structure: string]: number };
+  /** Numbers of table entries, symbols, flag features and trie nodes */
+  counts: { [table: string]: number };
+}
+
+/**
+ * A histogram of recorded values. `buckets` holds `[upper_bound, count]`
+ * pairs, not cumulative, the last with an upper bound of Infinity.
+ */
+export interface Histogram {
+  count: number;
+  sum: number;
+  buckets: [number, number][];
+}
+
+export interface SlowLookup {
+  method: string;
+  input: string;
+  seconds: number;
+  analyses: number;
+}
+
+export interface LookupMetrics {
+  /** Seconds taken, by method: `lookup`, `bulk_lookup` and so on */
+  latency: { [method: string]: Histogram };
+  /** Analyses of each input looked up */
+  analyses: Histogram;
+  /** The most recent lookups that took at least the slow threshold, oldest first */
+  slow_lookups: SlowLookup[];
+  /** How many lookups took at least the slow threshold, including those no longer kept */
+  slow_lookup_count: number;
+}
+
+/**
+ * The analyses of a batch of inputs, packed into typed arrays that share
+ * one ArrayBuffer. Analysis `i` is of input `word_index[i]`, in order, and
+ * its UTF-8 text is `text.subarray(text_offsets[i], text_offsets[i + 1])`.
+ */
+export interface PackedAnalyses {
+  word_index: Uint32Array;
+  text_offsets: Uint32Array;
+  text: Uint8Array;
+}
+
 interface CppTransducerInterface {
   new(fstFilename: string): CppTransducerInterface;
   _lookup_symbols(text: string): string[][]
+  _lookup_lemma_with_affixes(text: string): [string[], string, string[]][]
+  _memory_usage(): MemoryUsage
+  _load_profile(): { [phase: string]: number }
+  _bulk_lookup_packed(texts: string[]): PackedAnalyses
+  _set_metrics(enabled: boolean, slowSeconds: number, slowLogSize: number): void
+  _metrics(): LookupMetrics
+  _metrics_prometheus(prefix: string): string
+  _reset_metrics(): void
 }
 
 const CppTransducer = addon.Transducer as CppTransducerInterface;
 
+/**
+ * Transducers loaded from the same file share their tables, even across
+ * worker threads, so each worker can create its own Transducer without
+ * loading the file again.
+ */
 export class Transducer extends CppTransducer {
   /**
    * Apply FST to text, returning array of analyses strings.
@@ -47,36 +110,160 @@ export class Transducer extends CppTransducer {
    *    [[["PV/ki"], "atimêw", ["+V", "+TA", "+Ind", "+4Sg/Pl", "+3SgO"]]]
    */
   lookup_lemma_with_affixes(text: string) {
-    const ret: [string[], string, string[]][] = [];
-    for (const analysis of this.lookup_symbols(text)) {
-      const before = [];
-      let beforeDone = false;
-      let lemma = "";
-      let lemmaDone = false;
-      const after = [];
-
-      for (const symbol of analysis) {
-        if (symbol.length == 1) {
-          // symbol is a character
-          beforeDone = true;
-          if (lemmaDone) {
-            throw Error(`Unable to parse ${analysis} into lemma and affixes`);
-          }
-
-          lemma += symbol;
-        } else {
-          // symbol is a tag
-          if (!beforeDone) {
-            before.push(symbol);
-          } else {
-            lemmaDone = true;
-            after.push(symbol);
-          }
-        }
-      }
-
-      ret.push([before, lemma, after]);
+    if (arguments.length !== 1) {
+      throw new Error("Wrong number of arguments");
     }
-    return ret;
+    // Actual implementation is in C++
+    return this._lookup_lemma_with_affixes(text);
+  }
+
+  /**
+   * How much memory the transducer takes up: the total in bytes, whether
+   * it's mapped in from a compiled transducer, bytes by structure, and
+   * entry counts by table. Only unweighted transducers are supported.
+   */
+  memory_usage() {
+    if (arguments.length !== 0) {
+      throw new Error("Wrong number of arguments");
+    }
+    // Actual implementation is in C++
+    return this._memory_usage();
+  }
+
+  /**
+   * How many seconds each phase of loading the transducer took, by phase
+   * name, in the order they ran.
+   *
+   * E.g., load_profile() ⇒
+   *    {"header": 0.00001, "alphabet": 0.00002, "index build": 0.00001,
+   *     "table read": 0.002, "symbol tables": 0.00001}
+   */
+  load_profile() {
+    if (arguments.length !== 0) {
+      throw new Error("Wrong number of arguments");
+    }
+    // Actual implementation is in C++
+    return this._load_profile();
+  }
+
+  /**
+   * Start or stop recording how long lookups take and how many analyses
+   * they return. Recording only updates atomic counters, except for
+   * lookups that take at least slowSeconds, the last slowLogSize of which
+   * are kept with their inputs.
+   *
+   * Transducers loaded from the same file share their metrics, in every
+   * thread: enabling, disabling or resetting metrics on one does so for
+   * all of them, and metrics() reports the lookups of all of them.
+   */
+  set_metrics(enabled: boolean, slowSeconds = 0.01, slowLogSize = 100) {
+    if (arguments.length < 1 || arguments.length > 3) {
+      throw new Error("Wrong number of arguments");
+    }
+    if (slowSeconds < 0 || slowLogSize < 0) {
+      throw new Error("slowSeconds and slowLogSize must not be negative");
+    }
+    // Actual implementation is in C++
+    this._set_metrics(enabled, slowSeconds, slowLogSize);
+  }
+
+  /**
+   * What was recorded while metrics were enabled. lookup and
+   * lookup_symbols are both counted as `lookup`, and bulk_lookup and
+   * bulk_lookup_packed as `bulk_lookup`.
+   *
+   * E.g., metrics() ⇒
+   *    {latency: {lookup: {count: 1, sum: 0.000004, buckets: [[0.000001, 0], ...]}, ...},
+   *     analyses: {count: 1, sum: 2, buckets: [[0, 0], [1, 0], [2, 1], ...]},
+   *     slow_lookups: [], slow_lookup_count: 0}
+   */
+  metrics(): LookupMetrics {
+    if (arguments.length !== 0) {
+      throw new Error("Wrong number of arguments");
+    }
+    // Actual implementation is in C++
+    return this._metrics();
+  }
+
+  /**
+   * The metrics in the Prometheus text exposition format, as the
+   * `<prefix>_lookup_seconds` and `<prefix>_analyses_per_input`
+   * histograms and the `<prefix>_slow_lookups_total` counter.
+   */
+  metrics_prometheus(prefix = "hfstol") {
+    if (arguments.length > 1) {
+      throw new Error("Wrong number of arguments");
+    }
+    // Actual implementation is in C++
+    return this._metrics_prometheus(prefix);
+  }
+
+  /** Forget the metrics recorded so far. */
+  reset_metrics() {
+    if (arguments.length !== 0) {
+      throw new Error("Wrong number of arguments");
+    }
+    // Actual implementation is in C++
+    this._reset_metrics();
+  }
+
+  /**
+   * Apply FST to every text in texts, returning the analyses packed into
+   * typed arrays rather than as nested arrays of strings, which saves the
+   * garbage collector a lot of work for large batches.
+   *
+   * E.g., bulk_lookup_packed(["atim", "avocado"]) ⇒
+   *    {word_index: Uint32Array [0, 0], text_offsets: Uint32Array [0, 11, 40],
+   *     text: Uint8Array [...UTF-8 of "atim+N+A+Sgatimêw+V+TA+Imp+Imm+2Sg+3SgO"]}
+   */
+  bulk_lookup_packed(texts: string[]) {
+    if (arguments.length !== 1) {
+      throw new Error("Wrong number of arguments");
+    }
+    // Actual implementation is in C++
+    return this._bulk_lookup_packed(texts);
+  }
+
+  /**
+   * Apply FST to every text in texts, returning an array of the analyses
+   * strings of each text, in order.
+   *
+   * E.g., bulk_lookup(["atim", "avocado"]) ⇒
+   *    [["atim+N+A+Sg", "atimêw+V+TA+Imp+Imm+2Sg+3SgO"], []]
+   */
+  bulk_lookup(texts: string[]) {
+    if (arguments.length !== 1) {
+      throw new Error("Wrong number of arguments");
+    }
+    return unpackAnalyses(this.bulk_lookup_packed(texts), texts.length);
+  }
+}
+
+/**
+ * How many transducer files are loaded in the process. Every Transducer
+ * of the same file shares them, in any thread, until the file is replaced
+ * on disk.
+ */
+export function loadedTransducerCount(): number {
+  return addon._loaded_transducer_count();
+}
+
+/**
+ * Turn the packed analyses of inputCount inputs into an array of the
+ * analyses strings of each input.
+ */
+export function unpackAnalyses(packed: PackedAnalyses, inputCount: number) {
+  const decoder = new TextDecoder();
+  const ret: string[][] = [];
+  for (let n = 0; n < inputCount; n++) {
+    ret.push([]);
+  }
+  for (let i = 0; i < packed.word_index.length; i++) {
+    ret[packed.word_index[i]].push(
+      decoder.decode(
+        packed.text.subarray(packed.text_offsets[i], packed.text_offsets[i + 1])
+      )
+    );
   }
+  return ret;
 }
@@ -1,6 +1,10 @@
-const { Transducer } = require('.');
+const { Transducer, loadedTransducerCount, unpackAnalyses } = require('.');
+const fs = require('fs');
+const os = require('os');
+const path = require('path');
 const { expect } = require('chai');
 const { randomBytes } = require('crypto');
+const { Worker } = require('worker_threads');
 
 const DEFAULT_TRANSDUCER_FILE = "../crk-relaxed-analyzer-for-dictionary.hfstol";
 
@@ -59,6 +63,113 @@ describe("hfstol-addon", function () {
       expect(fst.lookup("avocado")).to.deep.equal([]);
     });
 
+    it("reports its memory usage", function () {
+      const usage = fst.memory_usage();
+      const structures = Object.values(usage.structures);
+      expect(usage.total).to.equal(structures.reduce((a, b) => a + b, 0));
+      expect(usage.structures.transition_targets).to.be.above(0);
+      expect(usage.counts.symbols).to.be.above(0);
+    });
+
+    it("reports how long loading took", function () {
+      const phases = fst.load_profile();
+      expect(Object.keys(phases)).to.include("table read");
+      for (const seconds of Object.values(phases)) {
+        expect(seconds).to.be.at.least(0);
+      }
+    });
+
+    it("records metrics when enabled", function () {
+      fst.reset_metrics();
+      fst.set_metrics(true, 0, 1);
+      try {
+        fst.lookup("atim");
+        fst.bulk_lookup(["atim", "avocado"]);
+      } finally {
+        fst.set_metrics(false);
+      }
+      const metrics = fst.metrics();
+      expect(metrics.latency.lookup.count).to.equal(1);
+      expect(metrics.latency.bulk_lookup.count).to.equal(1);
+      expect(metrics.analyses.count).to.equal(3);
+      expect(metrics.analyses.buckets[0]).to.deep.equal([0, 1]);
+      expect(metrics.slow_lookup_count).to.equal(1);
+      expect(metrics.slow_lookups[0].input).to.equal("atim");
+      expect(fst.metrics_prometheus()).to.include(
+        'hfstol_lookup_seconds_count{method="lookup"} 1\n'
+      );
+      fst.reset_metrics();
+    });
+
+    it("can look up packed batches", function () {
+      const words = ["atim", "avocado", "", "itwêwina", "atim"];
+      const packed = fst.bulk_lookup_packed(words);
+      expect(packed.word_index.buffer).to.equal(packed.text.buffer);
+      expect(packed.text_offsets.length).to.equal(packed.word_index.length + 1);
+      expect(unpackAnalyses(packed, words.length)).to.deep.equal(
+        words.map((w) => fst.lookup(w))
+      );
+      expect(fst.bulk_lookup(words)).to.deep.equal(
+        words.map((w) => fst.lookup(w))
+      );
+    });
+
+    it("can be used from worker threads", async function () {
+      const script = `
+        const { parentPort, workerData } = require('worker_threads');
+        const { Transducer, loadedTransducerCount } = require(workerData.module);
+        const fst = new Transducer(workerData.path);
+        parentPort.postMessage({
+          analyses: fst.bulk_lookup(workerData.words),
+          loaded: loadedTransducerCount(),
+        });
+      `;
+      const loaded = loadedTransducerCount();
+      const words = ["atim", "itwêwina", "avocado"];
+      const results = await Promise.all(
+        [0, 1, 2].map(
+          () =>
+            new Promise((resolve, reject) => {
+              const worker = new Worker(script, {
+                eval: true,
+                workerData: {
+                  module: __dirname,
+                  path: DEFAULT_TRANSDUCER_FILE,
+                  words,
+                },
+              });
+              worker.on("message", resolve);
+              worker.on("error", reject);
+            })
+        )
+      );
+      for (const result of results) {
+        expect(result.analyses).to.deep.equal(words.map((w) => fst.lookup(w)));
+        // the workers used the tables already loaded here
+        expect(result.loaded).to.equal(loaded);
+      }
+    });
+
+    it("loads a file again once it is replaced", function () {
+      const dir = fs.mkdtempSync(path.join(os.tmpdir(), "hfstol-"));
+      try {
+        const file = path.join(dir, "fst.hfstol");
+        fs.copyFileSync(DEFAULT_TRANSDUCER_FILE, file);
+        const old = new Transducer(file);
+        const loaded = loadedTransducerCount();
+        expect(new Transducer(file).lookup("atim")).to.deep.equal(old.lookup("atim"));
+        expect(loadedTransducerCount()).to.equal(loaded);
+
+        fs.copyFileSync(DEFAULT_TRANSDUCER_FILE, file + ".new");
+        fs.renameSync(file + ".new", file);
+        const replaced = new Transducer(file);
+        expect(loadedTransducerCount()).to.equal(loaded + 1);
+        expect(replaced.lookup("atim")).to.deep.equal(old.lookup("atim"));
+      } finally {
+        fs.rmSync(dir, { recursive: true });
+      }
+    });
+
     it("throws an error if lookup() is passed invalid args", function () {
       expect(() => fst.lookup("abc", "def")).to.throw(Error, /argument/);
       expect(() => fst.lookup(123)).to.throw(Error, /string.*expected/);
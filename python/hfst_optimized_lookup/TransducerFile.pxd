@@ -2,13 +2,118 @@
 Exposes the TransducerFile class in hfst-optimized-lookup.h to Python.
 """
 
+from libcpp cimport bool as cpp_bool
 from libcpp.string cimport string as std_string
+from libcpp.utility cimport pair
 from libcpp.vector cimport vector
 
 cdef extern from "hfst-optimized-lookup.h":
+    ctypedef unsigned short SymbolNumber
+
+    cdef cppclass LemmaAnalysis:
+        vector[std_string] prefixes
+        std_string lemma
+        vector[std_string] suffixes
+        bint contiguous
+
+    cdef enum InputRule:
+        pass
+
+    InputRule input_rule_from_name(const std_string& name) except +
+    const char* input_rule_name(InputRule rule)
+    std_string apply_input_rule(InputRule rule, const std_string& input)
+
+    cdef cppclass VariantLookup:
+        std_string variant
+        vector[InputRule] rules
+        vector[vector[std_string]] analyses
+
+    cdef cppclass CompletionLimits:
+        size_t max_depth
+        size_t max_results
+        double max_seconds
+        vector[std_string] require
+        vector[std_string] exclude
+
+    cdef cppclass Completion:
+        vector[std_string] input
+        vector[std_string] output
+
+    cdef cppclass Completions:
+        vector[Completion] completions
+        cpp_bool truncated
+
+    cdef cppclass LoadProfile:
+        vector[pair[std_string, double]] phases
+
+    cdef cppclass MemoryUsage:
+        cpp_bool mapped
+        vector[pair[std_string, size_t]] structures
+        vector[pair[std_string, size_t]] counts
+        size_t total
+
+    cdef cppclass Histogram:
+        vector[double] bounds
+        vector[unsigned long long] counts
+        unsigned long long count
+        double sum
+
+    cdef cppclass SlowLookup:
+        std_string method
+        std_string input
+        double seconds
+        size_t analyses
+
+    cdef cppclass LookupMetrics:
+        vector[pair[std_string, Histogram]] latencies
+        Histogram analyses
+        vector[SlowLookup] slow_lookups
+        unsigned long long slow_lookup_count
+        std_string prometheus(const std_string& prefix) except +
+
+    cdef cppclass AnalysisColumns:
+        vector[long long] word_index
+        vector[long long] symbol_offsets
+        vector[SymbolNumber] symbols
+        vector[long long] text_offsets
+        vector[char] text
+
     cdef cppclass TransducerFile:
         # docs on `except +`: “Without this declaration, C++ exceptions
         # originating from the constructor will not be handled by Cython.”
-        TransducerFile(const char* path) except +
+        TransducerFile(const char* path, bint epsilon_closures, const char* snapshot, bint prefault) except +
         int symbol_count() except +
+        size_t epsilon_closures_size()
+        MemoryUsage memory_usage() except +
+        LoadProfile load_profile()
+        void reload(const char* path, const char* snapshot) except + nogil
         vector[vector[std_string]] lookup(const char* input_string) except +
+        vector[LemmaAnalysis] lookup_lemma_with_affixes(const char* input_string) except +
+        VariantLookup lookup_variants(const char* input_string, const vector[InputRule]& rules) except +
+        Completions complete(const char* prefix, const CompletionLimits& limits) except + nogil
+        vector[vector[vector[std_string]]] bulk_lookup(const vector[std_string]& input_strings) except + nogil
+        void bulk_lookup_columns(const vector[std_string]& input_strings, AnalysisColumns& columns) except + nogil
+        vector[std_string] symbol_table() except +
+        void save_snapshot(const char* snapshot_path, const vector[std_string]& inputs) except + nogil
+        size_t snapshot_entry_count()
+        void set_hit_counting(cpp_bool enabled)
+        vector[pair[std_string, size_t]] hit_counts() except +
+        void set_metrics(cpp_bool enabled, double slow_seconds, size_t slow_log_size) except +
+        LookupMetrics metrics() except +
+        void reset_metrics() except +
+
+    cdef cppclass CascadeAnalysis:
+        size_t stage
+        vector[std_string] symbols
+
+    cdef enum CascadePolicy "TransducerCascade::Policy":
+        FIRST_NONEMPTY "TransducerCascade::FIRST_NONEMPTY"
+        UNION "TransducerCascade::UNION"
+
+    cdef cppclass TransducerCascade:
+        TransducerCascade(const vector[TransducerFile*]& stages, CascadePolicy policy) except +
+        vector[CascadeAnalysis] lookup(const char* input_string) except + nogil
+        vector[vector[CascadeAnalysis]] bulk_lookup(const vector[std_string]& input_strings) except + nogil
+
+    void compile_transducer(const char* source, const char* destination,
+                            const vector[std_string]& profile_words) except +
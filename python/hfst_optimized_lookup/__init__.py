@@ -1,8 +1,27 @@
 from pathlib import Path
 
-from ._types import Analysis
-from ._hfst_optimized_lookup import TransducerFile
+from ._types import Analysis, Completion, Completions, RegistryStats, VariantLookup
+from ._hfst_optimized_lookup import (
+    TransducerFile,
+    TransducerCascade,
+    AnalysisColumns,
+    compile_transducer,
+    apply_input_rule,
+)
+from ._registry import TransducerRegistry
 
-__all__ = ["TransducerFile", "Analysis"]
+__all__ = [
+    "TransducerFile",
+    "TransducerCascade",
+    "TransducerRegistry",
+    "Analysis",
+    "AnalysisColumns",
+    "Completion",
+    "Completions",
+    "RegistryStats",
+    "VariantLookup",
+    "compile_transducer",
+    "apply_input_rule",
+]
 
 __version__ = (Path(__file__).parent / "__VERSION__").read_text().strip()
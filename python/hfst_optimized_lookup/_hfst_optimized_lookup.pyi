@@ -1,13 +1,89 @@
 # typings for cython module _hfst_optimized_lookup.pyx
 import os
-from typing import Union, List, Set, Dict, Iterable
+from typing import Any, Union, List, Set, Dict, Iterable, Iterator, Literal, Optional, Tuple
 
-from ._types import Analysis
+from ._types import Analysis, Completions, VariantLookup
 
 class TransducerFile:
-    def __init__(self, path: Union[str, os.PathLike[str]]) -> None: ...
+    def __init__(
+        self,
+        path: Union[str, os.PathLike[str]],
+        epsilon_closures: bool = ...,
+        snapshot: Optional[Union[str, os.PathLike[str]]] = ...,
+        prefault: bool = ...,
+    ) -> None: ...
     def lookup(self, string: str) -> List[str]: ...
     def lookup_symbols(self, string: str) -> List[List[str]]: ...
     def lookup_lemma_with_affixes(self, string: str) -> List[Analysis]: ...
+    def lookup_variants(
+        self, string: str, rules: Iterable[str] = ...
+    ) -> VariantLookup: ...
+    def complete(
+        self,
+        prefix: str,
+        max_depth: int = ...,
+        limit: int = ...,
+        timeout: Optional[float] = ...,
+        require: Iterable[str] = ...,
+        exclude: Iterable[str] = ...,
+    ) -> Completions: ...
     def bulk_lookup(self, strings: Iterable[str]) -> Dict[str, Set[str]]: ...
+    def iter_lookup(
+        self, words: Iterable[str], batch_size: int = ..., workers: int = ...
+    ) -> Iterator[Tuple[str, List[str]]]: ...
+    def bulk_lookup_columns(self, words: Iterable[str]) -> AnalysisColumns: ...
+    def symbol_table(self) -> List[str]: ...
+    def save_snapshot(
+        self,
+        path: Union[str, os.PathLike[str]],
+        words: Optional[Iterable[str]] = ...,
+        size: int = ...,
+    ) -> None: ...
+    def snapshot_entry_count(self) -> int: ...
+    def set_hit_counting(self, enabled: bool) -> None: ...
+    def hit_counts(self) -> Dict[str, int]: ...
+    def set_metrics(
+        self, enabled: bool, slow_threshold: float = ..., slow_log_size: int = ...
+    ) -> None: ...
+    def metrics(self) -> Dict[str, Any]: ...
+    def metrics_prometheus(self, prefix: str = ...) -> str: ...
+    def reset_metrics(self) -> None: ...
     def symbol_count(self) -> int: ...
+    def epsilon_closures_size(self) -> int: ...
+    def memory_usage(self) -> Dict[str, Any]: ...
+    def load_profile(self) -> Dict[str, float]: ...
+    def reload(
+        self,
+        path: Optional[Union[str, os.PathLike[str]]] = ...,
+        snapshot: Optional[Union[str, os.PathLike[str]]] = ...,
+    ) -> None: ...
+
+class AnalysisColumns:
+    def __len__(self) -> int: ...
+    @property
+    def word_index(self) -> memoryview: ...
+    @property
+    def symbol_offsets(self) -> memoryview: ...
+    @property
+    def symbols(self) -> memoryview: ...
+    @property
+    def text_offsets(self) -> memoryview: ...
+    @property
+    def text(self) -> memoryview: ...
+class TransducerCascade:
+    transducers: Tuple[TransducerFile, ...]
+    def __init__(
+        self,
+        transducers: Iterable[TransducerFile],
+        policy: Literal["first-nonempty", "union"] = ...,
+    ) -> None: ...
+    def lookup(self, string: str) -> List[Tuple[int, str]]: ...
+    def lookup_symbols(self, string: str) -> List[Tuple[int, List[str]]]: ...
+    def bulk_lookup(self, words: Iterable[str]) -> Dict[str, List[Tuple[int, str]]]: ...
+
+def compile_transducer(
+    source: Union[str, os.PathLike[str]],
+    destination: Union[str, os.PathLike[str]],
+    words: Optional[Iterable[str]] = ...,
+) -> None: ...
+def apply_input_rule(rule: str, text: str) -> str: ...
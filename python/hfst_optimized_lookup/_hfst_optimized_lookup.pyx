@@ -1,10 +1,23 @@
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
+from cpython.buffer cimport PyBUF_WRITABLE
 from libcpp.string cimport string as std_string
 from libcpp.vector cimport vector
 
-from .TransducerFile cimport TransducerFile as CppTransducerFile
-from hfst_optimized_lookup._types import Analysis
+from .TransducerFile cimport TransducerFile as CppTransducerFile, LemmaAnalysis
+from .TransducerFile cimport AnalysisColumns as CppAnalysisColumns
+from .TransducerFile cimport MemoryUsage, Histogram, LookupMetrics
+from .TransducerFile cimport InputRule, input_rule_from_name, input_rule_name
+from .TransducerFile cimport apply_input_rule as cpp_apply_input_rule
+from .TransducerFile cimport VariantLookup as CppVariantLookup
+from .TransducerFile cimport CompletionLimits, Completions as CppCompletions
+from .TransducerFile cimport TransducerCascade as CppTransducerCascade
+from .TransducerFile cimport CascadeAnalysis, CascadePolicy, FIRST_NONEMPTY, UNION
+from .TransducerFile cimport compile_transducer as cpp_compile_transducer
+from hfst_optimized_lookup._types import Analysis, Completion, Completions, VariantLookup
 
 
 ### String utilities
@@ -21,6 +34,14 @@ cdef bytes_from_cstring(s):
         raise Exception("Passed non-string")
     return s.encode('UTF-8')
 
+cdef dict histogram_dict(const Histogram& h):
+    cdef size_t b
+    buckets = []
+    for b in range(h.counts.size()):
+        buckets.append((h.bounds[b] if b < h.bounds.size() else float("inf"), h.counts[b]))
+    return {"count": h.count, "sum": h.sum, "buckets": buckets}
+
+
 cdef public noop():
     """This public function only exists so that Cython creates a header file.
 
@@ -30,9 +51,34 @@ cdef public noop():
 
 cdef class TransducerFile:
     """
-    TransducerFile(path)
-
-    Load an ``.hfstol`` transducer file.
+    TransducerFile(path, epsilon_closures=False, snapshot=None, prefault=False)
+
+    Load an ``.hfstol`` transducer file, or a transducer compiled with
+    :py:func:`hfst_optimized_lookup.compile_transducer`, which loads faster.
+
+    With ``epsilon_closures``, the states reachable from each state through
+    input epsilon arcs alone are worked out while loading, so that lookups
+    jump straight to them instead of following the arcs one by one each
+    time. That makes lookups faster in transducers with many epsilon arcs,
+    such as analyzers emitting many tags, at the cost of loading time and
+    the memory reported by :py:meth:`epsilon_closures_size`.
+
+    With ``snapshot``, the path of a file written by
+    :py:meth:`save_snapshot`, inputs saved in the snapshot are answered
+    from it without touching the transducer, so that a freshly started
+    process serves its most frequent inputs quickly straight away. The
+    snapshot is mapped into memory where possible. A snapshot of any other
+    transducer file, including an earlier version of this one, raises an
+    exception, as does a truncated or corrupt one. Checking costs only the
+    first 64 KiB of the transducer file, as long as its size and
+    modification time haven't changed since the snapshot was saved; if the
+    file was copied, all of it is read once to make sure.
+
+    With ``prefault``, a compiled transducer is read into memory while
+    loading instead of page by page as lookups first touch it, starting
+    with the transitions that ``compile_transducer(..., words=...)`` found
+    to be used most. This makes loading slower, but keeps the first
+    lookups from waiting on the disk.
 
     >>> analyzer = TransducerFile("path/to/fst.hfst")
 
@@ -50,15 +96,26 @@ cdef class TransducerFile:
     >>> generator.bulk_lookup(["cactus+Noun+Sg", "octopus+Noun+Pl"])
     {"cactus+Noun+Sg", set(["cactuses, cacti"]), "octopus+Noun+Pl": set(["octopuses", "octopi", "octopodes"])}
 
-    :param path: the path to the .hfstol file
+    :param path: the path to the .hfstol or compiled transducer file
     :type path: str or os.PathLike
+    :param bool epsilon_closures: whether to work out epsilon closures
+    :param snapshot: the path to a snapshot of this transducer to load
+    :type snapshot: str or os.PathLike or None
+    :param bool prefault: whether to read a compiled transducer into memory
+        while loading it
     """
 
     cdef CppTransducerFile* c_tf # pointer to the C++ instance we're wrapping
 
-    def __cinit__(self, path):
+    def __cinit__(self, path, epsilon_closures=False, snapshot=None, prefault=False):
         path = os.fspath(path)
-        self.c_tf = new CppTransducerFile(bytes_from_cstring(path))
+        cdef const char* c_snapshot = NULL
+        if snapshot is not None:
+            snapshot = bytes_from_cstring(os.fspath(snapshot))
+            c_snapshot = snapshot
+        self.c_tf = new CppTransducerFile(
+            bytes_from_cstring(path), epsilon_closures, c_snapshot, prefault
+        )
 
     def symbol_count(self):
         """
@@ -70,6 +127,107 @@ cdef class TransducerFile:
         """
         return self.c_tf.symbol_count()
 
+    def epsilon_closures_size(self):
+        """
+        epsilon_closures_size() -> int
+
+        Returns the number of bytes of memory taken up by epsilon closures,
+        or 0 if the transducer was loaded without them.
+
+        :rtype: int
+        """
+        return self.c_tf.epsilon_closures_size()
+
+    def memory_usage(self):
+        """
+        memory_usage() -> dict
+
+        Returns how much memory the transducer takes up, for capacity
+        planning:
+
+        ``total``
+            bytes taken up altogether
+        ``mapped``
+            whether the tables are mapped in from a compiled transducer, in
+            which case the system can share them between processes loading
+            the same file
+        ``structures``
+            bytes taken up by each table, such as ``transition_targets`` or
+            ``trie_children``, by the epsilon closures, by the snapshot,
+            and by the buffers of lookups not currently running
+        ``counts``
+            the number of index and transition table entries, symbols,
+            input symbols, flag diacritic features, tokenizer trie nodes
+            and snapshot entries
+
+        Only unweighted transducers are supported.
+
+        :rtype: dict
+        """
+        cdef MemoryUsage usage = self.c_tf.memory_usage()
+        return {
+            "total": usage.total,
+            "mapped": usage.mapped,
+            "structures": {k.decode('UTF-8'): v for k, v in usage.structures},
+            "counts": {k.decode('UTF-8'): v for k, v in usage.counts},
+        }
+
+    def load_profile(self):
+        """
+        load_profile() -> dict[str, float]
+
+        Returns how many seconds each phase of loading the transducer took,
+        in the order they ran. Loading an ``.hfstol`` file goes through the
+        ``header``, ``alphabet``, ``index build`` (the tokenizer),
+        ``table read`` and ``symbol tables`` phases; loading a compiled
+        transducer only has ``map``. Working out epsilon closures adds an
+        ``epsilon closures`` phase, prefaulting a ``prefault`` phase, and
+        loading a snapshot a ``snapshot`` phase. After :py:meth:`reload`,
+        these are the phases of loading the new transducer.
+
+        :rtype: dict[str, float]
+        """
+        return {
+            k.decode('UTF-8'): v for k, v in self.c_tf.load_profile().phases
+        }
+
+    def reload(self, path=None, snapshot=None):
+        """
+        reload(path=None, snapshot=None)
+
+        Load the transducer at ``path``, or the file this one was loaded
+        from again if ``path`` is None, with the same ``epsilon_closures``
+        and ``prefault`` options, and switch to it.
+
+        Lookups in other threads go on while the new transducer loads, as
+        the GIL is released. Lookups that start after the switch use the
+        new transducer, and those already running finish on the old one,
+        which is freed once they are done. The snapshot of the old
+        transducer, if any, is dropped along with it; pass ``snapshot`` to
+        load one made from the new transducer. If loading fails, the
+        exception is raised and the old transducer stays in use.
+
+        To publish a new version of an analyzer without holding up the
+        thread that notices it:
+
+        >>> threading.Thread(target=analyzer.reload, args=("new.hfstol",)).start()
+
+        :param path: the path to the .hfstol or compiled transducer file
+        :type path: str or os.PathLike or None
+        :param snapshot: the path to a snapshot of the new transducer
+        :type snapshot: str or os.PathLike or None
+        """
+        cdef const char* c_path = NULL
+        cdef const char* c_snapshot = NULL
+        if path is not None:
+            path = bytes_from_cstring(os.fspath(path))
+            c_path = path
+        if snapshot is not None:
+            snapshot = bytes_from_cstring(os.fspath(snapshot))
+            c_snapshot = snapshot
+        with nogil:
+            self.c_tf.reload(c_path, c_snapshot)
+
     def lookup_symbols(self, string):
         """
         lookup_symbols(string)
@@ -118,8 +276,128 @@ cdef class TransducerFile:
             objects, or an empty list if there are no analyses.
         :rtype: list of :py:class:`hfst_optimized_lookup.Analysis`
         """
-        raw_analyses =  self.lookup_symbols(surface_form)
-        return [_parse_analysis(a) for a in raw_analyses]
+        cdef vector[LemmaAnalysis] results = self.c_tf.lookup_lemma_with_affixes(
+            bytes_from_cstring(surface_form)
+        )
+        return [
+            Analysis(
+                tuple([p.decode('UTF-8') for p in a.prefixes]),
+                a.lemma.decode('UTF-8'),
+                tuple([s.decode('UTF-8') for s in a.suffixes]),
+            )
+            for a in results
+        ]
+
+    def lookup_variants(
+        self, string, rules=("compose-latin", "lowercase", "macron-to-circumflex")
+    ):
+        """
+        lookup_variants(string, rules=("compose-latin", "lowercase", "macron-to-circumflex"))
+
+        Like ``lookup()``, but if the input has no analyses, look up variants
+        of it written differently, until one has. This all happens in a
+        single call, without going back to Python between the variants.
+
+        The variants are made by applying the rules to the input, each rule
+        after the ones before it in the list. Variants needing fewer and
+        earlier rules are tried first, and every variant is only tried once.
+        The rules are:
+
+        ``"compose-latin"``
+            combine ASCII letters and combining grave, acute, circumflex,
+            tilde, macron, diaeresis and cedilla accents into the accented
+            letters of Latin-1 and Latin Extended-A
+        ``"decompose-latin"``
+            split those accented letters into letters and combining accents
+        ``"lowercase"``
+            lowercase the letters of Basic Latin, Latin-1, Latin
+            Extended-A, and the basic Greek and Cyrillic alphabets
+        ``"circumflex-to-macron"``, ``"macron-to-circumflex"``
+            swap vowels with a circumflex (``â``) for vowels with a macron
+            (``ā``), or the other way round
+
+        These are fixed folds over those letters, not Unicode normalization
+        or case mapping. Anything else is left as it is: ``"compose-latin"``
+        doesn't turn ``m`` and a combining acute into ``ḿ`` as NFC would,
+        and ``"lowercase"`` doesn't lowercase ``Ḿ``. Normalize inputs with
+        :py:func:`unicodedata.normalize` beforehand for full coverage.
+
+        >>> analyzer.lookup_variants("Nipāw")
+        VariantLookup(variant='nipâw', rules=('lowercase', 'macron-to-circumflex'), analyses=['nipâw+V+AI+Ind+3Sg'])
+
+        :param str string: The string to lookup.
+        :param rules: the names of the rules to make variants with
+        :type rules: iterable[str]
+        :return: the variant found, the rules that made it, and its
+            analyses; or the input itself with no analyses
+        :rtype: :py:class:`hfst_optimized_lookup.VariantLookup`
+        """
+        cdef vector[InputRule] c_rules
+        for rule in rules:
+            c_rules.push_back(input_rule_from_name(bytes_from_cstring(rule)))
+        cdef CppVariantLookup result = self.c_tf.lookup_variants(
+            bytes_from_cstring(string), c_rules
+        )
+        return VariantLookup(
+            result.variant.decode('UTF-8'),
+            tuple([input_rule_name(r).decode('UTF-8') for r in result.rules]),
+            [b''.join(a).decode('UTF-8') for a in result.analyses],
+        )
+
+    def complete(
+        self, prefix, max_depth=16, limit=1000, timeout=None, require=(), exclude=()
+    ):
+        """
+        complete(prefix, max_depth=16, limit=1000, timeout=None, require=(), exclude=())
+
+        Finds every way the input can continue after ``prefix`` and still be
+        accepted, along with the output for the whole input, by walking the
+        transducer onwards from wherever ``prefix`` leads. With a generator,
+        a lemma and its part-of-speech tags give the lemma’s whole paradigm
+        in one walk, instead of looking up every possible tag combination.
+
+        Since a transducer can accept infinitely many inputs, the walk stops
+        at the limits; ``truncated`` in the result says whether any of them
+        cut it short. The GIL is released during the walk.
+
+        >>> generator.complete("atim+N+A", require=["+Sg"])
+        Completions(completions=[Completion(suffix='+Sg', output='atim'), ...], truncated=False)
+
+        :param str prefix: the start of the input
+        :param int max_depth: the most symbols to consume after the prefix
+        :param int limit: the most completions to find
+        :param timeout: the most seconds to spend, or ``None`` for no limit
+        :type timeout: float or None
+        :param require: symbols that completions must consume after the prefix
+        :type require: iterable[str]
+        :param exclude: symbols that completions must not consume after the
+            prefix; the walk doesn’t go past them, which can save a lot of time
+        :type exclude: iterable[str]
+        :raises ValueError: if a symbol to require or exclude isn’t in the
+            transducer’s alphabet
+        :rtype: :py:class:`hfst_optimized_lookup.Completions`
+        """
+        cdef CompletionLimits limits
+        limits.max_depth = max_depth
+        limits.max_results = limit
+        limits.max_seconds = 0 if timeout is None else timeout
+        for symbol in require:
+            limits.require.push_back(bytes_from_cstring(symbol))
+        for symbol in exclude:
+            limits.exclude.push_back(bytes_from_cstring(symbol))
+        cdef std_string c_prefix = bytes_from_cstring(prefix)
+        cdef CppCompletions result
+        with nogil:
+            result = self.c_tf.complete(c_prefix.c_str(), limits)
+        return Completions(
+            [
+                Completion(
+                    b''.join(c.input).decode('UTF-8'), b''.join(c.output).decode('UTF-8')
+                )
+                for c in result.completions
+            ],
+            result.truncated,
+        )
 
     def bulk_lookup(self, words):
         """
@@ -128,36 +406,562 @@ cdef class TransducerFile:
         Like ``lookup()`` but applied to multiple inputs. Useful for generating multiple
         surface forms.
 
+        All the words are looked up in a single pass through the transducer:
+        words that share a prefix, such as different inflections of the same
+        stem, only have that prefix looked up once, and repeated words are only
+        looked up once.
+
         :param words: list of words to lookup
         :type words: list[str]
         :return: a dictionary mapping words in the input to a set of its tranductions
         :rtype: dict[str, set[str]]
         """
+        words = list(words)
         ret = {}
-        for w in words:
-            ret[w] = set(self.lookup(w))
+        for w, analyses in zip(words, self._lookup_batch(words)):
+            ret[w] = set(analyses)
         return ret
 
+    def iter_lookup(self, words, batch_size=1000, workers=1):
+        """
+        iter_lookup(words, batch_size=1000, workers=1)
+
+        Like ``lookup()`` applied to each of the words in turn, as a generator
+        of ``(word, analyses)`` tuples in input order.
+
+        ``words`` can be any iterable, including one too large to fit in
+        memory, such as the lines of a corpus. It is read ``batch_size`` words
+        at a time, and each batch is looked up in a single pass like
+        ``bulk_lookup()``, so only a few batches are ever held in memory.
+
+        With more than one worker, batches are looked up in that many threads
+        at once, reading ahead of the words yielded so far by at most
+        ``workers`` batches.
+
+        The words are looked up as they are, so strip the line endings off
+        lines read from a file:
+
+        >>> with open("corpus.txt") as f:
+        ...     for word, analyses in analyzer.iter_lookup(
+        ...         line.rstrip("\\n") for line in f
+        ...     ):
+        ...         print(word, analyses)
+
+        :param words: the words to lookup
+        :type words: iterable[str]
+        :param int batch_size: how many words to look up together
+        :param int workers: how many threads to look up batches in
+        :return: a generator of ``(word, analyses)`` tuples, with analyses as
+            ``lookup()`` returns them
+        :rtype: iterator[tuple[str, list[str]]]
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+
+        words = iter(words)
+        if workers == 1:
+            while True:
+                batch = list(islice(words, batch_size))
+                if not batch:
+                    return
+                yield from zip(batch, self._lookup_batch(batch))
+
+        with ThreadPoolExecutor(workers) as executor:
+            pending = deque()
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < workers:
+                    batch = list(islice(words, batch_size))
+                    if batch:
+                        pending.append(
+                            (batch, executor.submit(self._lookup_batch, batch))
+                        )
+                    else:
+                        exhausted = True
+                if not pending:
+                    return
+                batch, future = pending.popleft()
+                yield from zip(batch, future.result())
+
+    def bulk_lookup_columns(self, words):
+        """
+        bulk_lookup_columns(words)
+
+        Like ``bulk_lookup()``, but returns the analyses in flat columns
+        instead of Python strings, for passing on to NumPy, Arrow or pandas
+        without creating a Python object per analysis. See
+        :py:class:`hfst_optimized_lookup.AnalysisColumns` for the layout.
+
+        Repeated words are only looked up once, but their analyses appear
+        once for every time the word does, so that the rows line up with
+        the input.
+
+        >>> columns = analyzer.bulk_lookup_columns(["bank", "banks"])
+        >>> import numpy
+        >>> numpy.asarray(columns.word_index)
+        array([0, 0, 1, 1])
+
+        :param words: the words to lookup
+        :type words: iterable[str]
+        :rtype: AnalysisColumns
+        """
+        cdef vector[std_string] c_words
+        for w in words:
+            c_words.push_back(bytes_from_cstring(w))
+        cdef AnalysisColumns columns = AnalysisColumns.__new__(AnalysisColumns)
+        with nogil:
+            self.c_tf.bulk_lookup_columns(c_words, columns.c_columns)
+        return columns
+
+    def symbol_table(self):
+        """
+        symbol_table()
+
+        Returns the symbol strings, indexed by symbol number, for mapping
+        the ``symbols`` column of ``bulk_lookup_columns()`` back to strings.
+
+        :rtype: list[str]
+        """
+        return [s.decode('UTF-8') for s in self.c_tf.symbol_table()]
+
+    def save_snapshot(self, path, words=None, size=10000):
+        """
+        save_snapshot(path, words=None, size=10000)
+
+        Save the analyses of up to ``size`` words to a snapshot file, to
+        pass as ``snapshot`` when loading this transducer again. The words
+        can come from a frequency list, most frequent first, or if
+        ``words`` is ``None``, from the words looked up most often since
+        :py:meth:`set_hit_counting` was enabled.
+
+        >>> analyzer.save_snapshot("analyzer.snapshot", top_words)
+        >>> analyzer = TransducerFile("analyzer.hfstol", snapshot="analyzer.snapshot")
+
+        :param path: where to write the snapshot
+        :type path: str or os.PathLike
+        :param words: the words to save, most frequent first
+        :type words: iterable[str] or None
+        :param int size: the most words to save
+        """
+        if words is None:
+            words = list(self.hit_counts())
+        cdef vector[std_string] c_words
+        for w in islice(words, size):
+            c_words.push_back(bytes_from_cstring(w))
+        cdef std_string c_path = bytes_from_cstring(os.fspath(path))
+        with nogil:
+            self.c_tf.save_snapshot(c_path.c_str(), c_words)
+
+    def snapshot_entry_count(self):
+        """
+        snapshot_entry_count() -> int
+
+        Returns the number of words in the loaded snapshot, or 0 if none
+        was loaded.
+
+        :rtype: int
+        """
+        return self.c_tf.snapshot_entry_count()
+
+    def set_hit_counting(self, enabled):
+        """
+        set_hit_counting(enabled)
+
+        While enabled, count how many times each word is looked up, for
+        :py:meth:`save_snapshot` to save the most frequent ones. Counting
+        takes a lock on every lookup, so leave it disabled if you don’t
+        need it. Disabling it keeps the counts so far.
+
+        :param bool enabled: whether to count lookups
+        """
+        self.c_tf.set_hit_counting(enabled)
+
+    def hit_counts(self):
+        """
+        hit_counts() -> dict[str, int]
+
+        Returns how many times each word was looked up while hit counting
+        was enabled, most frequent first.
+
+        :rtype: dict[str, int]
+        """
+        return {k.decode('UTF-8'): v for k, v in self.c_tf.hit_counts()}
+
+    def set_metrics(self, enabled, slow_threshold=0.01, slow_log_size=100):
+        """
+        set_metrics(enabled, slow_threshold=0.01, slow_log_size=100)
+
+        While enabled, record how long lookups take and how many analyses
+        they return, for :py:meth:`metrics`. Recording only updates atomic
+        counters, without taking a lock, except for lookups that take at
+        least ``slow_threshold`` seconds, the last ``slow_log_size`` of
+        which are kept with their inputs. Disabling metrics keeps what was
+        recorded so far.
+
+        :param bool enabled: whether to record lookups
+        :param float slow_threshold: seconds a lookup must take to be kept
+            as a slow lookup
+        :param int slow_log_size: how many slow lookups to keep
+        """
+        if slow_threshold < 0:
+            raise ValueError("slow_threshold must not be negative")
+        if slow_log_size < 0:
+            raise ValueError("slow_log_size must not be negative")
+        self.c_tf.set_metrics(enabled, slow_threshold, slow_log_size)
+
+    def metrics(self):
+        """
+        metrics() -> dict
+
+        Returns what was recorded while :py:meth:`set_metrics` was enabled:
+
+        ``latency``
+            a histogram of the seconds taken, for each of ``lookup`` (which
+            :py:meth:`lookup_symbols` is also counted as),
+            ``lookup_lemma_with_affixes``, ``lookup_variants``,
+            ``bulk_lookup`` (a whole call, including those made by
+            :py:meth:`iter_lookup` and :py:meth:`bulk_lookup_columns`) and
+            ``complete``
+        ``analyses``
+            a histogram of the number of analyses of each input looked up,
+            by any method
+        ``slow_lookups``
+            the most recent single-input lookups that took at least the
+            slow threshold, oldest first, each a dict of its ``method``,
+            ``input``, ``seconds`` and ``analyses``
+        ``slow_lookup_count``
+            how many lookups took at least the slow threshold, including
+            those no longer kept
+
+        Each histogram is a dict of its ``count``, its ``sum`` and its
+        ``buckets``, a list of ``(upper_bound, count)`` pairs, not
+        cumulative, the last with an upper bound of infinity.
+
+        :rtype: dict
+        """
+        cdef LookupMetrics m = self.c_tf.metrics()
+        cdef size_t i
+        latency = {}
+        for i in range(m.latencies.size()):
+            latency[m.latencies[i].first.decode('UTF-8')] = histogram_dict(m.latencies[i].second)
+        slow_lookups = []
+        for i in range(m.slow_lookups.size()):
+            slow_lookups.append({
+                "method": m.slow_lookups[i].method.decode('UTF-8'),
+                "input": m.slow_lookups[i].input.decode('UTF-8', 'replace'),
+                "seconds": m.slow_lookups[i].seconds,
+                "analyses": m.slow_lookups[i].analyses,
+            })
+        return {
+            "latency": latency,
+            "analyses": histogram_dict(m.analyses),
+            "slow_lookups": slow_lookups,
+            "slow_lookup_count": m.slow_lookup_count,
+        }
+
+    def metrics_prometheus(self, prefix="hfstol"):
+        """
+        metrics_prometheus(prefix="hfstol") -> str
+
+        Returns :py:meth:`metrics` in the Prometheus text exposition
+        format: the ``<prefix>_lookup_seconds`` histogram with a ``method``
+        label, the ``<prefix>_analyses_per_input`` histogram and the
+        ``<prefix>_slow_lookups_total`` counter.
+
+        :rtype: str
+        """
+        return self.c_tf.metrics().prometheus(bytes_from_cstring(prefix)).decode('UTF-8')
+
+    def reset_metrics(self):
+        """
+        reset_metrics()
+
+        Forgets everything :py:meth:`metrics` recorded so far.
+        """
+        self.c_tf.reset_metrics()
+
+    def _lookup_batch(self, words):
+        """
+        Look up a list of words in one pass, returning their analyses as
+        ``lookup()`` would, in the same order. The GIL is released while
+        looking up, so batches can be looked up in several threads at once.
+        """
+        cdef vector[std_string] c_words
+        for w in words:
+            c_words.push_back(bytes_from_cstring(w))
+        cdef vector[vector[vector[std_string]]] results
+        with nogil:
+            results = self.c_tf.bulk_lookup(c_words)
+        return [
+            [b''.join(a).decode('UTF-8') for a in analyses] for analyses in results
+        ]
+
     def __dealloc__(self):
         del self.c_tf
 
 
-def _parse_analysis(letters_and_tags):
-    prefix_tags = []
-    lemma_chars = []
-    suffix_tags = []
+CASCADE_POLICIES = {"first-nonempty": FIRST_NONEMPTY, "union": UNION}
+
+cdef class TransducerCascade:
+    """
+    TransducerCascade(transducers, policy="first-nonempty")
+
+    Look words up in several transducers in turn, such as a strict analyzer,
+    then a relaxed analyzer, then a guesser, without going back to Python
+    between them.
+
+    With the ``"first-nonempty"`` policy, a word’s analyses are those of the
+    first transducer that has any; with ``"union"``, they are the analyses
+    of every transducer, in order. Each analysis comes tagged with the
+    position in ``transducers`` of the transducer it came from.
+
+    Transducers with the same input symbols share the work of splitting the
+    input into symbols. Each transducer looks up the words that reach it as
+    its own :py:meth:`TransducerFile.bulk_lookup` would: answering from its
+    snapshot where it can, counting hits if hit counting is enabled, and
+    recording a ``bulk_lookup`` in its :py:meth:`TransducerFile.metrics`.
+
+    >>> cascade = TransducerCascade([strict, relaxed, guesser])
+    >>> cascade.lookup("tansi")
+    [(1, 'tânisi+Ipc')]
+
+    :param transducers: the transducers to look words up in, in order
+    :type transducers: list[TransducerFile]
+    :param str policy: ``"first-nonempty"`` or ``"union"``
+    """
+
+    cdef CppTransducerCascade* c_cascade
+    cdef readonly tuple transducers
+
+    def __cinit__(self, transducers, policy="first-nonempty"):
+        self.transducers = tuple(transducers)
+        if policy not in CASCADE_POLICIES:
+            raise ValueError(
+                f"policy must be one of {', '.join(map(repr, CASCADE_POLICIES))}"
+            )
+        cdef vector[CppTransducerFile*] stages
+        for tf in self.transducers:
+            if not isinstance(tf, TransducerFile):
+                raise TypeError("transducers must be TransducerFile objects")
+            stages.push_back((<TransducerFile>tf).c_tf)
+        self.c_cascade = new CppTransducerCascade(stages, CASCADE_POLICIES[policy])
+
+    def lookup_symbols(self, string):
+        """
+        lookup_symbols(string)
 
-    # Where should the multicharacter symbols go?  Initially, they are appended prefix
-    # tags, but as soon as one "lemma" symbol is seen, the tags should be appeneded to
-    # the suffix tags.
-    tag_destination = prefix_tags
+        Like :py:meth:`TransducerFile.lookup_symbols`, with each list of
+        symbols tagged with the transducer it came from.
 
-    for symbol in letters_and_tags:
-        if len(symbol) == 1:
-            lemma_chars.append(symbol)
-            tag_destination = suffix_tags
-        else:
-            assert len(symbol) > 1
-            tag_destination.append(symbol)
+        :param str string: The string to lookup.
+        :rtype: list[tuple[int, list[str]]]
+        """
+        cdef std_string c_string = bytes_from_cstring(string)
+        cdef vector[CascadeAnalysis] results
+        with nogil:
+            results = self.c_cascade.lookup(c_string.c_str())
+        return [
+            (a.stage, [x.decode('UTF-8') for x in a.symbols]) for a in results
+        ]
 
-    return Analysis(tuple(prefix_tags), "".join(lemma_chars), tuple(suffix_tags))
+    def lookup(self, string):
+        """
+        lookup(string)
+
+        Like :py:meth:`TransducerFile.lookup`, with each analysis tagged with
+        the transducer it came from.
+
+        :param str string: The string to lookup.
+        :return: list of ``(transducer index, analysis)`` tuples
+        :rtype: list[tuple[int, str]]
+        """
+        return [(stage, ''.join(a)) for stage, a in self.lookup_symbols(string)]
+
+    def bulk_lookup(self, words):
+        """
+        bulk_lookup(words)
+
+        Like ``lookup()`` applied to multiple inputs. Each transducer looks up
+        all the words still needing analyses in a single pass, like
+        :py:meth:`TransducerFile.bulk_lookup`.
+
+        :param words: list of words to lookup
+        :type words: list[str]
+        :return: a dictionary mapping words in the input to their tagged
+            analyses, as ``lookup()`` returns them
+        :rtype: dict[str, list[tuple[int, str]]]
+        """
+        words = list(words)
+        cdef vector[std_string] c_words
+        for w in words:
+            c_words.push_back(bytes_from_cstring(w))
+        cdef vector[vector[CascadeAnalysis]] results
+        with nogil:
+            results = self.c_cascade.bulk_lookup(c_words)
+        ret = {}
+        for n, w in enumerate(words):
+            ret[w] = [
+                (a.stage, b''.join(a.symbols).decode('UTF-8')) for a in results[n]
+            ]
+        return ret
+
+    def __dealloc__(self):
+        del self.c_cascade
+
+
+cdef class _Column:
+    """A read-only buffer over one of the vectors of an AnalysisColumns"""
+
+    cdef object owner # keeps the vector alive
+    cdef void* data
+    cdef Py_ssize_t shape[1]
+    cdef Py_ssize_t itemsize
+    cdef bytes format
+
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        if flags & PyBUF_WRITABLE:
+            raise BufferError("analysis columns are read-only")
+        buffer.buf = self.data
+        buffer.obj = self
+        buffer.len = self.shape[0] * self.itemsize
+        buffer.readonly = 1
+        buffer.itemsize = self.itemsize
+        buffer.format = self.format
+        buffer.ndim = 1
+        buffer.shape = self.shape
+        buffer.strides = &self.itemsize
+        buffer.suboffsets = NULL
+        buffer.internal = NULL
+
+    def __releasebuffer__(self, Py_buffer *buffer):
+        pass
+
+
+# Empty vectors may not have any data pointer, but buffers always need one
+cdef char empty_column_data[8]
+
+cdef _Column make_column(owner, void* data, size_t length, Py_ssize_t itemsize, bytes format):
+    cdef _Column column = _Column.__new__(_Column)
+    column.owner = owner
+    column.data = data if length else <void*>empty_column_data
+    column.shape[0] = length
+    column.itemsize = itemsize
+    column.format = format
+    return column
+
+
+cdef class AnalysisColumns:
+    """
+    The analyses of a batch of words, as returned by
+    :py:meth:`TransducerFile.bulk_lookup_columns`.
+
+    Each column is a read-only :py:class:`memoryview` over native memory,
+    which ``numpy.asarray()`` or ``pyarrow.py_buffer()`` can use without
+    copying. Analysis ``i`` is an analysis of ``words[word_index[i]]``; its
+    symbol numbers are ``symbols[symbol_offsets[i]:symbol_offsets[i + 1]]``
+    and its UTF-8 text is ``text[text_offsets[i]:text_offsets[i + 1]]``.
+    The offsets are Arrow-style, so ``text_offsets`` and ``text`` make up
+    an Arrow ``large_string`` array of the analyses.
+
+    ``len()`` is the number of analyses.
+    """
+
+    cdef CppAnalysisColumns c_columns
+
+    def __len__(self):
+        return self.c_columns.word_index.size()
+
+    @property
+    def word_index(self):
+        """The position in the input of the word each analysis is of (int64)"""
+        return memoryview(make_column(
+            self, self.c_columns.word_index.data(), self.c_columns.word_index.size(),
+            sizeof(long long), b'q'))
+
+    @property
+    def symbol_offsets(self):
+        """Where each analysis starts in ``symbols``, plus the end (int64)"""
+        return memoryview(make_column(
+            self, self.c_columns.symbol_offsets.data(), self.c_columns.symbol_offsets.size(),
+            sizeof(long long), b'q'))
+
+    @property
+    def symbols(self):
+        """The symbol numbers of all the analyses, concatenated (uint16)"""
+        return memoryview(make_column(
+            self, self.c_columns.symbols.data(), self.c_columns.symbols.size(),
+            sizeof(unsigned short), b'H'))
+
+    @property
+    def text_offsets(self):
+        """Where each analysis starts in ``text``, plus the end (int64)"""
+        return memoryview(make_column(
+            self, self.c_columns.text_offsets.data(), self.c_columns.text_offsets.size(),
+            sizeof(long long), b'q'))
+
+    @property
+    def text(self):
+        """The UTF-8 text of all the analyses, concatenated (bytes)"""
+        return memoryview(make_column(
+            self, self.c_columns.text.data(), self.c_columns.text.size(),
+            1, b'B'))
+
+
+def compile_transducer(source, destination, words=None):
+    """
+    compile_transducer(source, destination, words=None)
+
+    Write the unweighted ``.hfstol`` transducer at ``source`` to
+    ``destination`` in a compiled format. :py:class:`TransducerFile` maps a
+    compiled transducer straight into memory instead of parsing it, so it
+    loads much faster; it only works on machines with the same byte order
+    as the one that compiled it.
+
+    >>> compile_transducer("path/to/fst.hfstol", "path/to/fst.hfstolc")
+    >>> analyzer = TransducerFile("path/to/fst.hfstolc")
+
+    With ``words``, typical inputs such as a sample of a corpus, the states
+    that looking them up visits most are laid out next to each other at the
+    start of the index table and of the transition table, so that lookups
+    touch fewer pages of memory and :py:class:`TransducerFile` can prefault
+    the hot part first.
+    The lookup results are the same either way.
+
+    :param source: the path to the .hfstol file
+    :type source: str or os.PathLike
+    :param destination: the path to write the compiled transducer to
+    :type destination: str or os.PathLike
+    :param words: inputs to lay the transducer out for
+    :type words: iterable of str or None
+    """
+    cdef vector[std_string] c_words
+    if words is not None:
+        for w in words:
+            c_words.push_back(bytes_from_cstring(w))
+    cpp_compile_transducer(
+        bytes_from_cstring(os.fspath(source)),
+        bytes_from_cstring(os.fspath(destination)),
+        c_words,
+    )
+
+
+def apply_input_rule(rule, text):
+    """
+    apply_input_rule(rule, text) -> str
+
+    Returns the variant of ``text`` that
+    :py:meth:`TransducerFile.lookup_variants` makes with ``rule`` alone,
+    such as ``"lowercase"`` or ``"compose-latin"``.
+
+    >>> apply_input_rule("compose-latin", "mo\\u0302swa")
+    'môswa'
+
+    :param str rule: the name of the rule
+    :param str text: the text to rewrite
+    :rtype: str
+    """
+    return cpp_apply_input_rule(
+        input_rule_from_name(bytes_from_cstring(rule)), bytes_from_cstring(text)
+    ).decode('UTF-8')
@@ -0,0 +1,187 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional, Union
+
+from ._hfst_optimized_lookup import TransducerFile
+from ._types import RegistryStats
+
+PathLike = Union[str, "os.PathLike[str]"]
+
+
+class _Entry:
+    __slots__ = ("path", "options", "loading", "transducer", "size")
+
+    def __init__(self, path: PathLike, options: Dict[str, Any]) -> None:
+        self.path = path
+        self.options = options
+        # held while loading, so that each transducer is only loaded once
+        # however many threads ask for it at the same time
+        self.loading = threading.Lock()
+        self.transducer: Optional[TransducerFile] = None
+        self.size = 0
+
+
+def _resident_size(transducer: TransducerFile, path: PathLike) -> int:
+    try:
+        return transducer.memory_usage()["total"]
+    except RuntimeError:
+        # weighted transducers don't report their memory usage; they take
+        # up at least as much as their file
+        return os.path.getsize(path)
+
+
+class TransducerRegistry:
+    """
+    Transducers by name, each loaded the first time it is asked for and
+    shared by every thread after that. When the transducers loaded take up
+    more than ``memory_budget`` bytes, as reported by
+    :py:meth:`TransducerFile.memory_usage` right after loading them, the
+    least recently used are evicted until they fit again, and loaded again
+    when next asked for. The transducer just loaded is never evicted, even
+    if it doesn't fit by itself.
+
+    Evicting a compiled transducer (see
+    :py:func:`hfst_optimized_lookup.compile_transducer`) only unmaps its
+    file, and loading it again only maps it back in, so for processes
+    serving many transducers, compiled ones make eviction cheap.
+
+    >>> registry = TransducerRegistry(
+    ...     {"crk-analyzer": "crk-analyzer.hfstolc", "crk-generator": "crk-generator.hfstolc"},
+    ...     memory_budget=256 * 1024 * 1024,
+    ... )
+    >>> registry["crk-analyzer"].lookup("atim")
+    ['atim+N+A+Sg']
+
+    A transducer that has been evicted stays usable by whoever still has
+    it, and is only freed once they are done with it.
+
+    :param transducers: paths to transducer files, by name
+    :type transducers: dict[str, str or os.PathLike] or None
+    :param memory_budget: bytes the loaded transducers may take up, or
+        None for no limit
+    :type memory_budget: int or None
+    :param options: passed on to :py:class:`TransducerFile` when loading,
+        such as ``epsilon_closures=True``
+    """
+
+    def __init__(
+        self,
+        transducers: Optional[Mapping[str, PathLike]] = None,
+        memory_budget: Optional[int] = None,
+        **options: Any,
+    ) -> None:
+        self.memory_budget = memory_budget
+        self._options = options
+        self._lock = threading.Lock()
+        self._entries: Dict[str, _Entry] = {}
+        # the loaded entries, least recently used first
+        self._loaded: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._memory_in_use = 0
+        self._hits = 0
+        self._loads = 0
+        self._evictions = 0
+        if transducers is not None:
+            for name, path in transducers.items():
+                self.register(name, path)
+
+    def register(self, name: str, path: PathLike, **options: Any) -> None:
+        """
+        Add the transducer at ``path`` under ``name``, without loading it.
+        ``options`` are passed on to :py:class:`TransducerFile`, in addition
+        to those given to the registry. Registering a name again replaces
+        the transducer, evicting it if it was loaded.
+        """
+        entry = _Entry(os.fspath(path), {**self._options, **options})
+        with self._lock:
+            if name in self._loaded:
+                self._evict(name)
+            self._entries[name] = entry
+
+    def get(self, name: str) -> TransducerFile:
+        """
+        The transducer registered under ``name``, loading it if it isn't
+        loaded. Raises ``KeyError`` if there is no such transducer.
+        """
+        with self._lock:
+            entry = self._entries[name]
+            transducer = self._hit(name, entry)
+        if transducer is not None:
+            return transducer
+
+        with entry.loading:
+            with self._lock:
+                # another thread may have loaded it meanwhile
+                transducer = self._hit(name, entry)
+            if transducer is not None:
+                return transducer
+            transducer = TransducerFile(entry.path, **entry.options)
+            size = _resident_size(transducer, entry.path)
+            with self._lock:
+                if self._entries.get(name) is entry:
+                    entry.transducer = transducer
+                    entry.size = size
+                    self._loaded[name] = entry
+                    self._memory_in_use += size
+                    self._evict_over_budget(keep=name)
+                self._loads += 1
+        return transducer
+
+    def __getitem__(self, name: str) -> TransducerFile:
+        return self.get(name)
+
+    def __contains__(self, name: object) -> bool:
+        with self._lock:
+            return name in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def evict(self, name: str) -> None:
+        """
+        Evict the transducer registered under ``name``, if it is loaded.
+        """
+        with self._lock:
+            if name in self._loaded:
+                self._evict(name)
+
+    def stats(self) -> RegistryStats:
+        """
+        How often transducers have been asked for, loaded and evicted, and
+        what is loaded now.
+        """
+        with self._lock:
+            return RegistryStats(
+                hits=self._hits,
+                loads=self._loads,
+                evictions=self._evictions,
+                memory_in_use=self._memory_in_use,
+                loaded=tuple(self._loaded),
+            )
+
+    def _hit(self, name: str, entry: _Entry) -> Optional[TransducerFile]:
+        # called with the lock held
+        transducer = entry.transducer
+        if transducer is not None:
+            self._hits += 1
+            self._loaded.move_to_end(name)
+        return transducer
+
+    def _evict(self, name: str) -> None:
+        # called with the lock held
+        entry = self._loaded.pop(name)
+        self._memory_in_use -= entry.size
+        entry.transducer = None
+        entry.size = 0
+        self._evictions += 1
+
+    def _evict_over_budget(self, keep: str) -> None:
+        # called with the lock held
+        if self.memory_budget is None:
+            return
+        while self._memory_in_use > self.memory_budget:
+            name = next(iter(self._loaded))
+            if name == keep:
+                break
+            self._evict(name)
@@ -1,4 +1,4 @@
-from typing import NamedTuple, Tuple
+from typing import List, NamedTuple, Tuple
 
 
 class Analysis(NamedTuple):
@@ -47,3 +47,91 @@ class Analysis(NamedTuple):
     """
     Tags that appear after the lemma.
     """
+
+
+class VariantLookup(NamedTuple):
+    """
+    The result of :py:meth:`TransducerFile.lookup_variants`.
+
+    >>> analyzer.lookup_variants("Nipāw")
+    VariantLookup(variant='nipâw', rules=('lowercase', 'macron-to-circumflex'), analyses=['nipâw+V+AI+Ind+3Sg'])
+    """
+
+    variant: str
+    """
+    The variant of the input that was looked up, or the input itself if no
+    variant has any analyses.
+    """
+
+    rules: Tuple[str, ...]
+    """
+    The rules applied to the input to get the variant.
+    """
+
+    analyses: List[str]
+    """
+    The analyses of the variant, as returned by ``lookup()``.
+    """
+
+
+class Completion(NamedTuple):
+    """
+    A way to continue an input, found by :py:meth:`TransducerFile.complete`.
+    """
+
+    suffix: str
+    """
+    The rest of the input after the prefix.
+    """
+
+    output: str
+    """
+    The output for the prefix followed by the suffix.
+    """
+
+
+class Completions(NamedTuple):
+    """
+    The result of :py:meth:`TransducerFile.complete`.
+    """
+
+    completions: List[Completion]
+    """
+    The completions, in the order they were found.
+    """
+
+    truncated: bool
+    """
+    Whether a limit cut the search short, so that there may be more.
+    """
+
+
+class RegistryStats(NamedTuple):
+    """
+    The counters of a :py:class:`TransducerRegistry`.
+    """
+
+    hits: int
+    """
+    How many times a transducer was asked for and already loaded.
+    """
+
+    loads: int
+    """
+    How many times a transducer was loaded.
+    """
+
+    evictions: int
+    """
+    How many times a transducer was evicted.
+    """
+
+    memory_in_use: int
+    """
+    Bytes taken up by the transducers loaded now.
+    """
+
+    loaded: Tuple[str, ...]
+    """
+    The names of the transducers loaded now, least recently used first.
+    """
@@ -1,9 +1,22 @@
+import os
+import struct
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import pytest
 
 import hfst_optimized_lookup
-from hfst_optimized_lookup import TransducerFile, Analysis
+from hfst_optimized_lookup import (
+    TransducerFile,
+    TransducerCascade,
+    TransducerRegistry,
+    Analysis,
+    Completion,
+    VariantLookup,
+    apply_input_rule,
+    compile_transducer,
+)
 
 TEST_FST = "../crk-relaxed-analyzer-for-dictionary.hfstol"
 
@@ -58,11 +71,461 @@ def test_bulk_lookup_with_iterator(fst: TransducerFile) -> None:
     )
 
 
+def test_bulk_lookup_matches_lookup(fst: TransducerFile) -> None:
+    # Words sharing prefixes, a duplicate, an invalid word and the empty
+    # string all go through the same prefix-sharing traversal.
+    words = ["atim", "atimwa", "atimwak", "ê-mowât", "ê-nipâyân", "atim", "avocado", ""]
+    assert fst.bulk_lookup(words) == {w: set(fst.lookup(w)) for w in words}
+
+
+def test_bulk_lookup_columns(fst: TransducerFile) -> None:
+    words = ["atim", "atimwa", "ê-mowât", "avocado", "", "atim"]
+    columns = fst.bulk_lookup_columns(words)
+    symbol_table = fst.symbol_table()
+
+    word_index = columns.word_index.tolist()
+    symbol_offsets = columns.symbol_offsets.tolist()
+    symbols = columns.symbols.tolist()
+    text_offsets = columns.text_offsets.tolist()
+    text = columns.text.tobytes()
+    assert len(columns) == len(word_index)
+    assert len(symbol_offsets) == len(text_offsets) == len(columns) + 1
+
+    analyses: dict[int, list[str]] = {n: [] for n in range(len(words))}
+    for i, n in enumerate(word_index):
+        analysis = text[text_offsets[i] : text_offsets[i + 1]].decode("UTF-8")
+        analysis_symbols = symbols[symbol_offsets[i] : symbol_offsets[i + 1]]
+        assert analysis == "".join(symbol_table[s] for s in analysis_symbols)
+        analyses[n].append(analysis)
+    assert [analyses[n] for n in range(len(words))] == [fst.lookup(w) for w in words]
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_iter_lookup(fst: TransducerFile, workers: int) -> None:
+    words = ["atim", "atimwa", "ê-mowât", "avocado", "", "atim"] * 5
+    expected = [(w, fst.lookup(w)) for w in words]
+    assert (
+        list(fst.iter_lookup(iter(words), batch_size=4, workers=workers)) == expected
+    )
+
+
+def test_iter_lookup_file(fst: TransducerFile, tmp_path: Path) -> None:
+    corpus_path = tmp_path / "corpus.txt"
+    corpus_path.write_text("atim\nmôswa\navocado\n", encoding="UTF-8")
+    with open(corpus_path, encoding="UTF-8") as f:
+        lines = (line.rstrip("\n") for line in f)
+        results = list(fst.iter_lookup(lines, batch_size=2))
+    assert results == [(w, fst.lookup(w)) for w in ["atim", "môswa", "avocado"]]
+    assert results[0][1] != []
+
+
+@pytest.mark.parametrize("policy", ["first-nonempty", "union"])
+def test_transducer_cascade(fst: TransducerFile, policy: str) -> None:
+    cascade = TransducerCascade([fst, fst], policy)
+    words = ["môswa", "avocado", "", "môswa"]
+
+    def expected(word: str) -> list[tuple[int, str]]:
+        stages = [0] if policy == "first-nonempty" else [0, 1]
+        return [(stage, a) for stage in stages for a in fst.lookup(word)]
+
+    assert cascade.lookup("môswa") == expected("môswa")
+    assert cascade.bulk_lookup(words) == {w: expected(w) for w in words}
+
+
+def test_transducer_cascade_stages(fst: TransducerFile, tmp_path: Path) -> None:
+    snapshot_path = tmp_path / "fst.snapshot"
+    fst.save_snapshot(snapshot_path, ["môswa"])
+    first = TransducerFile(TEST_FST, snapshot=snapshot_path)
+    second = TransducerFile(TEST_FST)
+    for stage in [first, second]:
+        stage.set_metrics(True)
+        stage.set_hit_counting(True)
+    cascade = TransducerCascade([first, second])
+
+    words = ["môswa", "atim", "avocado"]
+    assert cascade.bulk_lookup(words) == {
+        w: [(0, a) for a in fst.lookup(w)] for w in words
+    }
+    assert first.hit_counts() == {"atim": 1, "avocado": 1, "môswa": 1}
+    # only avocado has no analyses in the first stage
+    assert second.hit_counts() == {"avocado": 1}
+    assert first.metrics()["latency"]["bulk_lookup"]["count"] == 1
+    assert first.metrics()["analyses"]["count"] == 3
+    assert second.metrics()["analyses"]["count"] == 1
+
+
+def write_guesser(path: Path) -> None:
+    """Write an .hfstol transducer that only analyzes “z”, as “z+Guess”"""
+    no_symbol, no_index, transition_table = 0xFFFF, 0xFFFFFFFF, 2**31
+    symbols = ["@_EPSILON_SYMBOL_@", "z", "+Guess"]
+    # the start state's finality entry, then its slots for ε and z
+    index = [(no_symbol, no_index), (no_symbol, no_index), (1, transition_table)]
+    # z:z, then a state with ε:+Guess to a final state
+    transitions = [
+        (1, 1, transition_table + 1),
+        (no_symbol, no_symbol, no_index),
+        (0, 2, transition_table + 3),
+        (no_symbol, no_symbol, 1),
+        (no_symbol, no_symbol, no_index),
+    ]
+    data = struct.pack("<HHIIII", 2, len(symbols), len(index), len(transitions), 3, 2)
+    # unweighted, deterministic, input-deterministic, minimized, acyclic,
+    # with input epsilons
+    data += struct.pack("<9I", 0, 1, 1, 1, 0, 0, 1, 0, 0)
+    data += b"".join(s.encode("UTF-8") + b"\0" for s in symbols)
+    data += b"".join(struct.pack("<HI", *entry) for entry in index)
+    data += b"".join(struct.pack("<HHI", *entry) for entry in transitions)
+    path.write_bytes(data)
+
+
+def test_transducer_cascade_reload(fst: TransducerFile, tmp_path: Path) -> None:
+    guesser_path = tmp_path / "guesser.hfstol"
+    write_guesser(guesser_path)
+    second = TransducerFile(TEST_FST)
+    cascade = TransducerCascade([fst, second])
+    assert cascade.lookup("z") == []
+
+    # z is only in the new alphabet of the second stage
+    second.reload(guesser_path)
+    assert cascade.lookup("z") == [(1, "z+Guess")]
+    assert cascade.bulk_lookup(["z", "atim"]) == {
+        "z": [(1, "z+Guess")],
+        "atim": [(0, a) for a in fst.lookup("atim")],
+    }
+
+
+@pytest.mark.parametrize(
+    ("surface", "rules"),
+    [
+        ("môswa", ()),
+        ("MÔSWA", ("lowercase",)),
+        ("mōswa", ("macron-to-circumflex",)),
+        ("Mōswa", ("lowercase", "macron-to-circumflex")),
+        # “môswa” with a combining circumflex
+        ("mo\u0302swa", ("compose-latin",)),
+    ],
+)
+def test_lookup_variants(
+    fst: TransducerFile, surface: str, rules: tuple[str, ...]
+) -> None:
+    assert fst.lookup_variants(surface) == VariantLookup(
+        "môswa", rules, fst.lookup("môswa")
+    )
+
+
+def test_lookup_variants_without_a_match(fst: TransducerFile) -> None:
+    assert fst.lookup_variants("Mōswa", rules=["lowercase"]) == VariantLookup(
+        "Mōswa", (), []
+    )
+    with pytest.raises(ValueError):
+        fst.lookup_variants("môswa", rules=["no-such-rule"])
+
+
+def test_input_rules_only_fold_latin() -> None:
+    assert apply_input_rule("compose-latin", "mo\u0302swa") == "môswa"
+    assert apply_input_rule("decompose-latin", "môswa") == "mo\u0302swa"
+    assert apply_input_rule("lowercase", "MÔSWA Ωмега") == "môswa ωмега"
+    # Not covered: combining sequences Unicode NFC composes into letters
+    # outside Latin-1 and Latin Extended-A, such as Latin Extended Additional,
+    # and their capitals
+    assert apply_input_rule("compose-latin", "m\u0301") == "m\u0301"
+    assert unicodedata.normalize("NFC", "m\u0301") == "\u1e3f"
+    assert apply_input_rule("decompose-latin", "\u1e3f") == "\u1e3f"
+    assert apply_input_rule("lowercase", "\u1e3e") == "\u1e3e"
+    # nor the names NFC and NFD once had
+    with pytest.raises(ValueError):
+        apply_input_rule("compose", "mo\u0302swa")
+
+
+def test_complete(fst: TransducerFile) -> None:
+    result = fst.complete("môsw", max_depth=3)
+    assert Completion("a", "môswa+N+A+Sg") in result.completions
+    for suffix, output in result.completions:
+        assert len(suffix) <= 3
+        assert output in fst.lookup("môsw" + suffix)
+
+    assert fst.complete("avocado").completions == []
+
+
+def test_complete_limits(fst: TransducerFile) -> None:
+    result = fst.complete("môsw", limit=1)
+    assert len(result.completions) == 1
+    assert result.truncated
+
+    required = fst.complete("môsw", max_depth=3, require=["a"]).completions
+    excluded = fst.complete("môsw", max_depth=3, exclude=["a"]).completions
+    assert required and all("a" in c.suffix for c in required)
+    assert all("a" not in c.suffix for c in excluded)
+
+    with pytest.raises(ValueError):
+        fst.complete("môsw", exclude=["no-such-symbol"])
+
+
+def test_epsilon_closures(fst: TransducerFile) -> None:
+    with_closures = TransducerFile(TEST_FST, epsilon_closures=True)
+    assert with_closures.epsilon_closures_size() > 0
+    assert fst.epsilon_closures_size() == 0
+
+    words = ["môswa", "ê-mowât", "nikî-nipân", "avocado", ""]
+    for word in words:
+        assert with_closures.lookup_symbols(word) == fst.lookup_symbols(word)
+    assert with_closures.bulk_lookup(words) == fst.bulk_lookup(words)
+
+
+def test_memory_usage(fst: TransducerFile) -> None:
+    usage = fst.memory_usage()
+    assert usage["total"] == sum(usage["structures"].values())
+    assert usage["structures"]["transition_targets"] > 0
+    assert usage["counts"]["symbols"] == fst.symbol_count()
+
+
+def test_load_profile(fst: TransducerFile, tmp_path: Path) -> None:
+    assert list(fst.load_profile()) == [
+        "header",
+        "alphabet",
+        "index build",
+        "table read",
+        "symbol tables",
+    ]
+    assert all(seconds >= 0 for seconds in fst.load_profile().values())
+
+    compiled_path = tmp_path / "compiled.hfstolc"
+    compile_transducer(TEST_FST, compiled_path)
+    assert list(TransducerFile(compiled_path).load_profile()) == ["map"]
+    assert list(TransducerFile(compiled_path, prefault=True).load_profile()) == [
+        "map",
+        "prefault",
+    ]
+
+
+def test_metrics() -> None:
+    fst = TransducerFile(TEST_FST)
+    fst.lookup("atim")
+    assert fst.metrics()["latency"]["lookup"]["count"] == 0
+
+    fst.set_metrics(True)
+    fst.lookup("atim")
+    fst.lookup_symbols("môswa")
+    fst.bulk_lookup(["atim", "môswa", "avocado"])
+    metrics = fst.metrics()
+    lookups = metrics["latency"]["lookup"]
+    assert lookups["count"] == 2
+    assert sum(count for _, count in lookups["buckets"]) == 2
+    assert lookups["buckets"][-1][0] == float("inf")
+    assert metrics["latency"]["bulk_lookup"]["count"] == 1
+    assert metrics["analyses"]["count"] == 5
+    # avocado has no analyses
+    assert metrics["analyses"]["buckets"][0] == (0, 1)
+
+    fst.reset_metrics()
+    assert fst.metrics()["analyses"]["count"] == 0
+
+
+def test_metrics_slow_lookups() -> None:
+    fst = TransducerFile(TEST_FST)
+    fst.set_metrics(True, slow_threshold=0, slow_log_size=2)
+    for word in ["atim", "môswa", "avocado"]:
+        fst.lookup(word)
+    metrics = fst.metrics()
+    assert metrics["slow_lookup_count"] == 3
+    assert [s["input"] for s in metrics["slow_lookups"]] == ["môswa", "avocado"]
+    assert metrics["slow_lookups"][-1]["method"] == "lookup"
+    assert metrics["slow_lookups"][-1]["analyses"] == 0
+
+    text = fst.metrics_prometheus()
+    assert "# TYPE hfstol_lookup_seconds histogram\n" in text
+    assert 'hfstol_lookup_seconds_bucket{method="lookup",le="+Inf"} 3\n' in text
+    assert 'hfstol_lookup_seconds_count{method="lookup"} 3\n' in text
+    assert 'hfstol_analyses_per_input_bucket{le="0"} 1\n' in text
+    assert "hfstol_slow_lookups_total 3\n" in text
+
+
+def test_snapshot(fst: TransducerFile, tmp_path: Path) -> None:
+    words = ["môswa", "atim", "avocado", ""]
+    snapshot_path = tmp_path / "fst.snapshot"
+    fst.save_snapshot(snapshot_path, words + ["itwêwina"], size=len(words))
+
+    warm = TransducerFile(TEST_FST, snapshot=snapshot_path)
+    assert warm.snapshot_entry_count() == len(words)
+    assert "snapshot" in warm.load_profile()
+    for word in words + ["itwêwina"]:
+        assert warm.lookup_symbols(word) == fst.lookup_symbols(word)
+    assert warm.bulk_lookup(words + ["itwêwina"]) == fst.bulk_lookup(
+        words + ["itwêwina"]
+    )
+
+    compiled_path = tmp_path / "compiled.hfstolc"
+    compile_transducer(TEST_FST, compiled_path)
+    with pytest.raises(Exception) as exception_info:
+        TransducerFile(compiled_path, snapshot=snapshot_path)
+    assert "different transducer" in " ".join(exception_info.value.args)
+
+    # a copy, with a different modification time, is the same transducer
+    copy_path = tmp_path / "copy.hfstol"
+    copy_path.write_bytes(Path(TEST_FST).read_bytes())
+    os.utime(copy_path, (0, 0))
+    assert TransducerFile(copy_path, snapshot=snapshot_path).snapshot_entry_count() == len(
+        words
+    )
+
+
+def test_snapshot_corrupt(fst: TransducerFile, tmp_path: Path) -> None:
+    snapshot_path = tmp_path / "fst.snapshot"
+    fst.save_snapshot(snapshot_path, ["môswa", "atim"])
+    image = snapshot_path.read_bytes()
+
+    truncated_path = tmp_path / "truncated.snapshot"
+    truncated_path.write_bytes(image[:-1])
+    # the first entry's key offset, just after the 64-byte header
+    corrupt_path = tmp_path / "corrupt.snapshot"
+    corrupt_path.write_bytes(image[:64] + b"\xff\xff\xff\x7f" + image[68:])
+    for path in [truncated_path, corrupt_path]:
+        with pytest.raises(Exception) as exception_info:
+            TransducerFile(TEST_FST, snapshot=path)
+        assert "truncated or corrupt" in " ".join(exception_info.value.args)
+
+
+def test_snapshot_from_hit_counts(tmp_path: Path) -> None:
+    fst = TransducerFile(TEST_FST)
+    fst.set_hit_counting(True)
+    fst.lookup("môswa")
+    fst.bulk_lookup(["atim", "môswa"])
+    fst.set_hit_counting(False)
+    fst.lookup("itwêwina")
+    assert fst.hit_counts() == {"môswa": 2, "atim": 1}
+
+    snapshot_path = tmp_path / "fst.snapshot"
+    fst.save_snapshot(snapshot_path, size=1)
+    warm = TransducerFile(TEST_FST, snapshot=snapshot_path)
+    assert warm.snapshot_entry_count() == 1
+    assert warm.lookup("môswa") == fst.lookup("môswa")
+
+
+def test_reload(fst: TransducerFile, tmp_path: Path) -> None:
+    words = ["môswa", "atim", "itwêwina", "avocado", ""]
+    compiled_path = tmp_path / "compiled.hfstolc"
+    compile_transducer(TEST_FST, compiled_path)
+    snapshot_path = tmp_path / "fst.snapshot"
+    fst.save_snapshot(snapshot_path, words)
+
+    reloaded = TransducerFile(TEST_FST, snapshot=snapshot_path)
+    reloaded.reload(compiled_path)
+    assert list(reloaded.load_profile()) == ["map"]
+    # the snapshot was of the old transducer file
+    assert reloaded.snapshot_entry_count() == 0
+    assert reloaded.bulk_lookup(words) == fst.bulk_lookup(words)
+
+    with pytest.raises(Exception):
+        reloaded.reload(tmp_path / "missing.hfstol")
+    assert list(reloaded.load_profile()) == ["map"]
+
+    reloaded.reload(TEST_FST, snapshot=snapshot_path)
+    assert reloaded.snapshot_entry_count() == len(words)
+    reloaded.reload()
+    assert reloaded.snapshot_entry_count() == 0
+    for word in words:
+        assert reloaded.lookup_symbols(word) == fst.lookup_symbols(word)
+
+
+def test_reload_during_lookups(fst: TransducerFile, tmp_path: Path) -> None:
+    compiled_path = tmp_path / "compiled.hfstolc"
+    compile_transducer(TEST_FST, compiled_path)
+    words = ["môswa", "atim", "itwêwina", "nikî-nipân"] * 50
+    expected = fst.bulk_lookup(words)
+
+    reloaded = TransducerFile(TEST_FST)
+    with ThreadPoolExecutor(4) as executor:
+        lookups = [
+            executor.submit(reloaded.bulk_lookup, words) for _ in range(20)
+        ]
+        for n in range(10):
+            reloaded.reload(compiled_path if n % 2 == 0 else TEST_FST)
+        for lookup in lookups:
+            assert lookup.result() == expected
+
+
+def test_registry(tmp_path: Path) -> None:
+    compiled_path = tmp_path / "compiled.hfstolc"
+    compile_transducer(TEST_FST, compiled_path)
+    registry = TransducerRegistry({"hfstol": TEST_FST, "compiled": compiled_path})
+    assert "hfstol" in registry and len(registry) == 2
+    with pytest.raises(KeyError):
+        registry.get("missing")
+    assert registry.stats().loaded == ()
+
+    assert registry["compiled"].lookup("atim") == registry["hfstol"].lookup("atim")
+    assert registry["compiled"] is registry.get("compiled")
+    stats = registry.stats()
+    assert (stats.hits, stats.loads, stats.evictions) == (2, 2, 0)
+    assert stats.loaded == ("hfstol", "compiled")
+    assert stats.memory_in_use > 0
+
+    registry.evict("hfstol")
+    assert registry.stats().loaded == ("compiled",)
+    assert 0 < registry.stats().memory_in_use < stats.memory_in_use
+
+
+def test_registry_memory_budget(tmp_path: Path) -> None:
+    compiled_path = tmp_path / "compiled.hfstolc"
+    compile_transducer(TEST_FST, compiled_path)
+    budget = TransducerFile(compiled_path).memory_usage()["total"]
+    registry = TransducerRegistry(
+        {"a": compiled_path, "b": compiled_path, "c": compiled_path},
+        memory_budget=budget,
+    )
+
+    a = registry["a"]
+    registry["b"]
+    assert registry.stats().loaded == ("b",)
+    # an evicted transducer still works for whoever has it
+    assert a.lookup("atim") == registry["b"].lookup("atim")
+    registry["a"]
+    stats = registry.stats()
+    assert (stats.hits, stats.loads, stats.evictions) == (1, 3, 2)
+    assert stats.loaded == ("a",)
+    assert stats.memory_in_use <= budget
+
+
+def test_registry_threads() -> None:
+    registry = TransducerRegistry({"fst": TEST_FST})
+    with ThreadPoolExecutor(4) as executor:
+        transducers = list(executor.map(registry.get, ["fst"] * 20))
+    assert all(t is transducers[0] for t in transducers)
+    assert registry.stats().loads == 1
+    assert registry.stats().hits == 19
+
+
 def test_create_from_path_obj() -> None:
     fst = TransducerFile(Path(TEST_FST))
     assert fst.lookup("itwêwina") == ["itwêwin+N+I+Pl"]
 
 
+def test_compiled_transducer(fst: TransducerFile, tmp_path: Path) -> None:
+    compiled_path = tmp_path / "compiled.hfstolc"
+    compile_transducer(TEST_FST, compiled_path)
+    compiled = TransducerFile(compiled_path)
+
+    assert compiled.symbol_count() == fst.symbol_count()
+    words = ["itwêwina", "nikî-nipân", "môswa", "avocado", ""]
+    for word in words:
+        assert compiled.lookup_symbols(word) == fst.lookup_symbols(word)
+    assert compiled.bulk_lookup(words) == fst.bulk_lookup(words)
+
+
+def test_compiled_transducer_profile(fst: TransducerFile, tmp_path: Path) -> None:
+    compiled_path = tmp_path / "compiled.hfstolc"
+    profiled_path = tmp_path / "profiled.hfstolc"
+    compile_transducer(TEST_FST, compiled_path)
+    compile_transducer(TEST_FST, profiled_path, words=["môswa", "atim", "môswa"])
+    assert profiled_path.read_bytes() != compiled_path.read_bytes()
+
+    profiled = TransducerFile(profiled_path, prefault=True)
+    words = ["itwêwina", "nikî-nipân", "môswa", "atim", "avocado", ""]
+    for word in words:
+        assert profiled.lookup_symbols(word) == fst.lookup_symbols(word)
+    assert profiled.bulk_lookup(words) == fst.bulk_lookup(words)
+
+
 @pytest.mark.skip("not yet implemented")
 def test_limit(fst: TransducerFile) -> None:
     assert fst.lookup("môswa", limit=1) == ["môswa+N+A+Sg"]  # type: ignore
@@ -163,6 +626,16 @@ def test_lookup_lemma_with_affixes(
     assert example in analyses
 
 
+def test_lookup_lemma_with_affixes_keeps_every_symbol(fst: TransducerFile) -> None:
+    analyses = fst.lookup_lemma_with_affixes("ê-kî-nitawi-kâh-kîmôci-kotiskâwêyâhk")
+    symbols = fst.lookup_symbols("ê-kî-nitawi-kâh-kîmôci-kotiskâwêyâhk")
+    assert len(analyses) == len(symbols)
+    for analysis, analysis_symbols in zip(analyses, symbols):
+        assert list(analysis.prefixes) + list(analysis.lemma) + list(
+            analysis.suffixes
+        ) == analysis_symbols
+
+
 def test_raises_exception_on_missing_file() -> None:
     with pytest.raises(Exception) as exception_info:
         TransducerFile("/does-not-exist.hfstol")